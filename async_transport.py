@@ -0,0 +1,156 @@
+import asyncio
+import struct
+import time
+from typing import AsyncIterator
+from ibapi import comm, decoder
+from ibapi.client import EClient
+from ibapi.common import MAX_MSG_LEN, NO_VALID_ID
+from ibapi.errors import BAD_LENGTH, CONNECT_FAIL
+from ibapi.server_versions import MAX_CLIENT_VER, MIN_CLIENT_VER
+from log_config import log
+from trading_app import TradingApp
+
+# messages decoded back to back before the reader lets the strategy task run
+MESSAGES_PER_YIELD = 100
+# outgoing bytes buffered before the reader waits for TWS to read them
+WRITE_BUFFER_LIMIT = 1 << 20
+# callbacks kept for a stream consumer that falls behind, the oldest are dropped beyond this
+STREAM_QUEUE_SIZE = 10_000
+
+
+class AsyncConnection:
+    """Stands in for ibapi's Connection so the EClient request methods write to the asyncio stream.
+    It is only used from the event loop thread, which makes the socket lock of the threaded client unnecessary."""
+
+    def __init__(self, host: str, port: int, writer: asyncio.StreamWriter):
+        self.host = host
+        self.port = port
+        self.writer = writer
+
+    def isConnected(self) -> bool:
+        return self.writer is not None and not self.writer.is_closing()
+
+    def sendMsg(self, msg: bytes) -> int:
+        if not self.isConnected():
+            return 0
+        self.writer.write(msg)
+        return len(msg)
+
+    def disconnect(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class CallbackDispatcher:
+    """What the decoder calls instead of the app: every callback goes to TradingApp first
+    and is then copied to the streams opened for it"""
+
+    def __init__(self, app: TradingApp):
+        self.app = app
+        self.streams: dict[str, list[asyncio.Queue]] = {}
+
+    def __getattr__(self, name: str):
+        method = getattr(self.app, name)
+        streams = self.streams.get(name)
+        if not streams:
+            return method
+
+        def dispatch(*args):
+            method(*args)
+            for stream in streams:
+                if stream.full():
+                    stream.get_nowait()
+                stream.put_nowait(args)
+        return dispatch
+
+    async def stream(self, callback: str) -> AsyncIterator[tuple]:
+        """Arguments of every call of an EWrapper callback, from now until the consumer stops iterating"""
+        stream = asyncio.Queue(STREAM_QUEUE_SIZE)
+        self.streams.setdefault(callback, []).append(stream)
+        try:
+            while True:
+                yield await stream.get()
+        finally:
+            self.streams[callback].remove(stream)
+
+
+class AsyncTransport:
+    """IB socket client on an asyncio event loop. Messages are read and decoded on the loop and the strategy runs
+    as a task of the same loop, so TradingApp state is only touched by one thread and no reader thread is needed."""
+
+    def __init__(self, app: TradingApp):
+        self.app = app
+        self.dispatcher = CallbackDispatcher(app)
+        self.reader: asyncio.StreamReader = None
+        self.writer: asyncio.StreamWriter = None
+        self.messages_received = 0
+
+    async def read_message(self) -> bytes:
+        size = struct.unpack('!I', await self.reader.readexactly(4))[0]
+        return await self.reader.readexactly(size)
+
+    async def connect(self, host: str, port: int, client_id: int) -> bool:
+        """Opens the socket and runs the IB handshake, returns False when TWS could not be reached"""
+        app = self.app
+        try:
+            self.reader, self.writer = await asyncio.open_connection(host, port)
+        except OSError:
+            app.error(NO_VALID_ID, CONNECT_FAIL.code(), CONNECT_FAIL.msg())
+            return False
+        app.host, app.port, app.clientId = host, port, client_id
+        app.conn = AsyncConnection(host, port, self.writer)
+        app.setConnState(EClient.CONNECTING)
+        version = f'v{MIN_CLIENT_VER}..{MAX_CLIENT_VER}'
+        if app.connectionOptions:
+            version = f'{version} {app.connectionOptions}'
+        app.conn.sendMsg(str.encode('API\0', 'ascii') + comm.make_msg(version))
+        app.decoder = decoder.Decoder(self.dispatcher, None)
+        fields = ()
+        # news can arrive before the server version
+        try:
+            while len(fields) != 2:
+                app.decoder.interpret(fields)
+                fields = comm.read_fields(await self.read_message())
+        except (asyncio.IncompleteReadError, ConnectionError):
+            log.error('Disconnected during the IB handshake')
+            app.disconnect()
+            return False
+        server_version, connection_time = fields
+        app.serverVersion_ = int(server_version)
+        app.connTime = connection_time
+        app.decoder.serverVersion = app.serverVersion()
+        app.setConnState(EClient.CONNECTED)
+        app.startApi()
+        self.dispatcher.connectAck()
+        return True
+
+    async def run(self) -> None:
+        """Reads and dispatches messages until TWS closes the connection or close() is called"""
+        app = self.app
+        try:
+            while app.isConnected():
+                text = await self.read_message()
+                if len(text) > MAX_MSG_LEN:
+                    app.error(NO_VALID_ID, BAD_LENGTH.code(), f'{BAD_LENGTH.msg()}:{len(text)}:{text}')
+                    break
+                decode_start_ns = time.monotonic_ns()
+                app.decoder.interpret(comm.read_fields(text))
+                app.latency.record('decode_and_dispatch', decode_start_ns)
+                self.messages_received += 1
+                if self.messages_received % MESSAGES_PER_YIELD == 0:
+                    await asyncio.sleep(0)
+                if self.writer.transport.get_write_buffer_size() > WRITE_BUFFER_LIMIT:
+                    await self.writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            log.error(f'Connection to IB closed: {e!r}')
+        finally:
+            if app.isConnected():
+                app.disconnect()
+
+    def stream(self, callback: str) -> AsyncIterator[tuple]:
+        return self.dispatcher.stream(callback)
+
+    def close(self) -> None:
+        if self.app.isConnected():
+            self.app.disconnect()
@@ -0,0 +1,27 @@
+"""Times a parameter sweep of the vectorized backtester on one synthetic pair.
+
+Run from the repository root with: python -m benchmarks.backtest_sweep"""
+import time
+import numpy as np
+from benchmarks.pair_scoring import synthetic_closes
+from strategy.backtest import sweep
+
+BARS = 20000
+ROLLING_WINDOWS = list(range(20, 420, 20))
+BAND_RATIOS = [round(ratio, 2) for ratio in np.arange(0.25, 3.01, 0.25)]
+BAR_INTERVALS = [1, 2, 3, 5, 10, 15, 30, 60]
+
+
+def run():
+    closes = synthetic_closes(2, BARS, seed=3)
+    timestamps = np.datetime64('2022-01-03T09:30', 'ns').astype(np.int64) + np.arange(BARS)*60*10**9
+    start = time.perf_counter()
+    result = sweep(timestamps, closes[0], closes[1], ROLLING_WINDOWS, BAND_RATIOS, BAR_INTERVALS)
+    seconds = time.perf_counter() - start
+    print(f'{len(result.summary)} parameter sets | {len(result.trades)} trades | {seconds:.2f}s | '
+          f'{1000*seconds/len(result.summary):.2f}ms per parameter set')
+    print(result.summary.head(10).to_string(index=False))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,75 @@
+"""Benchmarks the vectorized pair scoring against check_bonds.
+
+Run from the repository root with: python -m benchmarks.pair_scoring
+The check_bonds path is timed on a sample of pairs and extrapolated for the large universes,
+a full 500 instrument run through statsmodels would take hours."""
+import time
+import warnings
+import numpy as np
+from market_data.bar_store import BarStore
+from strategy.pair_scoring import ordered_pairs, score_pairs
+from strategy.pairs_trade import check_bonds
+
+UNIVERSE_SIZES = [5, 50, 500]
+BARS = 2000
+ROLLING_WINDOW = 100
+MAX_SAMPLED_PAIRS = 40
+
+
+def synthetic_closes(number_of_instruments: int, bars: int, seed: int = 7) -> np.ndarray:
+    """Bond like prices sharing one random walk factor so that most pairs are cointegrated"""
+    rng = np.random.default_rng(seed)
+    factor = np.cumsum(rng.normal(0, 0.05, bars))
+    loadings = rng.uniform(0.3, 1.5, (number_of_instruments, 1))
+    noise = rng.normal(0, 0.03, (number_of_instruments, bars))
+    return 100 + loadings*factor + noise
+
+
+def to_bar_store(closes: np.ndarray) -> BarStore:
+    store = BarStore(len(closes))
+    start = np.datetime64('2022-01-03T09:30', 'ns').astype(np.int64)
+    three_minutes = 180*10**9
+    for i, close in enumerate(closes):
+        store.append(start + i*three_minutes, close, close, close, close, 0, close, 0)
+    return store
+
+
+def compare(fast: dict, slow: dict) -> bool:
+    for key, value in slow.items():
+        if isinstance(value, (float, np.floating)):
+            if not np.isclose(value, fast[key], rtol=1e-6, atol=0.011):
+                return False
+        elif value != fast[key]:
+            return False
+    return True
+
+
+def run(number_of_instruments: int):
+    names = [f'bond_{i}' for i in range(number_of_instruments)]
+    closes = synthetic_closes(number_of_instruments, BARS)
+    pairs = ordered_pairs(number_of_instruments)
+    start = time.perf_counter()
+    fast_results = score_pairs(names, closes, ROLLING_WINDOW, pairs)
+    fast_seconds = time.perf_counter() - start
+
+    sample = pairs[np.linspace(0, len(pairs) - 1, min(len(pairs), MAX_SAMPLED_PAIRS)).astype(int)]
+    bars = {}
+    matches = 0
+    start = time.perf_counter()
+    for first, second in sample:
+        for index in (first, second):
+            if index not in bars:
+                bars[index] = to_bar_store(closes[index])
+        slow = check_bonds(names[first], bars[first], names[second], bars[second], ROLLING_WINDOW)
+        fast = fast_results[int(first)*(number_of_instruments - 1) + int(second) - int(second > first)]
+        matches += compare(fast, slow)
+    slow_seconds = (time.perf_counter() - start) * len(pairs) / len(sample)
+    print(f'{number_of_instruments:>4} instruments {len(pairs):>7} pairs | vectorized {fast_seconds:9.3f}s | '
+          f'check_bonds {slow_seconds:9.3f}s{" (extrapolated)" if len(sample) < len(pairs) else ""} | '
+          f'speedup {slow_seconds/fast_seconds:7.1f}x | {matches}/{len(sample)} sampled pairs match')
+
+
+if __name__ == '__main__':
+    warnings.filterwarnings('ignore')
+    for size in UNIVERSE_SIZES:
+        run(size)
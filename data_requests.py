@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 from enum import Enum
-from typing import Optional
+from typing import Optional, Union
 from ibapi.contract import Contract
 
 
@@ -20,6 +20,17 @@ class DataRequest(Enum):
         return self.name
 
 
+class RequestState(Enum):
+    """Lifecycle of a request, complete means the end marker or the first data point arrived"""
+    Pending = 1
+    Sent = 2
+    Complete = 3
+    Errored = 4
+
+    def __str__(self) -> str:
+        return self.name
+
+
 @dataclass
 class Subscription:
     data_type: Optional[DataRequest]
@@ -27,12 +38,24 @@ class Subscription:
     name: str
     was_sent: bool = False
     send_time: Optional[float] = None
+    state: RequestState = RequestState.Pending
+    complete_time: Optional[float] = None
+    error_code: Optional[int] = None
+
+    def key(self) -> tuple[Optional[Union[int, str]], Optional[DataRequest]]:
+        """Identity of the request: the contract id, or the symbol before IB assigned one, and the data type"""
+        if self.contract is None:
+            return None, self.data_type
+        return self.contract.conId or self.contract.symbol, self.data_type
+
+    def latency(self) -> Optional[float]:
+        """Seconds between sending the request and its completion"""
+        if self.send_time is None or self.complete_time is None:
+            return None
+        return self.complete_time - self.send_time
 
     def __eq__(self, other):
-        if self.contract and other.contract:
-            return self.contract.conId == other.contract.conId and self.data_type == other.data_type
-        else:
-            return self.data_type == other.data_type
+        return self.key() == other.key()
 
     def __hash__(self):
-        return hash((self.contract.conId, self.data_type))
+        return hash(self.key())
@@ -0,0 +1,117 @@
+import threading
+import time
+from typing import Optional
+import numpy as np
+from log_config import log
+from others import rows_to_table
+from reporting import Reporter
+
+# 2**SUB_BUCKET_BITS linear sub buckets per power of two, values are kept within 1/64 (1.6%) of their true value
+SUB_BUCKET_BITS = 7
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+DEFAULT_REPORT_SECONDS = 60.0
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def bucket_index(value: int) -> int:
+    if value < SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return (shift << (SUB_BUCKET_BITS - 1)) + (value >> shift)
+
+
+def bucket_value(index: int) -> int:
+    """Lowest value of a bucket"""
+    if index < SUB_BUCKETS:
+        return index
+    shift = (index >> (SUB_BUCKET_BITS - 1)) - 1
+    return (index - (shift << (SUB_BUCKET_BITS - 1))) << shift
+
+
+BUCKETS = bucket_index((1 << 63) - 1) + 1
+
+
+class LatencyHistogram:
+    """HDR style histogram of nanosecond latencies: log linear buckets, fixed memory and O(1) recording
+    with a bounded relative error, so millions of samples cost no more than a few"""
+
+    def __init__(self):
+        self.counts = [0]*BUCKETS
+        self.count = 0
+        self.total = 0
+        self.min: Optional[int] = None
+        self.max: Optional[int] = None
+
+    def record(self, value_ns: int) -> None:
+        value_ns = max(0, value_ns)
+        self.counts[bucket_index(value_ns)] += 1
+        self.count += 1
+        self.total += value_ns
+        if self.min is None or value_ns < self.min:
+            self.min = value_ns
+        if self.max is None or value_ns > self.max:
+            self.max = value_ns
+
+    def percentile(self, percent: float) -> Optional[int]:
+        if not self.count:
+            return None
+        cumulative = np.cumsum(self.counts)
+        index = int(np.searchsorted(cumulative, max(1, int(np.ceil(self.count*percent/100)))))
+        return min(bucket_value(index), self.max)
+
+    def mean(self) -> Optional[float]:
+        return self.total/self.count if self.count else None
+
+    def summary_us(self) -> dict:
+        row = {'count': self.count, 'mean': self.mean(), 'min': self.min}
+        row.update({f'p{percent:g}': self.percentile(percent) for percent in PERCENTILES})
+        row['max'] = self.max
+        return {name: value if name == 'count' or value is None else round(value/1000, 1) for name, value in row.items()}
+
+
+class LatencyRecorder:
+    """Latency histograms of the order path by stage, in microseconds when reported.
+    Stages are measured from a monotonic nanosecond timestamp taken earlier on the same path, usually the tick."""
+
+    def __init__(self, report_seconds: float = DEFAULT_REPORT_SECONDS):
+        self.histograms: dict[str, LatencyHistogram] = {}
+        self.report_seconds = report_seconds
+        self.last_report_ns = time.monotonic_ns()
+        # recorded from the IB reader and the strategy thread
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, start_ns: Optional[int], end_ns: Optional[int] = None) -> None:
+        if start_ns is None:
+            return
+        end_ns = time.monotonic_ns() if end_ns is None else end_ns
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = LatencyHistogram()
+            histogram.record(end_ns - start_ns)
+
+    def rows(self) -> list[dict]:
+        with self._lock:
+            return [{'stage': stage, **histogram.summary_us()} for stage, histogram in self.histograms.items()]
+
+    def table(self) -> Optional[str]:
+        rows = self.rows()
+        if not rows:
+            return None
+        return rows_to_table(rows)
+
+    def dump(self, reporter: Optional[Reporter] = None) -> None:
+        """Logs the histograms, or hands them to the reporting thread when a reporter is given"""
+        if reporter is not None:
+            reporter.report('latency', 'Latency in microseconds', self.rows())
+            return
+        table = self.table()
+        if table:
+            log.info(f'Latency in microseconds: \n{table}')
+
+    def dump_periodically(self, reporter: Optional[Reporter] = None) -> None:
+        """Dumps the histograms every report_seconds, they keep accumulating since the start"""
+        now_ns = time.monotonic_ns()
+        if now_ns - self.last_report_ns >= self.report_seconds*1_000_000_000:
+            self.last_report_ns = now_ns
+            self.dump(reporter)
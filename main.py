@@ -1,143 +1,226 @@
+import asyncio
 import threading
 import time
 from pandas import read_json
+from async_transport import AsyncTransport
 from data_requests import DataRequest, Subscription
-from strategy.pairs_trade import PairsTrade
-from strategy.parameters import StrategyParameters
+from latency import DEFAULT_REPORT_SECONDS, LatencyRecorder
+from market_data.archive import MarketArchive
+from market_data.security_master import DEFAULT_BASE_URL, DEFAULT_CACHE_PATH, SecurityMaster
+from order_execution import ExecutionEngine, ExecutionMode, ExecutionParameters
+from order_manager import DEFAULT_TERMINAL_ORDERS_KEPT, OrderManager
+from reporting import Reporter
+from request_scheduler import RequestScheduler
+from risk_gate import RiskGate, RiskLimits
+from runtime_snapshot import DEFAULT_SNAPSHOT_PATH, SnapshotStore
+from strategy.pair_strategy import PairStrategy
 from strategy.status import StrategyStatus
 from trading_app import TradingApp
 from log_config import log
 import configparser
 
+# upper bound on how long the strategy sleeps without a callback, keeps time based transitions such as the positions timeout alive
+TIMER_FALLBACK_SECONDS = 1.0
+
+
+def subscribe_to_legs(app: TradingApp, strategies: list[PairStrategy]) -> None:
+    for strategy in strategies:
+        app.requests.add(Subscription(
+            DataRequest.QuoteData, strategy.parameters.bond_1_contract, strategy.parameters.bond_1_name))
+        app.requests.add(Subscription(
+            DataRequest.QuoteData, strategy.parameters.bond_2_contract, strategy.parameters.bond_2_name))
+    app.send_requests()
+
+
+def run_pair_strategy(app: TradingApp, strategy: PairStrategy):
+    """One step of the trade state machine of a pair, run when a quote of its legs or one of its orders changed"""
+    parameters = strategy.parameters
+    match strategy.status:
+        case StrategyStatus.WAITING_FOR_TRADES:
+            if app.has_data_to_place_trades(strategy):
+                band_ratio = 1
+                # mid and true spread are priced from the same quotes of both legs
+                snapshot = app.spread_snapshot(strategy)
+                app.latency.record('tick_to_band_check', max(quote.last_update_ns or 0 for quote in snapshot) or None)
+                mid_price_spread = strategy.spread(snapshot)
+                if mid_price_spread > parameters.spread_mean:
+                    true_spread = strategy.true_spread(True, snapshot)
+                    if strategy.is_time_to_report():
+                        log.info(
+                            f'{strategy.key} True price spread: {true_spread} low band {parameters.bottom_band(band_ratio)} top band {parameters.top_band(band_ratio)}')
+                    if true_spread > parameters.top_band(band_ratio):
+                        app.update_strategy_status(
+                            strategy, StrategyStatus.SENT_ENTRY_ORDERS)
+                        app.sell_the_spread(strategy)
+                else:
+                    true_spread = strategy.true_spread(False, snapshot)
+                    if strategy.is_time_to_report():
+                        log.info(
+                            f'{strategy.key} spread: {true_spread} low band {parameters.bottom_band(band_ratio)} top band {parameters.top_band(band_ratio)}')
+                    if true_spread < parameters.bottom_band(band_ratio):
+                        app.update_strategy_status(strategy, StrategyStatus.SENT_ENTRY_ORDERS)
+                        app.buy_the_spread(strategy)
+        case StrategyStatus.SENT_ENTRY_ORDERS:
+            if strategy.trades and not strategy.trades[-1].is_complete():
+                if strategy.trades[-1].has_both_entries():
+                    app.update_strategy_status(strategy, StrategyStatus.IN_A_TRADE)
+        case StrategyStatus.IN_A_TRADE:
+            if app.has_data_to_calculate_unrealized_pnl(strategy) and app.has_data_to_calculate_spread(strategy):
+                spread = strategy.spread(app.spread_snapshot(strategy))
+                spread_reverted_to_mean = False
+                if strategy.previous_spread:
+                    if (spread > parameters.spread_mean and strategy.previous_spread < parameters.spread_mean) or \
+                            (spread < parameters.spread_mean and strategy.previous_spread > parameters.spread_mean):
+                        spread_reverted_to_mean = True
+                ## check for trade closing conditions ##
+                if spread_reverted_to_mean:
+                    app.update_strategy_status(strategy, StrategyStatus.SENT_EXIT_ORDERS)
+                    if not app.has_open_orders(strategy):
+                        app.close_positions(strategy)
+                        log.info(
+                            f'{strategy.key} spread has reverted to the mean. Closing its positions')
+                ##periodic update##
+                if strategy.is_time_to_report():
+                    app.report_pnl(strategy)
+                    ##end periodic update##
+                strategy.previous_spread = spread
+        case StrategyStatus.SENT_EXIT_ORDERS:
+            if strategy.trades[-1].is_complete():
+                # commission reports can still be on their way when the exit fills arrive
+                report = app.trade_report(strategy.trades[-1])
+                if report is not None:
+                    log.info(f'{strategy.key} Trade Closed. Net PnL: {report}, account {app.pnl.snapshot()}')
+                    app.retire_strategy(strategy)
+
 
 def strategy_loop(app: TradingApp):
     while True:
-        match app.status:
-            case StrategyStatus.INITIALIZED:
-                positions_timeout = False
-                if app.seconds_since_start() > 6:
-                    positions_timeout = True
-                    log.info(
-                        'No positions received for 5 seconds. Assuming flat.')
-                if app.received_all_account_data(positions_timeout):
-                    app.update_status(StrategyStatus.AWARE_OF_ACCOUNT)
-            case StrategyStatus.AWARE_OF_ACCOUNT:
-                if app.is_flat():
-                    for bond in app.bonds_general_info:
-                        contract = bond.to_ibkr_contract()
-                        name = bond.securityTerm
-                        contract_sub = Subscription(
-                            DataRequest.ContractInfo, contract, name)
-                        historical_sub = Subscription(
-                            DataRequest.HistoricalData, contract, name)
-                        if contract_sub not in app.requests:
-                            app.requests[app.generate_req_id()] = contract_sub
-                        if historical_sub not in app.requests:
-                            app.requests[app.generate_req_id()
-                                         ] = historical_sub
-                    app.send_requests()
-                    app.update_status(StrategyStatus.ANALYZING_PAIRS)
-                else:
-                    positions_table = app.produce_positions_table()
-                    log.info(f'Positions \n{positions_table}')
-                    app.strategy_data = StrategyParameters.from_pickle()
-                    pair = PairsTrade.from_pickle_file()
-                    if pair:
-                        app.trades = [pair]
-                    for position in app.positions.values():
-                        quote_request = Subscription(
-                            DataRequest.QuoteData, position.contract, position.name)
-                        historical_request = Subscription(
-                            DataRequest.HistoricalData, position.contract, position.name)
-                        contract_sub = Subscription(
-                            DataRequest.ContractInfo, position.contract, position.name)
-                        if quote_request not in app.requests.values():
-                            app.requests[app.generate_req_id()] = quote_request
-                        if historical_request not in app.requests.values():
-                            app.requests[app.generate_req_id()
-                                         ] = historical_request
-                        if contract_sub not in app.requests.values():
-                            app.requests[app.generate_req_id()] = contract_sub
-                        app.send_requests()
-                    app.update_status(StrategyStatus.IN_A_TRADE)
-            case StrategyStatus.ANALYZING_PAIRS:
-                if app.has_data_to_analyze_pairs():
-                    app.find_pairs_trade()
-                    app.requests[app.generate_req_id()] = Subscription(
-                        DataRequest.QuoteData, app.strategy_data.bond_1_contract, app.strategy_data.bond_1_name)
-                    app.requests[app.generate_req_id()] = Subscription(
-                        DataRequest.QuoteData, app.strategy_data.bond_2_contract, app.strategy_data.bond_2_name)
-                    app.send_requests()
-                    app.strategy_data.create_pickle_file()
-                    app.update_status(StrategyStatus.WAITING_FOR_TRADES)
-                else:
-                    for bond in app.bonds_general_info:
-                        contract = bond.to_ibkr_contract()
-                        name = bond.securityTerm
-                        contract_sub = Subscription(
-                            DataRequest.ContractInfo, contract, name)
-                        historical_sub = Subscription(
-                            DataRequest.HistoricalData, contract, name)
-                        if contract_sub not in app.requests.values():
-                            app.requests[app.generate_req_id()] = contract_sub
-                        if historical_sub not in app.requests.values():
-                            app.requests[app.generate_req_id()
-                                         ] = historical_sub
+        app.wait_for_strategy_wakeup(wakeup_timeout(app))
+        strategy_step(app)
+        # off the path from signal to placeOrder
+        app.save_snapshot_if_due()
+
+
+async def strategy_task(app: TradingApp):
+    """strategy_loop for the asyncio transport, runs on the event loop between the IB messages"""
+    while True:
+        await app.wait_for_strategy_wakeup_async(wakeup_timeout(app))
+        strategy_step(app)
+        # off the path from signal to placeOrder
+        app.save_snapshot_if_due()
+
+
+def wakeup_timeout(app: TradingApp) -> float:
+    next_request = app.seconds_until_next_request()
+    return TIMER_FALLBACK_SECONDS if next_request is None else min(TIMER_FALLBACK_SECONDS, next_request)
+
+
+def strategy_step(app: TradingApp):
+    """Reacts to whatever changed since the previous wakeup"""
+    app.send_requests()
+    app.archive_ticks()
+    app.archive_orders()
+    app.manage_executions()
+    app.latency.dump_periodically(app.reporter)
+    match app.status:
+        case StrategyStatus.INITIALIZED:
+            positions_timeout = False
+            if app.seconds_since_start() > 6:
+                positions_timeout = True
+                log.info(
+                    'No positions received for 5 seconds. Assuming flat.')
+            if app.received_all_account_data(positions_timeout):
+                app.update_status(StrategyStatus.AWARE_OF_ACCOUNT)
+        case StrategyStatus.AWARE_OF_ACCOUNT:
+            if app.is_flat():
+                for bond in app.bonds_general_info:
+                    contract = bond.to_ibkr_contract()
+                    name = bond.securityTerm
+                    contract_sub = Subscription(
+                        DataRequest.ContractInfo, contract, name)
+                    historical_sub = Subscription(
+                        DataRequest.HistoricalData, contract, name)
+                    app.requests.add(contract_sub)
+                    app.requests.add(historical_sub)
+                app.send_requests()
+                app.update_status(StrategyStatus.ANALYZING_PAIRS)
+            else:
+                app.report_positions()
+                # strategies and trades come from the snapshot read at startup
+                if not app.strategies:
+                    log.error('Positions are not managed by any pair strategy, they are left as they are')
+                for position in app.positions.values():
+                    quote_request = Subscription(
+                        DataRequest.QuoteData, position.contract, position.name)
+                    historical_request = Subscription(
+                        DataRequest.HistoricalData, position.contract, position.name)
+                    contract_sub = Subscription(
+                        DataRequest.ContractInfo, position.contract, position.name)
+                    app.requests.add(quote_request)
+                    app.requests.add(historical_request)
+                    app.requests.add(contract_sub)
                     app.send_requests()
-            case StrategyStatus.WAITING_FOR_TRADES:
-                if app.has_data_to_place_trades():
-                    band_ratio = 1
-                    mid_price_spread = app.calculate_spread()
-                    if mid_price_spread > app.strategy_data.spread_mean:
-                        true_spread = app.calculate_true_spread(True)
-                        if app.is_time_to_report():
-                            log.info(
-                                f'True price spread: {true_spread} low band {app.strategy_data.bottom_band(band_ratio)} top band {app.strategy_data.top_band(band_ratio)}')
-                        if true_spread > app.strategy_data.top_band(band_ratio):
-                            app.sell_the_spread()
-                            app.update_status(
-                                StrategyStatus.SENT_ENTRY_ORDERS)
-                    else:
-                        true_spread = app.calculate_true_spread(False)
-                        if app.is_time_to_report():
-                            log.info(
-                                f'spread: {true_spread} low band {app.strategy_data.bottom_band(band_ratio)} top band {app.strategy_data.top_band(band_ratio)}')
-                        if true_spread < app.strategy_data.bottom_band(band_ratio):
-                            app.buy_the_spread()
-                            app.update_status(StrategyStatus.SENT_ENTRY_ORDERS)
-            case StrategyStatus.SENT_ENTRY_ORDERS:
-                if app.trades:
-                    if app.trades[-1].has_both_entries():
-                        app.trades[-1].create_pickle_file()
-                        app.update_status(StrategyStatus.IN_A_TRADE)
-            case StrategyStatus.IN_A_TRADE:
-                if app.has_data_to_calculate_unrealized_pnl() and app.has_data_to_calculate_spread():
-                    spread = app.calculate_spread()
-                    spread_reverted_to_mean = False
-                    if app.previous_spread:
-                        if (spread > app.strategy_data.spread_mean and app.previous_spread < app.strategy_data.spread_mean) or \
-                                (spread < app.strategy_data.spread_mean and app.previous_spread > app.strategy_data.spread_mean):
-                            spread_reverted_to_mean = True
-                    ## check for trade closing conditions ##
-                    if spread_reverted_to_mean:
-                        if not app.has_open_orders():
-                            app.close_all_positions()
-                            log.info(
-                                'Spread has reverted to the mean. Closing all positions')
-                        app.update_status(StrategyStatus.SENT_EXIT_ORDERS)
-                    ##periodic update##
-                    if app.is_time_to_report():
-                        tt = app.get_positions_table()
-                        log.info(f'\n{tt}')
-                        ##end periodic update##
-                    app.previous_spread = spread
-            case StrategyStatus.SENT_EXIT_ORDERS:
-                if app.trades[-1].is_complete():
-                    report = app.trades[-1].report()
-                    log.info(f'Trade Closed. Net PnL: {report}')
-                    app.trades[-1].delete_pickle_file()
-                    app.strategy_data.delete_pickle_file()
-                    app.update_status(StrategyStatus.ANALYZING_PAIRS)
+                subscribe_to_legs(app, list(app.strategies.values()))
+                app.update_status(StrategyStatus.WAITING_FOR_TRADES)
+        case StrategyStatus.ANALYZING_PAIRS:
+            if app.has_data_to_analyze_pairs():
+                subscribe_to_legs(app, app.find_pairs_trades())
+                app.update_status(StrategyStatus.WAITING_FOR_TRADES)
+            else:
+                for bond in app.bonds_general_info:
+                    contract = bond.to_ibkr_contract()
+                    name = bond.securityTerm
+                    contract_sub = Subscription(
+                        DataRequest.ContractInfo, contract, name)
+                    historical_sub = Subscription(
+                        DataRequest.HistoricalData, contract, name)
+                    app.requests.add(contract_sub)
+                    app.requests.add(historical_sub)
+                app.send_requests()
+    if app.status in (StrategyStatus.ANALYZING_PAIRS, StrategyStatus.WAITING_FOR_TRADES):
+        # running pairs keep trading while more are analyzed, only those whose legs or orders changed are stepped
+        for strategy in app.strategies_to_evaluate():
+            run_pair_strategy(app, strategy)
+
+
+def request_account_data(app: TradingApp):
+    app.requests.add(Subscription(
+        DataRequest.Positions, None, 'Positions', False))
+    app.requests.add(Subscription(
+        DataRequest.Account, None, 'Account', False))
+    app.requests.add(Subscription(
+        DataRequest.Orders, None, 'Account', False))
+
+
+async def cancel_tasks(tasks: set[asyncio.Task]) -> None:
+    """Cancels tasks and waits for them to end, cancelling again those whose cancellation asyncio.wait_for dropped"""
+    while tasks:
+        for task in tasks:
+            task.cancel()
+        _, tasks = await asyncio.wait(tasks, timeout=0.1)
+
+
+async def run_on_event_loop(app: TradingApp, host: str, port: int):
+    """Reader and strategy as tasks of one event loop, in place of the reader loop and the strategy thread"""
+    app.use_event_loop()
+    transport = AsyncTransport(app)
+    if not await transport.connect(host, port, 0):
+        log.error('Failed to connect to Interactive Brokers')
+        return
+    log.info('Connected to Interactive Brokers')
+    app.send_requests()
+    strategy = asyncio.create_task(strategy_task(app))
+    try:
+        await transport.run()
+    finally:
+        await cancel_tasks({strategy})
+        app.latency.dump()
+        app.execution.dump()
+        app.reporter.close()
+        if app.analysis_pool:
+            app.analysis_pool.close()
+        if app.snapshots is not None:
+            app.snapshots.close()
 
 
 def main():
@@ -148,21 +231,59 @@ def main():
         'trading', 'percent_of_account_to_use')
     rolling_window = config.getint('trading', 'rolling_window')
     bar_interval = config.getint('trading', 'bar_interval')
-    rolling_window = config.getint('trading', 'rolling_window')
+    revalidation_interval = config.getint(
+        'trading', 'revalidation_interval', fallback=20)
+    update_hedge_ratio = config.getboolean(
+        'trading', 'update_hedge_ratio', fallback=False)
+    min_pair_correlation = config.getfloat(
+        'analysis', 'min_pair_correlation', fallback=None)
+    analysis_jobs = config.getint('analysis', 'jobs', fallback=1)
+    max_pairs = config.getint('trading', 'max_pairs', fallback=1)
+    scheduler = RequestScheduler(config.getfloat('pacing', 'messages_per_second', fallback=40),
+                                 config.getint('pacing', 'max_historical_in_flight', fallback=50),
+                                 config.getint('pacing', 'historical_requests_per_10_minutes', fallback=None))
+    tick_buffer_size = config.getint('market_data', 'tick_buffer_size', fallback=65536)
+    depth_levels = config.getint('market_data', 'depth_levels', fallback=10)
+    orders = OrderManager(config.get('orders', 'archive_path', fallback=None),
+                          config.getint('orders', 'terminal_orders_kept', fallback=DEFAULT_TERMINAL_ORDERS_KEPT))
+    risk = RiskGate(RiskLimits(config.getfloat('risk', 'max_order_quantity', fallback=None),
+                               config.getfloat('risk', 'max_order_notional', fallback=None),
+                               config.getfloat('risk', 'max_instrument_notional', fallback=None),
+                               config.getfloat('risk', 'max_account_notional', fallback=None),
+                               config.getfloat('risk', 'max_orders_per_second', fallback=10),
+                               config.getint('risk', 'order_burst', fallback=max(4, 2*max_pairs)),
+                               config.getint('risk', 'max_open_legs', fallback=2*max_pairs),
+                               config.getfloat('risk', 'max_quote_age_seconds', fallback=5)))
+    execution = ExecutionEngine(ExecutionParameters(ExecutionMode(config.get('execution', 'mode', fallback='market')),
+                                                    config.getfloat('execution', 'timeout_seconds', fallback=30),
+                                                    config.getfloat('execution', 'price_increment', fallback=0.001),
+                                                    config.get('execution', 'adaptive_priority', fallback='Normal')))
+    latency = LatencyRecorder(config.getfloat('latency', 'report_seconds', fallback=DEFAULT_REPORT_SECONDS))
+    reporter = Reporter(config.get('reporting', 'json_path', fallback=None))
+    archive_directory = config.get('archive', 'directory', fallback=None)
+    archive = MarketArchive(archive_directory) if archive_directory else None
+    snapshots = SnapshotStore(config.get('snapshot', 'path', fallback=DEFAULT_SNAPSHOT_PATH))
+    security_master = SecurityMaster(config.get('treasury_direct', 'cache_path', fallback=DEFAULT_CACHE_PATH),
+                                     config.get('treasury_direct', 'base_url', fallback=DEFAULT_BASE_URL),
+                                     config.getfloat('treasury_direct', 'ttl_hours', fallback=12)*60*60,
+                                     config.getfloat('treasury_direct', 'timeout', fallback=10))
     server_name = config.get('server', 'name')
     server_type = config.get('server', 'type')
+    transport = config.get('server', 'transport', fallback='thread')
     log.info('Starting...')
     app = TradingApp(account, bar_interval, rolling_window,
-                     percent_of_account_to_use)
-    app.get_bond_market_info()
-    app.requests[app.generate_req_id()] = Subscription(
-        DataRequest.Positions, None, 'Positions', False)
-    app.requests[app.generate_req_id()] = Subscription(
-        DataRequest.Account, None, 'Account', False)
-    app.requests[app.generate_req_id()] = Subscription(
-        DataRequest.Orders, None, 'Account', False)
+                     percent_of_account_to_use, revalidation_interval, update_hedge_ratio,
+                     min_pair_correlation, analysis_jobs, scheduler, tick_buffer_size, depth_levels, archive, snapshots, max_pairs, latency, orders, risk, execution,
+                     reporter=reporter)
+    app.get_bond_market_info(security_master)
+    # a restart during a trade resumes it from the snapshot instead of starting over at INITIALIZED
+    app.restore_snapshot()
+    request_account_data(app)
     ports = read_json('ibkr-ports.json')
     log.info('Connecting to Interactive Brokers...')
+    if transport == 'asyncio':
+        asyncio.run(run_on_event_loop(app, '127.0.0.1', ports[server_name][server_type]))
+        return
     app.connect('127.0.0.1', ports[server_name][server_type], clientId=0)
     time.sleep(0.1)
     if not app.isConnected():
@@ -174,7 +295,16 @@ def main():
     strategy_thread = threading.Thread(
         target=strategy_loop, args=(app,), daemon=True)
     strategy_thread.start()
-    app.run()
+    try:
+        app.run()
+    finally:
+        app.latency.dump()
+        app.execution.dump()
+        app.reporter.close()
+        if app.analysis_pool:
+            app.analysis_pool.close()
+        if app.snapshots is not None:
+            app.snapshots.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,139 @@
+import datetime
+import math
+import os
+from typing import Optional
+import numpy as np
+from market_data.bar_store import BarStore
+
+BAR_COLUMNS = {'timestamp': np.int64, 'open': np.float64, 'high': np.float64, 'low': np.float64, 'close': np.float64,
+               'volume': np.float64, 'wap': np.float64, 'bar_count': np.int64}
+TICK_COLUMNS = {'received_ns': np.int64, 'exchange_time': np.int64, 'bid_price': np.float64, 'ask_price': np.float64,
+                'bid_size': np.float64, 'ask_size': np.float64}
+SECONDS_PER_DAY = 24*60*60
+# what subscribe_to_data asked for before the archive existed, also the longest gap that is filled
+MAX_HISTORY_DAYS = 30
+
+
+class ColumnArchive:
+    """Append only columnar table, one raw little endian file per column in a directory.
+    Rows are only ever appended, reads memory map the files so years of history are paged in on demand."""
+
+    def __init__(self, directory: str, columns: dict[str, type]):
+        self.directory = directory
+        self.columns = {name: np.dtype(dtype).newbyteorder('<') for name, dtype in columns.items()}
+        os.makedirs(directory, exist_ok=True)
+        self._trim()
+
+    def _path(self, column: str) -> str:
+        return os.path.join(self.directory, f'{column}.bin')
+
+    def _rows_in(self, column: str) -> int:
+        path = self._path(column)
+        return os.path.getsize(path)//self.columns[column].itemsize if os.path.exists(path) else 0
+
+    def _trim(self) -> None:
+        """Cuts every column to the shortest one, drops a row left half written by a crash during append"""
+        rows = len(self)
+        for column in self.columns:
+            path = self._path(column)
+            if os.path.exists(path) and os.path.getsize(path) != rows*self.columns[column].itemsize:
+                os.truncate(path, rows*self.columns[column].itemsize)
+
+    def __len__(self) -> int:
+        return min(self._rows_in(column) for column in self.columns)
+
+    def append(self, rows: dict[str, np.ndarray]) -> int:
+        """Appends rows given as one array per column, returns the number of rows written"""
+        count = len(next(iter(rows.values())))
+        if not count:
+            return 0
+        for column, dtype in self.columns.items():
+            with open(self._path(column), 'ab') as f:
+                f.write(np.ascontiguousarray(rows[column], dtype=dtype).tobytes())
+        return count
+
+    def read(self, column: str) -> np.ndarray:
+        """Read only memory map of a column, rows appended afterwards are not visible in it"""
+        rows = len(self)
+        if not rows:
+            return np.empty(0, dtype=self.columns[column])
+        return np.memmap(self._path(column), dtype=self.columns[column], mode='r', shape=(rows,))
+
+    def last(self, column: str):
+        rows = len(self)
+        if not rows:
+            return None
+        with open(self._path(column), 'rb') as f:
+            f.seek((rows - 1)*self.columns[column].itemsize)
+            return np.frombuffer(f.read(self.columns[column].itemsize), dtype=self.columns[column])[0].item()
+
+
+class MarketArchive:
+    """Bars and bid/ask ticks of every instrument kept on disk between runs, under directory/<instrument key>/.
+    The key is the IB contract id, or the CUSIP for contracts requested before IB assigned one."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._tables: dict[str, ColumnArchive] = {}
+
+    def _table(self, key, name: str, columns: dict[str, type]) -> ColumnArchive:
+        directory = os.path.join(self.directory, str(key), name)
+        if directory not in self._tables:
+            self._tables[directory] = ColumnArchive(directory, columns)
+        return self._tables[directory]
+
+    def bars(self, key, bar_size: str) -> ColumnArchive:
+        return self._table(key, f"bars_{bar_size.replace(' ', '_')}", BAR_COLUMNS)
+
+    def ticks(self, key) -> ColumnArchive:
+        return self._table(key, 'bid_ask', TICK_COLUMNS)
+
+    def last_bar_timestamp(self, key, bar_size: str) -> Optional[int]:
+        return self.bars(key, bar_size).last('timestamp')
+
+    def append_bars(self, key, bar_size: str, store: BarStore, end: Optional[int] = None) -> int:
+        """Writes the bars of store[:end] newer than the last archived bar. Only finished bars may be passed,
+        an archived bar is never rewritten."""
+        table = self.bars(key, bar_size)
+        end = len(store) if end is None else end
+        last = table.last('timestamp')
+        start = 0 if last is None else int(np.searchsorted(store.timestamps[:end], last, side='right'))
+        return table.append({'timestamp': store.timestamps[start:end], 'open': store.opens[start:end],
+                             'high': store.highs[start:end], 'low': store.lows[start:end],
+                             'close': store.closes[start:end], 'volume': store.volumes[start:end],
+                             'wap': store.waps[start:end], 'bar_count': store.bar_counts[start:end]})
+
+    def bar_store(self, key, bar_size: str, start_ns: Optional[int] = None, in_memory: bool = False) -> BarStore:
+        """Archived bars from start_ns on as a BarStore. By default its columns are the memory maps themselves,
+        for backtests over long histories, in_memory copies them for a store that live bars are appended to."""
+        table = self.bars(key, bar_size)
+        timestamps = table.read('timestamp')
+        start = 0 if start_ns is None else int(np.searchsorted(timestamps, start_ns))
+        columns = {column: table.read(column)[start:] for column in BAR_COLUMNS}
+        if in_memory:
+            columns = {column: np.array(values) for column, values in columns.items()}
+        return BarStore.from_columns(columns)
+
+    def append_ticks(self, key, rows: dict[str, np.ndarray]) -> int:
+        return self.ticks(key).append(rows)
+
+
+def history_duration(last_timestamp: Optional[int], bar_seconds: int, now: Optional[datetime.datetime] = None) -> str:
+    """IB duration string covering the gap since the last archived bar plus one bar of overlap,
+    capped at the month the strategy always looked at"""
+    if last_timestamp is None:
+        return '1 M'
+    now = datetime.datetime.now() if now is None else now
+    now_ns = int(np.datetime64(now, 'ns').astype(np.int64))
+    seconds = max(0, (now_ns - last_timestamp)//1_000_000_000) + bar_seconds
+    if seconds >= MAX_HISTORY_DAYS*SECONDS_PER_DAY:
+        return '1 M'
+    if seconds <= SECONDS_PER_DAY:
+        return f'{seconds} S'
+    return f'{math.ceil(seconds/SECONDS_PER_DAY)} D'
+
+
+def history_start(now: Optional[datetime.datetime] = None) -> int:
+    """Timestamp of the oldest bar a one month request returns, archived bars before it are not loaded at startup"""
+    now = datetime.datetime.now() if now is None else now
+    return int(np.datetime64(now - datetime.timedelta(days=MAX_HISTORY_DAYS), 'ns').astype(np.int64))
@@ -0,0 +1,143 @@
+from datetime import datetime
+from functools import reduce
+from typing import Optional
+import numpy as np
+from ibapi.common import BarData
+
+INITIAL_CAPACITY = 1024
+
+
+def bar_timestamp_ns(date: str) -> int:
+    """Converts the IB bar date string (yyyymmdd hh:mm:ss) to epoch nanoseconds"""
+    timestamp = datetime.strptime(date, '%Y%m%d %H:%M:%S')
+    return int(np.datetime64(timestamp, 'ns').astype(np.int64))
+
+
+class BarStore:
+    """Columnar storage for the bars of one instrument, arrays grow by doubling so appends are amortized O(1)"""
+
+    def __init__(self, capacity: int = INITIAL_CAPACITY):
+        self.size = 0
+        self._timestamp = np.empty(capacity, dtype=np.int64)
+        self._open = np.empty(capacity)
+        self._high = np.empty(capacity)
+        self._low = np.empty(capacity)
+        self._close = np.empty(capacity)
+        self._volume = np.empty(capacity)
+        self._wap = np.empty(capacity)
+        self._bar_count = np.empty(capacity, dtype=np.int64)
+
+    @classmethod
+    def from_columns(cls, columns: dict[str, np.ndarray]) -> 'BarStore':
+        """Store over existing column arrays keyed by column name without the underscore, the arrays are not copied
+        until an append grows the store"""
+        store = cls(0)
+        for column in store._columns():
+            setattr(store, column, columns[column[1:]])
+        store.size = len(store._timestamp)
+        return store
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _columns(self) -> list[str]:
+        return ['_timestamp', '_open', '_high', '_low', '_close', '_volume', '_wap', '_bar_count']
+
+    def _grow(self) -> None:
+        capacity = max(INITIAL_CAPACITY, 2*len(self._timestamp))
+        for column in self._columns():
+            old = getattr(self, column)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, column, new)
+
+    def append(self, timestamp: int, open: float, high: float, low: float, close: float, volume: float, wap: float, bar_count: int) -> None:
+        if self.size == len(self._timestamp):
+            self._grow()
+        i = self.size
+        self._timestamp[i] = timestamp
+        self._open[i] = open
+        self._high[i] = high
+        self._low[i] = low
+        self._close[i] = close
+        self._volume[i] = volume
+        self._wap[i] = wap
+        self._bar_count[i] = bar_count
+        self.size += 1
+
+    def append_bar_data(self, bar_data: BarData) -> int:
+        """Appends an IB bar and returns its timestamp in nanoseconds"""
+        timestamp = bar_timestamp_ns(bar_data.date)
+        self.append(timestamp, bar_data.open, bar_data.high, bar_data.low, bar_data.close,
+                    float(bar_data.volume), float(bar_data.wap), bar_data.barCount)
+        return timestamp
+
+    def replace_last_bar_data(self, bar_data: BarData) -> None:
+        """Overwrites the newest bar with a later update of the same bar"""
+        self.size -= 1
+        self.append_bar_data(bar_data)
+
+    def last_timestamp(self) -> Optional[int]:
+        return int(self._timestamp[self.size - 1]) if self.size else None
+
+    def sort(self) -> None:
+        """Sorts by timestamp, skipped when bars already arrived in order which is the usual case"""
+        timestamps = self.timestamps
+        if self.size < 2 or np.all(timestamps[1:] >= timestamps[:-1]):
+            return
+        order = np.argsort(timestamps, kind='stable')
+        for column in self._columns():
+            data = getattr(self, column)
+            data[:self.size] = data[:self.size][order]
+
+    # the properties below are views, they are invalidated by the next append that grows the store
+    @property
+    def timestamps(self) -> np.ndarray:
+        return self._timestamp[:self.size]
+
+    @property
+    def opens(self) -> np.ndarray:
+        return self._open[:self.size]
+
+    @property
+    def highs(self) -> np.ndarray:
+        return self._high[:self.size]
+
+    @property
+    def lows(self) -> np.ndarray:
+        return self._low[:self.size]
+
+    @property
+    def closes(self) -> np.ndarray:
+        return self._close[:self.size]
+
+    @property
+    def volumes(self) -> np.ndarray:
+        return self._volume[:self.size]
+
+    @property
+    def waps(self) -> np.ndarray:
+        return self._wap[:self.size]
+
+    @property
+    def bar_counts(self) -> np.ndarray:
+        return self._bar_count[:self.size]
+
+    def join_closes(self, other: 'BarStore') -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Inner join on timestamp, returns the shared timestamps and both close series"""
+        timestamps, mine, theirs = np.intersect1d(
+            self.timestamps, other.timestamps, assume_unique=True, return_indices=True)
+        return timestamps, self.closes[mine], other.closes[theirs]
+
+
+def align_stores(stores: list[BarStore]) -> tuple[np.ndarray, np.ndarray]:
+    """Builds a (instruments x bars) close price matrix over the timestamps shared by every store"""
+    if not stores:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0))
+    timestamps = reduce(lambda left, right: np.intersect1d(left, right, assume_unique=True),
+                        [store.timestamps for store in stores])
+    closes = np.empty((len(stores), len(timestamps)))
+    for row, store in enumerate(stores):
+        _, indices, _ = np.intersect1d(store.timestamps, timestamps, assume_unique=True, return_indices=True)
+        closes[row] = store.closes[indices]
+    return timestamps, closes
@@ -0,0 +1,51 @@
+import datetime as dt
+from typing import Optional
+from ibapi.contract import Contract, ContractDetails
+from market_data.ust_bonds import USTreasurySecurity
+
+
+class InstrumentIndex:
+    """Securities by IB conId, CUSIP, IB symbol and maturity date so callbacks resolve their instrument in O(1).
+    Securities are added from Treasury Direct, their conId and symbol once IB returned the contract details."""
+
+    def __init__(self):
+        self.by_con_id: dict[int, USTreasurySecurity] = {}
+        self.by_cusip: dict[str, USTreasurySecurity] = {}
+        self.by_symbol: dict[str, USTreasurySecurity] = {}
+        self.by_maturity: dict[dt.date, list[USTreasurySecurity]] = {}
+        self._contract_dates: dict[str, Optional[dt.date]] = {}
+
+    def add_security(self, security: USTreasurySecurity) -> None:
+        self.by_cusip[security.cusip] = security
+        # the contract requests use the CUSIP as the symbol
+        self.by_symbol.setdefault(security.cusip, security)
+        if security.maturityDate is not None:
+            same_maturity = self.by_maturity.setdefault(security.maturityDate, [])
+            if all(other.cusip != security.cusip for other in same_maturity):
+                same_maturity.append(security)
+        if security.contract_details is not None:
+            self.add_contract_details(security, security.contract_details)
+
+    def add_contract_details(self, security: USTreasurySecurity, details: ContractDetails) -> None:
+        security.contract_details = details
+        self.by_con_id[details.contract.conId] = security
+        if details.contract.symbol:
+            self.by_symbol[details.contract.symbol] = security
+
+    def contract_date(self, value: str) -> Optional[dt.date]:
+        """Parses an IB yyyymmdd date once, later calls with the same string are a dict lookup"""
+        if value not in self._contract_dates:
+            try:
+                self._contract_dates[value] = dt.datetime.strptime(value[:8], '%Y%m%d').date()
+            except ValueError:
+                self._contract_dates[value] = None
+        return self._contract_dates[value]
+
+    def find(self, contract: Contract) -> Optional[USTreasurySecurity]:
+        """The security of an IB contract by conId, then symbol, then maturity when only one security matures that day"""
+        security = self.by_con_id.get(contract.conId) or self.by_symbol.get(contract.symbol)
+        if security is None and contract.lastTradeDateOrContractMonth:
+            same_maturity = self.by_maturity.get(self.contract_date(contract.lastTradeDateOrContractMonth), [])
+            if len(same_maturity) == 1:
+                security = same_maturity[0]
+        return security
@@ -1,16 +1,40 @@
-from dataclasses import dataclass
-from typing import Optional
-from datetime import datetime
+import time
+from typing import NamedTuple, Optional
+
+NANOSECONDS_PER_SECOND = 1_000_000_000
+
+
+class QuoteSnapshot(NamedTuple):
+    """Immutable copy of a Quote taken between two writes"""
+    bid_price: Optional[float]
+    ask_price: Optional[float]
+    bid_size: Optional[float]
+    ask_size: Optional[float]
+    mid_price: Optional[float]
+    last_update_ns: Optional[int]
+
+    def is_valid(self, acceptable_delay: float, now_ns: Optional[int] = None) -> bool:
+        """Checks that all the fields are present and it was updated within the last acceptable_delay seconds"""
+        if not (self.bid_price and self.ask_price and self.bid_size and self.ask_size and self.mid_price):
+            return False
+        now_ns = time.monotonic_ns() if now_ns is None else now_ns
+        return now_ns - self.last_update_ns <= acceptable_delay*NANOSECONDS_PER_SECOND
 
 
-@dataclass
 class Quote:
-    bid_price: Optional[float] = None
-    ask_price: Optional[float] = None
-    bid_size: Optional[int] = None
-    ask_size: Optional[int] = None
-    mid_price: Optional[float] = None
-    last_update_time: Optional[float] = None
+    """Top of book of one instrument, written by the IB reader thread only.
+    Every write is bracketed by two increments of sequence, so it is odd while a write is in progress.
+    Readers take snapshot() and retry until they saw the same even sequence before and after copying the fields."""
+    __slots__ = ('bid_price', 'ask_price', 'bid_size', 'ask_size', 'mid_price', 'last_update_ns', 'sequence')
+
+    def __init__(self):
+        self.bid_price: Optional[float] = None
+        self.ask_price: Optional[float] = None
+        self.bid_size: Optional[float] = None
+        self.ask_size: Optional[float] = None
+        self.mid_price: Optional[float] = None
+        self.last_update_ns: Optional[int] = None
+        self.sequence = 0
 
     @classmethod
     def from_tick(cls, tickType: int, value: float) -> 'Quote':
@@ -18,8 +42,14 @@ class Quote:
         q.update_quote(tickType, value)
         return q
 
+    @classmethod
+    def from_bid_ask(cls, bid_price: float, ask_price: float, bid_size: float, ask_size: float) -> 'Quote':
+        q = cls()
+        q.update_bid_ask(bid_price, ask_price, bid_size, ask_size)
+        return q
+
     def update_quote(self, tickType: int, value: float):
-        self.last_update_time = datetime.now().timestamp()
+        self.sequence += 1
         match tickType:
             case 0:
                 self.bid_size = value
@@ -29,12 +59,48 @@ class Quote:
                 self.ask_price = value
             case 3:
                 self.ask_size = value
-        if self.ask_price != None and self.bid_price != None:
+        if self.ask_price is not None and self.bid_price is not None:
             self.mid_price = (self.ask_price + self.bid_price)/2
+        self.last_update_ns = time.monotonic_ns()
+        self.sequence += 1
+
+    def update_bid_ask(self, bid_price: float, ask_price: float, bid_size: float, ask_size: float):
+        """Writes a whole tick by tick bid/ask update as one change"""
+        self.sequence += 1
+        self.bid_price = bid_price
+        self.ask_price = ask_price
+        self.bid_size = bid_size
+        self.ask_size = ask_size
+        self.mid_price = round((bid_price + ask_price)/2, 3)
+        self.last_update_ns = time.monotonic_ns()
+        self.sequence += 1
+
+    def _fields(self) -> QuoteSnapshot:
+        return QuoteSnapshot(self.bid_price, self.ask_price, self.bid_size, self.ask_size, self.mid_price, self.last_update_ns)
+
+    def snapshot(self) -> QuoteSnapshot:
+        while True:
+            sequence = self.sequence
+            if sequence & 1:
+                # a write is in progress on the IB reader thread, let it finish
+                time.sleep(0)
+                continue
+            fields = self._fields()
+            if self.sequence == sequence:
+                return fields
 
     def is_valid(self, acceptable_delay: float) -> bool:
-        """Checks that all the fields are present and it was updates within the last acceptable_delay seconds"""
-        all_data = self.bid_price and self.ask_price and self.bid_size and self.ask_size and self.mid_price
-        fresh = (datetime.now().timestamp() -
-                 self.last_update_time) <= acceptable_delay
-        return all_data and fresh
+        """Checks that all the fields are present and it was updated within the last acceptable_delay seconds"""
+        return self.snapshot().is_valid(acceptable_delay)
+
+
+def pair_snapshot(first: Quote, second: Quote) -> tuple[QuoteSnapshot, QuoteSnapshot]:
+    """Snapshots of two quotes such that neither changed while the other was copied"""
+    while True:
+        first_sequence, second_sequence = first.sequence, second.sequence
+        if (first_sequence | second_sequence) & 1:
+            time.sleep(0)
+            continue
+        fields = first._fields(), second._fields()
+        if first.sequence == first_sequence and second.sequence == second_sequence:
+            return fields
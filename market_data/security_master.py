@@ -0,0 +1,128 @@
+import datetime as dt
+import json
+import os
+import tempfile
+import threading
+from typing import Optional
+import requests
+from log_config import log
+
+DEFAULT_BASE_URL = 'http://www.treasurydirect.gov/TA_WS'
+DEFAULT_CACHE_PATH = 'security_master.json'
+DEFAULT_TTL_SECONDS = 12*60*60
+DEFAULT_TIMEOUT_SECONDS = 10.0
+# auctions older than this are neither fetched nor kept
+HISTORY_DAYS = 365
+
+
+def auction_date(record: dict) -> str:
+    """yyyy-mm-dd of the auction, Treasury Direct dates are yyyy-mm-ddT00:00:00 so the prefix sorts as a date"""
+    return str(record.get('auctionDate') or '')[:10]
+
+
+class SecurityMaster:
+    """Local cache of Treasury Direct auction records keyed by CUSIP, the latest auction of a CUSIP wins.
+    Records are kept as the raw JSON and only decoded by the caller for the securities it selects.
+    refresh() fetches only the days since the previous fetch and revalidates with the ETag and Last-Modified
+    of that query, failures keep the cached records."""
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, base_url: str = DEFAULT_BASE_URL,
+                 ttl_seconds: float = DEFAULT_TTL_SECONDS, timeout: float = DEFAULT_TIMEOUT_SECONDS):
+        self.path = path
+        self.base_url = base_url.rstrip('/')
+        self.ttl_seconds = ttl_seconds
+        self.timeout = timeout
+        self.records: dict[str, dict] = {}
+        self.fetched_at: Optional[float] = None
+        self.validators: dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log.error(f'Ignoring unreadable security master cache {self.path}: {e}')
+            return
+        self.records = data.get('records', {})
+        self.fetched_at = data.get('fetched_at')
+        self.validators = data.get('validators', {})
+
+    def _save(self) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        handle, temporary = tempfile.mkstemp(prefix='.security_master_', dir=directory)
+        with os.fdopen(handle, 'w') as f:
+            json.dump({'records': self.records, 'fetched_at': self.fetched_at, 'validators': self.validators}, f)
+        os.replace(temporary, self.path)
+
+    def is_fresh(self, now: Optional[float] = None) -> bool:
+        now = dt.datetime.now().timestamp() if now is None else now
+        return self.fetched_at is not None and now - self.fetched_at < self.ttl_seconds
+
+    def days_to_fetch(self, now: Optional[float] = None) -> int:
+        """Days of auctions missing from the cache, one day of overlap catches records published late"""
+        now = dt.datetime.now().timestamp() if now is None else now
+        if self.fetched_at is None or not self.records:
+            return HISTORY_DAYS
+        return min(HISTORY_DAYS, int((now - self.fetched_at)//(24*60*60)) + 2)
+
+    def refresh(self) -> bool:
+        """Brings the cache up to date unless it is within its TTL, returns False when Treasury Direct could not be reached"""
+        with self._lock:
+            if self.is_fresh():
+                return True
+            days = self.days_to_fetch()
+            params = {'format': 'json', 'days': str(days)}
+            headers = {}
+            if self.validators.get('days') == days:
+                if self.validators.get('etag'):
+                    headers['If-None-Match'] = self.validators['etag']
+                if self.validators.get('last_modified'):
+                    headers['If-Modified-Since'] = self.validators['last_modified']
+            try:
+                response = requests.get(f'{self.base_url}/securities/auctioned', params=params, headers=headers, timeout=self.timeout)
+            except requests.RequestException as e:
+                log.error(f'Treasury Direct unreachable, using {len(self.records)} cached securities: {e}')
+                return False
+            if response.status_code == 304:
+                log.info('Treasury Direct securities unchanged since the last fetch')
+            elif response.status_code == 200:
+                try:
+                    self.merge(response.json())
+                except ValueError as e:
+                    log.error(f'Invalid Treasury Direct response, using {len(self.records)} cached securities: {e}')
+                    return False
+                self.validators = {'days': days, 'etag': response.headers.get('ETag'),
+                                   'last_modified': response.headers.get('Last-Modified')}
+            else:
+                log.error(f'Treasury Direct returned {response.status_code}, using {len(self.records)} cached securities')
+                return False
+            self.fetched_at = dt.datetime.now().timestamp()
+            self._save()
+            return True
+
+    def merge(self, records: list[dict]) -> None:
+        """Adds fetched records, a CUSIP keeps its latest auction (reopenings), auctions older than HISTORY_DAYS are dropped"""
+        for record in records:
+            cusip = record.get('cusip')
+            if cusip and (cusip not in self.records or auction_date(record) >= auction_date(self.records[cusip])):
+                self.records[cusip] = record
+        oldest = str(dt.date.today() - dt.timedelta(days=HISTORY_DAYS))
+        self.records = {cusip: record for cusip, record in self.records.items() if auction_date(record) >= oldest}
+
+    def refresh_in_background(self) -> threading.Thread:
+        thread = threading.Thread(target=self.refresh, name='SecurityMasterRefresh', daemon=True)
+        thread.start()
+        return thread
+
+    def securities(self) -> list[dict]:
+        """Raw records, refreshed first only when the cache is empty, otherwise a stale cache is used as is
+        and refreshed in the background for the next start"""
+        if not self.records:
+            self.refresh()
+        elif not self.is_fresh():
+            self.refresh_in_background()
+        return list(self.records.values())
@@ -0,0 +1,153 @@
+import time
+from typing import Optional
+import numpy as np
+
+DEFAULT_TICK_CAPACITY = 65536
+DEFAULT_DEPTH_CAPACITY = 65536
+DEFAULT_DEPTH_LEVELS = 10
+# updateMktDepth operation and side codes
+DEPTH_INSERT, DEPTH_UPDATE, DEPTH_DELETE = 0, 1, 2
+DEPTH_ASK, DEPTH_BID = 0, 1
+
+
+class RingBuffer:
+    """Fixed size columnar buffer written by one thread, the oldest rows are overwritten once it is full.
+    written counts every row ever appended, readers use it to detect rows overwritten while they copied."""
+
+    def __init__(self, capacity: int, columns: dict[str, np.dtype]):
+        self.capacity = capacity
+        self.written = 0
+        self.columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in columns.items()}
+
+    def __len__(self) -> int:
+        return min(self.written, self.capacity)
+
+    def _append(self, *values) -> None:
+        slot = self.written % self.capacity
+        for column, value in zip(self.columns.values(), values):
+            column[slot] = value
+        self.written += 1
+
+    def _copy(self, start: int, end: int) -> Optional[dict[str, np.ndarray]]:
+        indices = np.arange(start, end) % self.capacity
+        rows = {name: column[indices] for name, column in self.columns.items()}
+        # the slot after end may be half written, it only matters when it wrapped onto the first copied row
+        return rows if self.written + 1 - start <= self.capacity else None
+
+    def last(self, n: Optional[int] = None) -> dict[str, np.ndarray]:
+        """Copies of the newest n rows, oldest first"""
+        while True:
+            end = self.written
+            # the slot about to be written is never returned, so at most capacity - 1 rows are readable
+            count = min(self.capacity - 1, end) if n is None else min(n, self.capacity - 1, end)
+            rows = self._copy(end - count, end)
+            if rows is not None:
+                return rows
+
+    def since(self, position: int) -> tuple[dict[str, np.ndarray], int]:
+        """Rows appended after position (a previous value of written), and the position to pass next time.
+        Rows that were already overwritten are skipped."""
+        while True:
+            end = self.written
+            rows = self._copy(max(position, end - self.capacity + 1), end)
+            if rows is not None:
+                return rows, end
+
+
+class BidAskTicks(RingBuffer):
+    def __init__(self, capacity: int = DEFAULT_TICK_CAPACITY):
+        super().__init__(capacity, {'received_ns': np.int64, 'exchange_time': np.int64, 'bid_price': np.float64,
+                                    'ask_price': np.float64, 'bid_size': np.float64, 'ask_size': np.float64})
+
+    def append(self, exchange_time: int, bid_price: float, ask_price: float, bid_size: float, ask_size: float,
+               received_ns: Optional[int] = None) -> None:
+        self._append(time.monotonic_ns() if received_ns is None else received_ns, exchange_time, bid_price, ask_price, bid_size, ask_size)
+
+
+class DepthUpdates(RingBuffer):
+    def __init__(self, capacity: int = DEFAULT_DEPTH_CAPACITY):
+        super().__init__(capacity, {'received_ns': np.int64, 'position': np.int16, 'operation': np.int8, 'side': np.int8,
+                                    'price': np.float64, 'size': np.float64})
+
+    def append(self, position: int, operation: int, side: int, price: float, size: float, received_ns: Optional[int] = None) -> None:
+        self._append(time.monotonic_ns() if received_ns is None else received_ns, position, operation, side, price, size)
+
+
+class DepthBook:
+    """Order book levels maintained from updateMktDepth insert/update/delete operations"""
+
+    def __init__(self, levels: int = DEFAULT_DEPTH_LEVELS):
+        self.levels = levels
+        # row 0 holds the asks, row 1 the bids, indexed by the IB side code
+        self.prices = np.full((2, levels), np.nan)
+        self.sizes = np.zeros((2, levels))
+        self.depth = [0, 0]
+
+    def update(self, position: int, operation: int, side: int, price: float, size: float) -> None:
+        if position >= self.levels:
+            return
+        prices, sizes = self.prices[side], self.sizes[side]
+        if operation == DEPTH_INSERT:
+            prices[position + 1:] = prices[position:-1].copy()
+            sizes[position + 1:] = sizes[position:-1].copy()
+            prices[position], sizes[position] = price, size
+            self.depth[side] = min(self.depth[side] + 1, self.levels)
+        elif operation == DEPTH_UPDATE:
+            prices[position], sizes[position] = price, size
+            self.depth[side] = max(self.depth[side], position + 1)
+        elif operation == DEPTH_DELETE:
+            prices[position:-1] = prices[position + 1:].copy()
+            sizes[position:-1] = sizes[position + 1:].copy()
+            prices[-1], sizes[-1] = np.nan, 0.0
+            self.depth[side] = max(self.depth[side] - 1, 0)
+
+    def bids(self) -> tuple[np.ndarray, np.ndarray]:
+        return self.prices[DEPTH_BID, :self.depth[DEPTH_BID]].copy(), self.sizes[DEPTH_BID, :self.depth[DEPTH_BID]].copy()
+
+    def asks(self) -> tuple[np.ndarray, np.ndarray]:
+        return self.prices[DEPTH_ASK, :self.depth[DEPTH_ASK]].copy(), self.sizes[DEPTH_ASK, :self.depth[DEPTH_ASK]].copy()
+
+
+class InstrumentTicks:
+    """Everything recorded for one instrument: bid/ask ticks, raw depth updates and the book they build.
+    All storage is allocated up front, bursts overwrite the oldest rows instead of growing memory."""
+
+    def __init__(self, tick_capacity: int = DEFAULT_TICK_CAPACITY, depth_capacity: int = DEFAULT_DEPTH_CAPACITY,
+                 depth_levels: int = DEFAULT_DEPTH_LEVELS):
+        self.bid_ask = BidAskTicks(tick_capacity)
+        self.depth_updates = DepthUpdates(depth_capacity)
+        self.book = DepthBook(depth_levels)
+
+    def on_depth(self, position: int, operation: int, side: int, price: float, size: float) -> None:
+        self.depth_updates.append(position, operation, side, price, size)
+        self.book.update(position, operation, side, price, size)
+
+
+def microprice(bid_price: np.ndarray, ask_price: np.ndarray, bid_size: np.ndarray, ask_size: np.ndarray) -> np.ndarray:
+    """Size weighted mid, leans towards the side with less size since that side is more likely to be taken"""
+    total = bid_size + ask_size
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(total > 0, (bid_price*ask_size + ask_price*bid_size)/total, (bid_price + ask_price)/2)
+
+
+def spread_volatility(ticks: BidAskTicks, n: Optional[int] = None) -> Optional[float]:
+    """Standard deviation of the quoted bid/ask spread over the newest n ticks"""
+    rows = ticks.last(n)
+    if len(rows['bid_price']) < 2:
+        return None
+    return float(np.std(rows['ask_price'] - rows['bid_price'], ddof=1))
+
+
+def mid_volatility(ticks: BidAskTicks, n: Optional[int] = None) -> Optional[float]:
+    """Standard deviation of tick to tick mid price changes over the newest n ticks"""
+    rows = ticks.last(n)
+    if len(rows['bid_price']) < 3:
+        return None
+    return float(np.std(np.diff((rows['bid_price'] + rows['ask_price'])/2), ddof=1))
+
+
+def latest_microprice(ticks: BidAskTicks) -> Optional[float]:
+    rows = ticks.last(1)
+    if not len(rows['bid_price']):
+        return None
+    return float(microprice(rows['bid_price'], rows['ask_price'], rows['bid_size'], rows['ask_size'])[0])
@@ -0,0 +1,231 @@
+import datetime
+import math
+import threading
+import time
+from dataclasses import dataclass
+from enum import Enum
+from typing import Optional
+from market_data.quotes import Quote, QuoteSnapshot
+from risk_gate import notional_per_unit
+from strategy.orders import StrategyOrder, create_adaptive_order, create_limit_order, create_market_order
+from log_config import log
+from others import rows_to_table
+
+# label of the orders sent at market to complete a pair once its worked leg filled, or after an exit timed out
+HEDGE = 'hedge'
+# IB statuses in which a working order can be modified
+MODIFIABLE_STATUSES = {'Submitted', 'PreSubmitted'}
+
+
+class ExecutionMode(Enum):
+    # every leg at market, crossing the bid/ask
+    MARKET = 'market'
+    # the worked leg joins the near side of the book: BUY at the bid, SELL at the ask
+    LIMIT = 'limit'
+    # the worked leg rests at the mid, pegged by repricing on every quote rather than with IB's PEG MID type
+    # which is only routed to some venues
+    MIDPOINT_PEG = 'midpoint_peg'
+    # the worked leg is a market order handed to IB's Adaptive algo
+    ADAPTIVE = 'adaptive'
+
+    def __str__(self):
+        return self.value
+
+
+@dataclass
+class ExecutionParameters:
+    mode: ExecutionMode = ExecutionMode.MARKET
+    # a worked leg still open after this is cancelled, an entry is then given up and an exit completed at market
+    timeout_seconds: float = 30.0
+    # limit prices are rounded to this, away from the other side of the book
+    price_increment: float = 0.001
+    adaptive_priority: str = 'Normal'
+
+
+@dataclass
+class LegExecution:
+    """One leg of an entry or exit worked with a limit, pegged or adaptive order. The other legs wait in hedges
+    and go out at market once it fills. Kept on its PairStrategy so that a restart resumes it from the snapshot."""
+    order_id: int
+    mode: ExecutionMode
+    entry: bool
+    # wall clock time after which the order is cancelled
+    deadline: float
+    hedges: list[StrategyOrder]
+    reprices: int = 0
+    cancel_sent: bool = False
+    # quantity of the worked leg that never filled, an exit sends it at market with the hedges
+    remaining: float = 0.0
+    # the rest of the worked leg of a timed out exit is among the hedges, at market
+    replaced: bool = False
+    # set by the IB reader thread, acted on by the strategy thread
+    filled: bool = False
+    cancelled: bool = False
+
+    def is_done(self) -> bool:
+        """The legs waiting on it can go out"""
+        return self.filled or (self.cancelled and not self.entry)
+
+
+@dataclass
+class FillStatistics:
+    """Orders of one execution label. Slippage is the fill price against the arrival mid in price points,
+    positive when the order paid more than the mid, and the cost is that slippage in account currency."""
+    sent: int = 0
+    filled: int = 0
+    timed_out: int = 0
+    reprices: int = 0
+    slippage: float = 0.0
+    slippage_cost: float = 0.0
+    seconds_to_fill: float = 0.0
+
+    def row(self) -> dict:
+        return {'sent': self.sent, 'filled': self.filled, 'fill_rate': round(self.filled/self.sent, 3) if self.sent else None,
+                'timed_out': self.timed_out, 'reprices': self.reprices,
+                'mean_slippage': round(self.slippage/self.filled, 5) if self.filled else None,
+                'slippage_cost': round(self.slippage_cost, 2),
+                'mean_seconds_to_fill': round(self.seconds_to_fill/self.filled, 3) if self.filled else None}
+
+
+def quoted_spread(quote: Optional[Quote]) -> float:
+    """Bid/ask spread relative to the mid, infinite when the quote is incomplete"""
+    snapshot = quote.snapshot() if quote is not None else None
+    if snapshot is None or not snapshot.bid_price or not snapshot.ask_price or not snapshot.mid_price:
+        return math.inf
+    return (snapshot.ask_price - snapshot.bid_price)/snapshot.mid_price
+
+
+class ExecutionEngine:
+    """Turns the market orders of an entry or exit into the orders of the execution mode and keeps the fill rate
+    and slippage of every order by execution label, so that modes can be compared on the same replay.
+    The leg with the widest quote is worked, the tighter legs hedge it at market once it fills."""
+
+    def __init__(self, parameters: Optional[ExecutionParameters] = None):
+        self.parameters = parameters or ExecutionParameters()
+        self.statistics: dict[str, FillStatistics] = {}
+        # orders are sent from the strategy thread and filled on the IB reader thread
+        self._lock = threading.Lock()
+
+    def is_market(self) -> bool:
+        return self.parameters.mode == ExecutionMode.MARKET
+
+    def worked_leg(self, legs: list[StrategyOrder], quotes: dict[int, Quote]) -> StrategyOrder:
+        """The least liquid leg: waiting on it costs the most, and hedging it at market costs the least"""
+        return max(legs, key=lambda leg: quoted_spread(quotes.get(leg.contract.conId)))
+
+    def limit_price(self, mode: ExecutionMode, action: str, snapshot: Optional[QuoteSnapshot]) -> Optional[float]:
+        if snapshot is None or not snapshot.bid_price or not snapshot.ask_price:
+            return None
+        increment = self.parameters.price_increment
+        if mode == ExecutionMode.MIDPOINT_PEG:
+            price = (snapshot.bid_price + snapshot.ask_price)/2
+        else:
+            price = snapshot.bid_price if action == 'BUY' else snapshot.ask_price
+        # round away from the other side, a pegged BUY never crosses the ask
+        units = math.floor(price/increment + 1e-9) if action == 'BUY' else math.ceil(price/increment - 1e-9)
+        return round(units*increment, 10)
+
+    def work(self, leg: StrategyOrder, snapshot: Optional[QuoteSnapshot]) -> bool:
+        """Replaces the market order of a leg with the order of the execution mode, False when it has no price to rest at"""
+        order = leg.order
+        if self.parameters.mode == ExecutionMode.ADAPTIVE:
+            leg.order = create_adaptive_order(order.action, order.totalQuantity, order.account, self.parameters.adaptive_priority)
+        else:
+            limit_price = self.limit_price(self.parameters.mode, order.action, snapshot)
+            if limit_price is None:
+                return False
+            leg.order = create_limit_order(order.action, order.totalQuantity, order.account, limit_price)
+        leg.execution = str(self.parameters.mode)
+        return True
+
+    def start(self, order_id: int, entry: bool, hedges: list[StrategyOrder]) -> LegExecution:
+        for hedge in hedges:
+            hedge.execution = HEDGE
+        deadline = datetime.datetime.now().timestamp() + self.parameters.timeout_seconds
+        return LegExecution(order_id, self.parameters.mode, entry, deadline, hedges)
+
+    def reprice_target(self, execution: LegExecution, leg: StrategyOrder, snapshot: Optional[QuoteSnapshot]) -> Optional[float]:
+        """New limit price of a resting leg whose quote moved, None when the order can stay as it is"""
+        if execution.mode not in (ExecutionMode.LIMIT, ExecutionMode.MIDPOINT_PEG) or leg.status not in MODIFIABLE_STATUSES:
+            return None
+        limit_price = self.limit_price(execution.mode, leg.order.action, snapshot)
+        if limit_price is None or abs(limit_price - leg.order.lmtPrice) < self.parameters.price_increment/2:
+            return None
+        return limit_price
+
+    def on_reprice(self, execution: LegExecution, leg: StrategyOrder, limit_price: float) -> None:
+        leg.order.lmtPrice = limit_price
+        execution.reprices += 1
+        with self._lock:
+            self.label(leg.execution).reprices += 1
+
+    def is_expired(self, execution: LegExecution) -> bool:
+        return not execution.cancel_sent and datetime.datetime.now().timestamp() > execution.deadline
+
+    def on_cancelled(self, execution: LegExecution, quantity: float, filled: float) -> None:
+        """The worked leg ended before filling completely. The hedges of an entry that partly filled are cut to the
+        filled share, so the pair goes on smaller, an exit keeps the rest of the leg for completion_orders."""
+        execution.remaining = quantity - filled
+        if filled and execution.entry:
+            for hedge in execution.hedges:
+                hedge.order.totalQuantity = max(1, round(float(hedge.order.totalQuantity)*filled/quantity))
+        # set before cancelled, manage_executions gives up an entry it sees cancelled and not filled
+        execution.filled = filled > 0
+        execution.cancelled = True
+
+    def completion_orders(self, execution: LegExecution, leg: StrategyOrder) -> list[StrategyOrder]:
+        """Orders that complete the pair once the worked leg is done: the hedges, and what did not fill of the worked
+        leg at market when an exit timed out"""
+        if execution.remaining and not execution.entry and not execution.replaced:
+            replacement = StrategyOrder.create(create_market_order(leg.order.action, round(execution.remaining), leg.order.account),
+                                               leg.contract, leg.tick_ns)
+            replacement.execution = HEDGE
+            replacement.arrival_price = leg.arrival_price
+            execution.hedges.insert(0, replacement)
+            execution.replaced = True
+        # they react to the fill or the timeout rather than to a tick
+        for order in execution.hedges:
+            order.tick_ns = None
+            order.created_ns = time.monotonic_ns()
+        return list(execution.hedges)
+
+    def retry_order(self, leg: StrategyOrder) -> StrategyOrder:
+        """Unsent copy of a leg the risk gate stopped"""
+        retry = StrategyOrder.create(leg.order, leg.contract, leg.tick_ns)
+        retry.execution = leg.execution
+        retry.arrival_price = leg.arrival_price
+        return retry
+
+    def label(self, name: str) -> FillStatistics:
+        statistics = self.statistics.get(name)
+        if statistics is None:
+            statistics = self.statistics[name] = FillStatistics()
+        return statistics
+
+    def on_sent(self, leg: StrategyOrder) -> None:
+        with self._lock:
+            self.label(leg.execution).sent += 1
+
+    def on_timeout(self, leg: StrategyOrder) -> None:
+        with self._lock:
+            self.label(leg.execution).timed_out += 1
+
+    def on_filled(self, leg: StrategyOrder, fill_price: float) -> None:
+        with self._lock:
+            statistics = self.label(leg.execution)
+            statistics.filled += 1
+            if leg.arrival_price is not None:
+                slippage = (fill_price - leg.arrival_price)*(1 if leg.order.action == 'BUY' else -1)
+                statistics.slippage += slippage
+                statistics.slippage_cost += slippage*float(leg.order.totalQuantity)*notional_per_unit(leg.contract)
+            if leg.sent_time is not None and leg.fill_time is not None:
+                statistics.seconds_to_fill += leg.fill_time - leg.sent_time
+
+    def summary_rows(self) -> list[dict]:
+        with self._lock:
+            return [{'execution': name, **statistics.row()} for name, statistics in self.statistics.items()]
+
+    def dump(self) -> None:
+        rows = self.summary_rows()
+        if rows:
+            log.info(f'Execution in {self.parameters.mode} mode: \n{rows_to_table(rows)}')
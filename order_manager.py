@@ -0,0 +1,138 @@
+import json
+import threading
+from typing import Iterator, Optional
+from strategy.orders import StrategyOrder
+from log_config import log
+
+# RiskRejected orders were stopped by the risk gate and never sent
+TERMINAL_STATUSES = {'Filled', 'Cancelled', 'ApiCancelled', 'Inactive', 'RiskRejected'}
+# completed orders kept in memory for late callbacks such as repeated Filled statuses and commission reports
+DEFAULT_TERMINAL_ORDERS_KEPT = 1000
+
+
+class OrderManager:
+    """Orders by IB order id, split into unsent, working and terminal indexes so that submission and open order
+    checks only look at the orders they concern. Ids come from a counter seeded by nextValidId.
+    Terminal orders beyond terminal_orders_kept are archived: appended as json lines to archive_path when
+    one is given, and dropped from memory."""
+
+    def __init__(self, archive_path: Optional[str] = None, terminal_orders_kept: int = DEFAULT_TERMINAL_ORDERS_KEPT):
+        self.archive_path = archive_path
+        self.terminal_orders_kept = terminal_orders_kept
+        self._next_id: Optional[int] = None
+        self._unsent: dict[int, StrategyOrder] = {}
+        self._working: dict[int, StrategyOrder] = {}
+        self._terminal: dict[int, StrategyOrder] = {}
+        self.archived_count = 0
+        self._lock = threading.Lock()
+
+    def seed(self, next_valid_id: int) -> None:
+        """nextValidId from TWS, ids are never handed out twice even if TWS sends a lower one later"""
+        with self._lock:
+            self._next_id = next_valid_id if self._next_id is None else max(self._next_id, next_valid_id)
+
+    def is_seeded(self) -> bool:
+        return self._next_id is not None
+
+    def allocate(self) -> int:
+        with self._lock:
+            order_id = self._next_id
+            self._next_id += 1
+            return order_id
+
+    def add(self, order_id: int, order: StrategyOrder) -> None:
+        """Adds a strategy order to send, or an order TWS reported, to the index its status belongs in"""
+        with self._lock:
+            self._index(order_id, order)
+            if self._next_id is not None and order_id >= self._next_id:
+                self._next_id = order_id + 1
+
+    def _index(self, order_id: int, order: StrategyOrder) -> None:
+        if order.status == 'Unsent':
+            self._unsent[order_id] = order
+        elif order.status in TERMINAL_STATUSES:
+            self._terminal[order_id] = order
+        else:
+            self._working[order_id] = order
+
+    def update_status(self, order_id: int, status: str) -> bool:
+        """Returns True when the order has just become terminal"""
+        with self._lock:
+            order = self.get(order_id)
+            if order is None:
+                return False
+            order.status = status
+            if status in TERMINAL_STATUSES and order_id not in self._terminal:
+                self._unsent.pop(order_id, None)
+                self._working.pop(order_id, None)
+                self._terminal[order_id] = order
+                return True
+            return False
+
+    def take_unsent(self) -> list[tuple[int, StrategyOrder]]:
+        """Orders waiting to be sent, moved to the working index, the caller places them"""
+        with self._lock:
+            unsent = list(self._unsent.items())
+            self._unsent.clear()
+            for order_id, order in unsent:
+                order.status = 'Sent'
+                self._working[order_id] = order
+            return unsent
+
+    def archive_terminal(self) -> list[int]:
+        """Archives the oldest terminal orders beyond terminal_orders_kept, returns their ids"""
+        with self._lock:
+            excess = len(self._terminal) - self.terminal_orders_kept
+            if excess <= 0:
+                return []
+            archived = list(self._terminal.items())[:excess]
+            for order_id, _ in archived:
+                del self._terminal[order_id]
+        if self.archive_path:
+            try:
+                with open(self.archive_path, 'a') as f:
+                    for order_id, order in archived:
+                        f.write(json.dumps({'order_id': order_id, **order.get_summary()}, default=str) + '\n')
+            except OSError as e:
+                log.error(f'Error archiving {len(archived)} orders to {self.archive_path}: {e}')
+        self.archived_count += len(archived)
+        return [order_id for order_id, _ in archived]
+
+    def get(self, order_id: int) -> Optional[StrategyOrder]:
+        return self._working.get(order_id) or self._unsent.get(order_id) or self._terminal.get(order_id)
+
+    def __contains__(self, order_id: int) -> bool:
+        return order_id in self._working or order_id in self._unsent or order_id in self._terminal
+
+    def __getitem__(self, order_id: int) -> StrategyOrder:
+        order = self.get(order_id)
+        if order is None:
+            raise KeyError(order_id)
+        return order
+
+    def __len__(self) -> int:
+        return len(self._unsent) + len(self._working) + len(self._terminal)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter([order_id for order_id, _ in self.items()])
+
+    def items(self) -> list[tuple[int, StrategyOrder]]:
+        with self._lock:
+            return list(self._unsent.items()) + list(self._working.items()) + list(self._terminal.items())
+
+    def values(self) -> list[StrategyOrder]:
+        return [order for _, order in self.items()]
+
+    def working(self) -> list[tuple[int, StrategyOrder]]:
+        with self._lock:
+            return list(self._working.items())
+
+    def as_dict(self) -> dict[int, StrategyOrder]:
+        return dict(self.items())
+
+    def restore(self, orders: dict[int, StrategyOrder]) -> None:
+        """Orders of a snapshot, the id counter moves past them"""
+        for order_id, order in orders.items():
+            self.add(order_id, order)
+        if orders:
+            self.seed(max(orders) + 1)
@@ -2,18 +2,18 @@ import json
 import pickle
 from colorama import Fore
 from prettytable import PrettyTable
-import pandas as pd
 from typing import Optional
 import datetime as dt
 import os
 from log_config import log
 
-def df_to_tt(dataframe: pd.DataFrame) -> PrettyTable:
-    """Transforms pandas dataframe to terminal table"""
+def rows_to_table(rows: list[dict]) -> PrettyTable:
+    """Terminal table of records, the columns are the keys in the order they first appear"""
     x = PrettyTable()
-    x.field_names = list(dataframe.columns)
-    for _, row in dataframe.iterrows():
-        x.add_row(list(row))
+    columns = list(dict.fromkeys(key for row in rows for key in row))
+    x.field_names = columns
+    for row in rows:
+        x.add_row([row.get(column, '') for column in columns])
     return x
 
 
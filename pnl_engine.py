@@ -0,0 +1,292 @@
+import threading
+import time
+from dataclasses import dataclass
+from typing import NamedTuple, Optional
+from ibapi.commission_report import CommissionReport
+from ibapi.common import UNSET_DOUBLE
+from log_config import log
+
+# book of the positions no pair strategy manages, such as those found in the account at startup
+ACCOUNT_BOOK = ''
+BASIS_POINT = 0.0001
+# IB rounds the realized pnl of its commission reports
+RECONCILE_TOLERANCE = 0.01
+
+
+def par_modified_duration(coupon_rate: float, years: float) -> float:
+    """Modified duration of a semi annual coupon bond priced at par, where the yield is the coupon rate"""
+    if years <= 0:
+        return 0.0
+    if coupon_rate <= 0:
+        return years
+    return (1 - (1 + coupon_rate/2)**(-2*years))/coupon_rate
+
+
+class PnlSnapshot(NamedTuple):
+    """Totals of a book or of the account, in account currency. Exposure is quantity times mid times the notional
+    of a unit, DV01 the value change of the positions for a one basis point fall in yields."""
+    realized: float
+    unrealized: float
+    commissions: float
+    gross_exposure: float
+    net_exposure: float
+    dv01: float
+
+    @property
+    def net_pnl(self) -> float:
+        return self.realized + self.unrealized - self.commissions
+
+
+@dataclass
+class PnlTotals:
+    realized: float = 0.0
+    unrealized: float = 0.0
+    commissions: float = 0.0
+    gross_exposure: float = 0.0
+    net_exposure: float = 0.0
+    dv01: float = 0.0
+
+    def snapshot(self) -> PnlSnapshot:
+        return PnlSnapshot(self.realized, self.unrealized, self.commissions, self.gross_exposure, self.net_exposure, self.dv01)
+
+
+@dataclass
+class InstrumentTerms:
+    name: str
+    # account currency per order unit and point of price, see risk_gate.notional_per_unit
+    notional_per_unit: float
+    modified_duration: float
+
+
+@dataclass
+class PositionPnl:
+    """Position of one book in one instrument, marked to its latest quote: longs at the bid, shorts at the ask"""
+    book: str
+    con_id: int
+    terms: InstrumentTerms
+    quantity: float = 0.0
+    average_price: float = 0.0
+    realized: float = 0.0
+    commissions: float = 0.0
+    mark_price: Optional[float] = None
+    # monotonic time of the quote the position is marked to
+    mark_ns: Optional[int] = None
+    unrealized: float = 0.0
+    exposure: float = 0.0
+    dv01: float = 0.0
+
+    def fill(self, signed_quantity: float, price: float) -> float:
+        """Adds an execution to the position, returns the pnl it realized"""
+        quantity = self.quantity
+        realized = 0.0
+        if quantity and (quantity > 0) != (signed_quantity > 0):
+            closed = min(abs(signed_quantity), abs(quantity))
+            realized = closed*(price - self.average_price)*(1 if quantity > 0 else -1)*self.terms.notional_per_unit
+            if abs(signed_quantity) > abs(quantity):
+                self.average_price = price
+        else:
+            self.average_price = (quantity*self.average_price + signed_quantity*price)/(quantity + signed_quantity)
+        self.quantity = quantity + signed_quantity
+        if not self.quantity:
+            self.average_price = 0.0
+        self.realized += realized
+        return realized
+
+    def mark(self, bid_price: Optional[float], ask_price: Optional[float], update_ns: Optional[int]) -> None:
+        price = bid_price if self.quantity > 0 else ask_price
+        if price is None or not self.quantity:
+            self.unrealized = self.exposure = self.dv01 = 0.0
+            return
+        mid = (bid_price + ask_price)/2 if bid_price is not None and ask_price is not None else price
+        self.mark_price = price
+        self.mark_ns = update_ns
+        self.unrealized = self.quantity*(price - self.average_price)*self.terms.notional_per_unit
+        self.exposure = self.quantity*mid*self.terms.notional_per_unit
+        self.dv01 = self.exposure*self.terms.modified_duration*BASIS_POINT
+
+    def row(self) -> dict:
+        return {'book': self.book, 'contract': self.con_id, 'term': self.terms.name, 'quantity': self.quantity,
+                'average_price': round(self.average_price, 4), 'mark_price': self.mark_price, 'unrealized_pnl': round(self.unrealized, 2),
+                'realized_pnl': round(self.realized, 2), 'commissions': round(self.commissions, 2), 'exposure': round(self.exposure, 2),
+                'dv01': round(self.dv01, 2)}
+
+
+@dataclass
+class ExecutionRecord:
+    order_id: int
+    book: str
+    con_id: int
+    realized: float
+    # realized pnl of the account wide position, the one IB reports
+    account_realized: float
+    commission: Optional[float] = None
+
+
+class PnlEngine:
+    """Realized and unrealized pnl, exposure and DV01 of every position by book (pair strategy key), updated in O(1)
+    on every quote and execution, with running totals by book and for the account so that a snapshot costs nothing.
+    Positions move with execDetails and commissions come from commissionReport, matched by execId in whichever
+    order they arrive, and the realized pnl IB reports is reconciled against the one computed here."""
+
+    def __init__(self):
+        self.instruments: dict[int, InstrumentTerms] = {}
+        self.positions: dict[int, list[PositionPnl]] = {}
+        self.books: dict[str, dict[int, PositionPnl]] = {}
+        self.totals: dict[str, PnlTotals] = {}
+        self.account = PnlTotals()
+        # account wide quantity and average price by conId, IB's realized pnl comes from these rather than from a book
+        self.account_positions: dict[int, PositionPnl] = {}
+        # latest bid, ask and update time of every instrument, a new position is marked right away
+        self.marks: dict[int, tuple[Optional[float], Optional[float], Optional[int]]] = {}
+        self.executions: dict[str, ExecutionRecord] = {}
+        self.order_executions: dict[int, list[str]] = {}
+        self.pending_commissions: dict[str, CommissionReport] = {}
+        self.reconciliation_breaks = 0
+        # quotes and executions arrive on the IB reader thread, snapshots are taken by the strategy thread
+        self._lock = threading.Lock()
+
+    def register(self, con_id: int, name: str, notional_per_unit: float, modified_duration: float) -> None:
+        if con_id not in self.instruments:
+            self.instruments[con_id] = InstrumentTerms(name, notional_per_unit, modified_duration)
+
+    def is_registered(self, con_id: int) -> bool:
+        return con_id in self.instruments
+
+    def _position(self, book: str, con_id: int) -> PositionPnl:
+        book_positions = self.books.setdefault(book, {})
+        position = book_positions.get(con_id)
+        if position is None:
+            position = book_positions[con_id] = PositionPnl(book, con_id, self.instruments[con_id])
+            self.positions.setdefault(con_id, []).append(position)
+        return position
+
+    def _account_position(self, con_id: int) -> PositionPnl:
+        position = self.account_positions.get(con_id)
+        if position is None:
+            position = self.account_positions[con_id] = PositionPnl(ACCOUNT_BOOK, con_id, self.instruments[con_id])
+        return position
+
+    def _update(self, position: PositionPnl, bid_price: Optional[float], ask_price: Optional[float], update_ns: Optional[int],
+                realized: float = 0.0, commission: float = 0.0) -> None:
+        """Re-marks a position and moves the book and account totals by its change"""
+        before_unrealized, before_exposure, before_dv01 = position.unrealized, position.exposure, position.dv01
+        position.mark(bid_price, ask_price, update_ns)
+        for totals in (self.totals.setdefault(position.book, PnlTotals()), self.account):
+            totals.realized += realized
+            totals.commissions += commission
+            totals.unrealized += position.unrealized - before_unrealized
+            totals.net_exposure += position.exposure - before_exposure
+            totals.gross_exposure += abs(position.exposure) - abs(before_exposure)
+            totals.dv01 += position.dv01 - before_dv01
+
+    def on_quote(self, con_id: int, bid_price: Optional[float], ask_price: Optional[float], update_ns: Optional[int]) -> None:
+        with self._lock:
+            self.marks[con_id] = (bid_price, ask_price, update_ns)
+            for position in self.positions.get(con_id, ()):
+                self._update(position, bid_price, ask_price, update_ns)
+
+    def on_execution(self, exec_id: str, order_id: int, book: str, con_id: int, side: str, shares: float, price: float) -> None:
+        """An execution of a registered instrument, repeated execDetails of the same execId are ignored"""
+        with self._lock:
+            if exec_id in self.executions:
+                return
+            position = self._position(book, con_id)
+            signed_quantity = shares if side == 'BOT' else -shares
+            realized = position.fill(signed_quantity, price)
+            account_realized = self._account_position(con_id).fill(signed_quantity, price)
+            self.executions[exec_id] = ExecutionRecord(order_id, book, con_id, realized, account_realized)
+            self.order_executions.setdefault(order_id, []).append(exec_id)
+            self._update(position, *self.marks.get(con_id, (None, None, None)), realized=realized)
+            report = self.pending_commissions.pop(exec_id, None)
+            if report is not None:
+                self._apply_commission(report)
+
+    def on_commission(self, report: CommissionReport) -> Optional[int]:
+        """Returns the order of the execution, None when its execDetails has not arrived yet"""
+        with self._lock:
+            if report.execId not in self.executions:
+                self.pending_commissions[report.execId] = report
+                return None
+            return self._apply_commission(report)
+
+    def _apply_commission(self, report: CommissionReport) -> int:
+        record = self.executions[report.execId]
+        if record.commission is None:
+            record.commission = report.commission
+            position = self.books[record.book][record.con_id]
+            position.commissions += report.commission
+            self._update(position, *self.marks.get(record.con_id, (None, None, None)), commission=report.commission)
+        # IB reports realized pnl net of the commission, and only for executions that reduce a position
+        if report.realizedPNL is not None and report.realizedPNL != UNSET_DOUBLE:
+            computed = record.account_realized - report.commission
+            if abs(report.realizedPNL - computed) > RECONCILE_TOLERANCE:
+                self.reconciliation_breaks += 1
+                log.warning(f'Execution {report.execId} of order {record.order_id}: IB realized pnl {report.realizedPNL:.2f}, computed {computed:.2f}')
+        return record.order_id
+
+    def load_position(self, book: str, con_id: int, quantity: float, average_price: float) -> None:
+        """Sets a position that did not come from executions seen here, from the account or a snapshot"""
+        with self._lock:
+            position = self._position(book, con_id)
+            before_unrealized, before_exposure, before_dv01 = position.unrealized, position.exposure, position.dv01
+            position.quantity, position.average_price = float(quantity), float(average_price)
+            position.unrealized = position.exposure = position.dv01 = 0.0
+            for totals in (self.totals.setdefault(book, PnlTotals()), self.account):
+                totals.unrealized -= before_unrealized
+                totals.net_exposure -= before_exposure
+                totals.gross_exposure -= abs(before_exposure)
+                totals.dv01 -= before_dv01
+            self._update(position, *self.marks.get(con_id, (None, None, None)))
+
+    def load_account_position(self, con_id: int, quantity: float, average_price: float) -> None:
+        """Account wide position reported by IB, the basis of its realized pnl"""
+        with self._lock:
+            position = self._account_position(con_id)
+            position.quantity, position.average_price = float(quantity), float(average_price)
+
+    def snapshot(self, book: Optional[str] = None) -> PnlSnapshot:
+        """Totals of a book, or of the account when book is None"""
+        with self._lock:
+            totals = self.account if book is None else self.totals.get(book, PnlTotals())
+            return totals.snapshot()
+
+    def book_quantity(self, con_id: int, exclude: str) -> float:
+        with self._lock:
+            return sum(position.quantity for position in self.positions.get(con_id, ()) if position.book != exclude)
+
+    def is_marked(self, book: Optional[str], max_age_seconds: float) -> bool:
+        """Every open position of the book, or of the account, is marked to a quote younger than max_age_seconds"""
+        now_ns = time.monotonic_ns()
+        with self._lock:
+            books = self.books.values() if book is None else [self.books.get(book, {})]
+            return all(position.mark_ns is not None and now_ns - position.mark_ns <= max_age_seconds*1_000_000_000
+                       for positions in books for position in positions.values() if position.quantity)
+
+    def position_rows(self, book: Optional[str] = None) -> list[dict]:
+        with self._lock:
+            books = self.books.values() if book is None else [self.books.get(book, {})]
+            return [position.row() for positions in books for position in positions.values() if position.quantity]
+
+    def has_commissions(self, order_ids: list[int]) -> bool:
+        """Every order has executions and the commission of each of them is in"""
+        with self._lock:
+            return all(self.order_executions.get(order_id) and
+                       all(self.executions[exec_id].commission is not None for exec_id in self.order_executions[order_id])
+                       for order_id in order_ids)
+
+    def order_totals(self, order_ids: list[int]) -> tuple[float, float]:
+        """Commissions and realized pnl of the executions of some orders"""
+        with self._lock:
+            records = [self.executions[exec_id] for order_id in order_ids for exec_id in self.order_executions.get(order_id, ())]
+            return sum(record.commission or 0.0 for record in records), sum(record.realized for record in records)
+
+    def execution_order(self, exec_id: str) -> Optional[int]:
+        record = self.executions.get(exec_id)
+        return record.order_id if record is not None else None
+
+    def forget_orders(self, order_ids: list[int]) -> None:
+        """Drops the execution records of archived orders, the positions and totals keep their effect"""
+        with self._lock:
+            for order_id in order_ids:
+                for exec_id in self.order_executions.pop(order_id, ()):
+                    self.executions.pop(exec_id, None)
@@ -0,0 +1,305 @@
+import threading
+import time
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import Callable, Optional
+import numpy as np
+from ibapi.commission_report import CommissionReport
+from ibapi.common import UNSET_DOUBLE, BarData, TickAttrib, TickAttribBidAsk
+from ibapi.contract import Contract, ContractDetails
+from ibapi.execution import Execution
+from ibapi.order import Order
+from ibapi.ticktype import TickTypeEnum
+from replay.events import BAR, QUOTE, ReplayEvent, ReplayScenario
+
+FIRST_CON_ID = 500000
+COMMISSION_PER_BOND = 0.1
+
+# the broker talks to its transport through emit(callback name, callback args), the names are EWrapper methods
+Emit = Callable[[str, tuple], None]
+
+
+@dataclass
+class PendingOrder:
+    order_id: int
+    con_id: int
+    action: str
+    quantity: float
+    placed_ns: int
+    # None for market orders, Adaptive algo orders included
+    limit_price: Optional[float] = None
+
+
+def bar_date(timestamp_ns: int) -> str:
+    """Formats a bar timestamp the way IB does with formatDate=1"""
+    return np.datetime64(timestamp_ns, 'ns').astype('datetime64[s]').item().strftime('%Y%m%d %H:%M:%S')
+
+
+def bar_from_event(event: ReplayEvent) -> BarData:
+    bar = BarData()
+    bar.date = bar_date(event.timestamp_ns)
+    bar.open = event.values['open']
+    bar.high = event.values['high']
+    bar.low = event.values['low']
+    bar.close = event.values['close']
+    bar.volume = Decimal(str(event.values.get('volume', 0)))
+    bar.wap = Decimal(str(event.values.get('wap', event.values['close'])))
+    bar.barCount = int(event.values.get('bar_count', 0))
+    return bar
+
+
+class SimulatedBroker:
+    """Plays the part of TWS: answers the requests TradingApp sends, streams the replayed market data to the
+    subscribed request ids and fills market orders against the next quote of their instrument
+    (BUY at the ask, SELL at the bid) with a fixed commission per bond. Limit orders rest until the other side
+    of the book reaches their price and then fill at it: quotes carry no trades, so a resting order is assumed
+    to trade only once the market comes to it."""
+
+    def __init__(self, scenario: ReplayScenario, account: str, buying_power: float, emit: Emit, commission_per_bond: float = COMMISSION_PER_BOND,
+                 historical_requests_per_second: Optional[int] = None):
+        self.scenario = scenario
+        self.account = account
+        self.buying_power = buying_power
+        self.emit = emit
+        self.commission_per_bond = commission_per_bond
+        self.con_ids: dict[str, int] = {bond.cusip: FIRST_CON_ID + i for i, bond in enumerate(scenario.bonds)}
+        self.symbols: dict[int, str] = {con_id: cusip for cusip, con_id in self.con_ids.items()}
+        self.quote_subscriptions: dict[str, list[int]] = {}
+        self.tick_subscriptions: dict[str, list[int]] = {}
+        self.bar_subscriptions: dict[str, list[int]] = {}
+        self.request_symbols: dict[int, str] = {}
+        self.books: dict[str, dict[str, float]] = {}
+        self.pending_orders: dict[str, list[PendingOrder]] = {}
+        self.order_ids: set[int] = set()
+        # with the socket transport orders arrive on the gateway thread while quotes arrive on the replay thread
+        self.orders_lock = threading.Lock()
+        self.positions: dict[int, tuple[float, float]] = {}
+        self.execution_counter = 0
+        self.last_tick_ns: Optional[int] = None
+        self.tick_to_order_ns: list[int] = []
+        self.fills = 0
+        self.orders_placed = 0
+        # emulates IB pacing, historical requests above this rate are rejected with error 162
+        self.historical_requests_per_second = historical_requests_per_second
+        self.historical_request_times: list[float] = []
+        self.pacing_violations = 0
+
+    def contract_for(self, symbol: str) -> Contract:
+        bond = next(b for b in self.scenario.bonds if b.cusip == symbol)
+        contract = Contract()
+        contract.conId = self.con_ids[symbol]
+        contract.symbol = symbol
+        contract.secType = 'BOND'
+        contract.exchange = 'SMART'
+        contract.currency = 'USD'
+        contract.lastTradeDateOrContractMonth = bond.maturityDate.strftime('%Y%m%d')
+        return contract
+
+    def symbol_of(self, contract: Contract) -> Optional[str]:
+        if contract.conId and contract.conId in self.symbols:
+            return self.symbols[contract.conId]
+        if contract.symbol in self.con_ids:
+            return contract.symbol
+        return None
+
+    ##-----------------Requests-------------------##
+    def start_api(self, next_order_id: int = 1) -> None:
+        self.emit('nextValidId', (next_order_id,))
+        self.emit('managedAccounts', (self.account,))
+
+    def req_positions(self) -> None:
+        for con_id, (quantity, average_price) in self.positions.items():
+            if quantity:
+                self.emit('position', (self.account, self.contract_for(self.symbols[con_id]), Decimal(quantity), 10*average_price))
+        self.emit('positionEnd', ())
+
+    def req_account_summary(self, req_id: int) -> None:
+        self.emit('accountSummary', (req_id, self.account, 'BuyingPower', str(self.buying_power), 'USD'))
+        self.emit('accountSummaryEnd', (req_id,))
+
+    def req_open_orders(self) -> None:
+        self.emit('openOrderEnd', ())
+
+    def req_contract_details(self, req_id: int, contract: Contract) -> None:
+        symbol = self.symbol_of(contract)
+        if symbol is None:
+            self.emit('error', (req_id, 200, 'No security definition has been found for the request'))
+            return
+        details = ContractDetails()
+        details.contract = self.contract_for(symbol)
+        details.cusip = symbol
+        details.maturity = details.contract.lastTradeDateOrContractMonth
+        self.emit('bondContractDetails', (req_id, details))
+        self.emit('contractDetailsEnd', (req_id,))
+
+    def req_historical_data(self, req_id: int, contract: Contract, keep_up_to_date: bool) -> None:
+        symbol = self.symbol_of(contract)
+        if symbol is None:
+            self.emit('error', (req_id, 162, 'Historical Market Data Service error message:No market data permissions'))
+            return
+        if self.historical_requests_per_second:
+            now = time.monotonic()
+            self.historical_request_times = [t for t in self.historical_request_times if now - t < 1.0]
+            if len(self.historical_request_times) >= self.historical_requests_per_second:
+                self.pacing_violations += 1
+                self.emit('error', (req_id, 162, 'Historical Market Data Service error message:Historical data request pacing violation'))
+                return
+            self.historical_request_times.append(now)
+        bars = self.scenario.history(symbol)
+        for event in bars:
+            self.emit('historicalData', (req_id, bar_from_event(event)))
+        start = bar_date(bars[0].timestamp_ns) if bars else ''
+        end = bar_date(bars[-1].timestamp_ns) if bars else ''
+        self.emit('historicalDataEnd', (req_id, start, end))
+        if keep_up_to_date:
+            self.bar_subscriptions.setdefault(symbol, []).append(req_id)
+
+    def req_mkt_data(self, req_id: int, contract: Contract) -> None:
+        symbol = self.symbol_of(contract)
+        if symbol is not None:
+            self.request_symbols[req_id] = symbol
+            self.quote_subscriptions.setdefault(symbol, []).append(req_id)
+
+    def req_tick_by_tick(self, req_id: int, contract: Contract) -> None:
+        symbol = self.symbol_of(contract)
+        if symbol is not None:
+            self.request_symbols[req_id] = symbol
+            self.tick_subscriptions.setdefault(symbol, []).append(req_id)
+
+    def has_market_data_subscribers(self) -> bool:
+        return bool(self.quote_subscriptions or self.tick_subscriptions)
+
+    def place_order(self, order_id: int, contract: Contract, order: Order) -> None:
+        now = time.monotonic_ns()
+        symbol = self.symbol_of(contract)
+        if symbol is None:
+            self.emit('error', (order_id, 200, 'No security definition has been found for the request'))
+            return
+        if order.orderType not in ('MKT', 'LMT'):
+            self.emit('error', (order_id, 10000, f'Simulated broker only fills MKT and LMT orders, got {order.orderType}'))
+            return
+        quantity = float(order.totalQuantity)
+        limit_price = order.lmtPrice if order.orderType == 'LMT' else None
+        with self.orders_lock:
+            if order_id in self.order_ids:
+                # placeOrder with the id of a working order modifies it
+                pending = self.find_pending(order_id)
+                if pending is None:
+                    self.emit('error', (order_id, 104, "Can't modify a filled order"))
+                    return
+                pending.limit_price, pending.quantity = limit_price, quantity
+                self.emit('orderStatus', (order_id, 'Submitted', Decimal(0), Decimal(quantity), 0.0, order_id, 0, 0.0, 0, '', 0.0))
+                return
+            self.order_ids.add(order_id)
+            self.orders_placed += 1
+            if self.last_tick_ns is not None:
+                self.tick_to_order_ns.append(now - self.last_tick_ns)
+            self.emit('orderStatus', (order_id, 'Submitted', Decimal(0), Decimal(quantity), 0.0, order_id, 0, 0.0, 0, '', 0.0))
+            self.pending_orders.setdefault(symbol, []).append(
+                PendingOrder(order_id, self.con_ids[symbol], order.action, quantity, now, limit_price))
+
+    def find_pending(self, order_id: int) -> Optional[PendingOrder]:
+        for pending_orders in self.pending_orders.values():
+            for pending in pending_orders:
+                if pending.order_id == order_id:
+                    return pending
+        return None
+
+    def cancel_order(self, order_id: int) -> None:
+        with self.orders_lock:
+            pending = self.find_pending(order_id)
+            if pending is None:
+                self.emit('error', (order_id, 10147, f'OrderId {order_id} that needs to be cancelled is not found.'))
+                return
+            self.pending_orders[self.symbols[pending.con_id]].remove(pending)
+            self.emit('orderStatus', (order_id, 'Cancelled', Decimal(0), Decimal(pending.quantity), 0.0, order_id, 0, 0.0, 0, '', 0.0))
+
+    ##-----------------Market data-------------------##
+    def on_event(self, event: ReplayEvent) -> None:
+        if event.kind == QUOTE:
+            self.on_quote(event)
+        elif event.kind == BAR:
+            for req_id in self.bar_subscriptions.get(event.symbol, []):
+                self.emit('historicalDataUpdate', (req_id, bar_from_event(event)))
+
+    def on_quote(self, event: ReplayEvent) -> None:
+        book = self.books.setdefault(event.symbol, {})
+        values = event.values
+        changed = {key: book.get(key) != value for key, value in values.items()}
+        book.update(values)
+        for req_id in self.quote_subscriptions.get(event.symbol, []):
+            for price_type, size_type, price_key, size_key in ((TickTypeEnum.BID, TickTypeEnum.BID_SIZE, 'bid_price', 'bid_size'),
+                                                               (TickTypeEnum.ASK, TickTypeEnum.ASK_SIZE, 'ask_price', 'ask_size')):
+                if changed[price_key]:
+                    self.emit('tickPrice', (req_id, price_type, values[price_key], TickAttrib()))
+                if changed[size_key]:
+                    self.emit('tickSize', (req_id, size_type, Decimal(str(values[size_key]))))
+        for req_id in self.tick_subscriptions.get(event.symbol, []):
+            self.emit('tickByTickBidAsk', (req_id, event.timestamp_ns // 1_000_000_000, values['bid_price'], values['ask_price'],
+                                           Decimal(str(values['bid_size'])), Decimal(str(values['ask_size'])), TickAttribBidAsk()))
+        self.fill_pending(event.symbol)
+
+    def fill_price(self, pending: PendingOrder, book: dict[str, float]) -> Optional[float]:
+        """Price a pending order fills at on the current book, None while a limit order is not reached"""
+        if pending.action == 'BUY':
+            if pending.limit_price is None:
+                return book['ask_price']
+            return pending.limit_price if book['ask_price'] <= pending.limit_price else None
+        if pending.limit_price is None:
+            return book['bid_price']
+        return pending.limit_price if book['bid_price'] >= pending.limit_price else None
+
+    def fill_pending(self, symbol: str) -> None:
+        book = self.books[symbol]
+        fills = []
+        with self.orders_lock:
+            resting = []
+            for pending in self.pending_orders.pop(symbol, []):
+                price = self.fill_price(pending, book)
+                if price is None:
+                    resting.append(pending)
+                else:
+                    fills.append((pending, price))
+            if resting:
+                self.pending_orders[symbol] = resting
+        for pending, price in fills:
+            signed = pending.quantity if pending.action == 'BUY' else -pending.quantity
+            realized = self.update_position(pending.con_id, signed, price)
+            self.fills += 1
+            self.execution_counter += 1
+            exec_id = f'sim.{self.execution_counter:08d}'
+            self.emit('orderStatus', (pending.order_id, 'Filled', Decimal(pending.quantity), Decimal(0), price,
+                                      pending.order_id, 0, price, 0, '', 0.0))
+            execution = Execution()
+            execution.execId = exec_id
+            execution.orderId = pending.order_id
+            execution.acctNumber = self.account
+            execution.side = 'BOT' if pending.action == 'BUY' else 'SLD'
+            execution.shares = Decimal(pending.quantity)
+            execution.price = price
+            execution.avgPrice = price
+            execution.cumQty = Decimal(pending.quantity)
+            self.emit('execDetails', (-1, self.contract_for(symbol), execution))
+            report = CommissionReport()
+            report.execId = exec_id
+            report.commission = self.commission_per_bond*pending.quantity
+            report.currency = 'USD'
+            report.realizedPNL = UNSET_DOUBLE if realized is None else realized - report.commission
+            report.yield_ = UNSET_DOUBLE
+            report.yieldRedemptionDate = 0
+            self.emit('commissionReport', (report,))
+
+    def update_position(self, con_id: int, signed_quantity: float, price: float) -> Optional[float]:
+        """Applies a fill, returns the realized pnl when it reduces the position (bond pnl is 10x the price move per bond)"""
+        quantity, average_price = self.positions.get(con_id, (0.0, 0.0))
+        new_quantity = quantity + signed_quantity
+        realized = None
+        if quantity and (quantity > 0) != (signed_quantity > 0):
+            closed = min(abs(signed_quantity), abs(quantity))
+            realized = 10*closed*(price - average_price)*(1 if quantity > 0 else -1)
+            if abs(signed_quantity) > abs(quantity):
+                average_price = price
+        elif new_quantity:
+            average_price = (quantity*average_price + signed_quantity*price)/new_quantity
+        self.positions[con_id] = (new_quantity, average_price if new_quantity else 0.0)
+        return realized
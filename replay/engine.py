@@ -0,0 +1,272 @@
+"""Deterministic market data replay for TradingApp and strategy_loop without a live TWS.
+
+python -m replay.engine --speed 0                      synthetic session, as fast as possible, in process
+python -m replay.engine --speed 10 --transport socket  10x real time through the fake IB gateway
+python -m replay.engine --transport asyncio            through the fake IB gateway with the asyncio client
+python -m replay.engine --execution midpoint_peg       pegged entries and exits, compare the execution table with market
+python -m replay.engine --events ticks.jsonl --bonds bonds.json
+"""
+import argparse
+import asyncio
+import json
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+import numpy as np
+from log_config import log
+from async_transport import AsyncTransport
+from main import cancel_tasks, request_account_data, strategy_loop, strategy_task
+from order_execution import ExecutionEngine, ExecutionMode, ExecutionParameters
+from market_data.ust_bonds import USTreasurySecurity
+from replay.broker import SimulatedBroker
+from replay.events import ReplayScenario, load_events, scenario_from_events, synthetic_scenario
+from replay.gateway import TICK_TYPES, FakeGateway
+from trading_app import TradingApp
+
+SUBSCRIPTION_TIMEOUT_SECONDS = 60.0
+SETTLE_SECONDS = 1.0
+
+
+@dataclass
+class ReplayReport:
+    market_events: int
+    callbacks: int
+    elapsed_seconds: float
+    orders: int
+    fills: int
+    closed_trades: int
+    tick_to_order_ns: list[int]
+    # fill rate and slippage by execution label, see ExecutionEngine
+    execution: list[dict]
+    # account totals of the pnl engine and its disagreements with the realized pnl of the commission reports
+    pnl: dict
+    reconciliation_breaks: int
+
+    def events_per_second(self) -> float:
+        return self.market_events/self.elapsed_seconds if self.elapsed_seconds else 0.0
+
+    def latency_percentiles_us(self) -> dict[str, float]:
+        if not self.tick_to_order_ns:
+            return {}
+        samples = np.array(self.tick_to_order_ns)/1000
+        return {'p50': float(np.percentile(samples, 50)), 'p90': float(np.percentile(samples, 90)),
+                'p99': float(np.percentile(samples, 99)), 'max': float(samples.max())}
+
+    def summary(self) -> dict:
+        return {'market_events': self.market_events, 'callbacks': self.callbacks, 'elapsed_seconds': round(self.elapsed_seconds, 3),
+                'events_per_second': round(self.events_per_second(), 1), 'orders': self.orders, 'fills': self.fills,
+                'closed_trades': self.closed_trades, 'tick_to_order_us': {k: round(v, 1) for k, v in self.latency_percentiles_us().items()},
+                'execution': self.execution, 'pnl': self.pnl, 'reconciliation_breaks': self.reconciliation_breaks}
+
+
+class InProcessTransport:
+    """Routes the app requests straight to the broker and delivers the broker callbacks from the replay thread,
+    which plays the part of the IB reader thread"""
+
+    def __init__(self, app: TradingApp, broker: SimulatedBroker):
+        self.app = app
+        self.broker = broker
+        self.callbacks: queue.Queue = queue.Queue()
+        self.callbacks_delivered = 0
+        broker.emit = lambda method, args: self.callbacks.put((method, args))
+        app.isConnected = lambda: True
+        app.reqPositions = broker.req_positions
+        app.reqAccountSummary = lambda reqId, groupName, tags: broker.req_account_summary(reqId)
+        app.reqOpenOrders = broker.req_open_orders
+        app.reqContractDetails = broker.req_contract_details
+        app.reqHistoricalData = lambda reqId, contract, endDateTime, durationStr, barSizeSetting, whatToShow, useRTH, formatDate, keepUpToDate, chartOptions: \
+            broker.req_historical_data(reqId, contract, keepUpToDate)
+        app.reqMktData = lambda reqId, contract, *args: broker.req_mkt_data(reqId, contract)
+        app.reqTickByTickData = lambda reqId, contract, *args: broker.req_tick_by_tick(reqId, contract)
+        app.reqMktDepth = lambda *args: None
+        app.reqExecutions = lambda *args: None
+        app.placeOrder = broker.place_order
+        app.cancelOrder = lambda orderId, manualCancelOrderTime='': broker.cancel_order(orderId)
+
+    def connect(self) -> None:
+        self.broker.start_api()
+        self.deliver(0)
+
+    def start(self, strategy: Callable[[TradingApp], None]) -> None:
+        start_strategy_thread(self.app, strategy)
+
+    def deliver(self, timeout: float) -> None:
+        """Delivers queued callbacks, waiting up to timeout seconds for the first one"""
+        deadline = time.perf_counter() + timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            try:
+                method, args = self.callbacks.get(timeout=remaining) if remaining > 0 else self.callbacks.get_nowait()
+            except queue.Empty:
+                return
+            if method in TICK_TYPES:
+                self.broker.last_tick_ns = time.monotonic_ns()
+            getattr(self.app, method)(*args)
+            self.callbacks_delivered += 1
+
+    def close(self) -> None:
+        pass
+
+
+class SocketTransport:
+    """Runs the app unmodified against the FakeGateway over a local TCP connection"""
+
+    def __init__(self, app: TradingApp, broker: SimulatedBroker):
+        self.app = app
+        self.gateway = FakeGateway(broker)
+
+    @property
+    def callbacks_delivered(self) -> int:
+        return self.gateway.callbacks_sent
+
+    def connect(self) -> None:
+        self.gateway.start()
+        self.app.connect('127.0.0.1', self.gateway.port, clientId=0)
+        threading.Thread(target=self.app.run, name='IBReader', daemon=True).start()
+
+    def start(self, strategy: Callable[[TradingApp], None]) -> None:
+        start_strategy_thread(self.app, strategy)
+
+    def deliver(self, timeout: float) -> None:
+        if timeout > 0:
+            time.sleep(timeout)
+
+    def close(self) -> None:
+        self.app.disconnect()
+        self.gateway.stop()
+
+
+class AsyncSocketTransport:
+    """Runs the app against the FakeGateway with the asyncio client, the reader and strategy_task share
+    an event loop that runs in its own thread so the replay thread can keep feeding the gateway"""
+
+    def __init__(self, app: TradingApp, broker: SimulatedBroker):
+        self.app = app
+        self.gateway = FakeGateway(broker)
+        self.loop = asyncio.new_event_loop()
+        self.client = AsyncTransport(app)
+
+    @property
+    def callbacks_delivered(self) -> int:
+        return self.gateway.callbacks_sent
+
+    def connect(self) -> None:
+        self.gateway.start()
+        threading.Thread(target=self.loop.run_forever, name='EventLoop', daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._connect(), self.loop).result()
+
+    async def _connect(self) -> None:
+        self.app.use_event_loop()
+        await self.client.connect('127.0.0.1', self.gateway.port, 0)
+        self.loop.create_task(self.client.run())
+
+    def start(self, strategy: Callable[[TradingApp], None]) -> None:
+        # strategy_loop cannot share the loop, its asyncio twin runs instead
+        self.loop.call_soon_threadsafe(self.app.send_requests)
+        self.loop.call_soon_threadsafe(self.loop.create_task, strategy_task(self.app))
+
+    def deliver(self, timeout: float) -> None:
+        if timeout > 0:
+            time.sleep(timeout)
+
+    async def _close(self) -> None:
+        self.client.close()
+        await cancel_tasks({task for task in asyncio.all_tasks() if task is not asyncio.current_task()})
+
+    def close(self) -> None:
+        asyncio.run_coroutine_threadsafe(self._close(), self.loop).result()
+        self.gateway.stop()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+TRANSPORTS = {'inprocess': InProcessTransport, 'socket': SocketTransport, 'asyncio': AsyncSocketTransport}
+
+
+def start_strategy_thread(app: TradingApp, strategy: Callable[[TradingApp], None]) -> None:
+    app.send_requests()
+    threading.Thread(target=strategy, args=(app,), name='Strategy', daemon=True).start()
+
+
+class ReplayEngine:
+    """Feeds a ReplayScenario to a TradingApp running strategy_loop.
+    speed is the replay rate relative to the recorded timestamps, 0 replays as fast as possible."""
+
+    def __init__(self, scenario: ReplayScenario, app: TradingApp, speed: float = 0, transport: str = 'inprocess',
+                 buying_power: float = 1_000_000, strategy: Callable[[TradingApp], None] = strategy_loop,
+                 historical_requests_per_second: Optional[int] = None):
+        self.scenario = scenario
+        self.app = app
+        self.speed = speed
+        self.strategy = strategy
+        self.broker = SimulatedBroker(scenario, app.account, buying_power, emit=lambda method, args: None,
+                                      historical_requests_per_second=historical_requests_per_second)
+        app.set_bonds_general_info(scenario.bonds)
+        self.transport = TRANSPORTS[transport](app, self.broker)
+
+    def wait_for_subscriptions(self) -> None:
+        """Live data starts once the strategy has picked a pair and subscribed to its quotes"""
+        deadline = time.perf_counter() + SUBSCRIPTION_TIMEOUT_SECONDS
+        while not self.broker.has_market_data_subscribers():
+            if time.perf_counter() > deadline:
+                log.error('Replay: no market data subscription before the timeout, replaying anyway')
+                return
+            self.transport.deliver(0.01)
+
+    def run(self) -> ReplayReport:
+        request_account_data(self.app)
+        self.transport.connect()
+        self.transport.start(self.strategy)
+        self.wait_for_subscriptions()
+        session = self.scenario.session()
+        start = time.perf_counter()
+        first_ns = session[0].timestamp_ns if session else 0
+        for event in session:
+            if self.speed > 0:
+                due = start + (event.timestamp_ns - first_ns)/1e9/self.speed
+                self.transport.deliver(max(0.0, due - time.perf_counter()))
+            self.broker.on_event(event)
+            self.transport.deliver(0)
+        elapsed = time.perf_counter() - start
+        self.transport.deliver(SETTLE_SECONDS)
+        report = ReplayReport(len(session), self.transport.callbacks_delivered, elapsed, self.broker.orders_placed, self.broker.fills,
+                              sum(trade.is_complete() for trade in self.app.trades), list(self.broker.tick_to_order_ns),
+                              self.app.execution.summary_rows(),
+                              {key: round(value, 2) for key, value in self.app.pnl.snapshot()._asdict().items()},
+                              self.app.pnl.reconciliation_breaks)
+        self.transport.close()
+        self.app.latency.dump()
+        self.app.execution.dump()
+        self.app.reporter.flush()
+        if self.app.snapshots is not None:
+            self.app.snapshots.flush()
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay market data through TradingApp and strategy_loop')
+    parser.add_argument('--speed', type=float, default=0, help='replay rate, 1 is real time, 0 is as fast as possible')
+    parser.add_argument('--transport', choices=list(TRANSPORTS), default='inprocess')
+    parser.add_argument('--execution', choices=[str(mode) for mode in ExecutionMode], default='market')
+    parser.add_argument('--events', help='recorded events, one ReplayEvent json per line')
+    parser.add_argument('--bonds', help='Treasury Direct json records of the instruments in --events')
+    parser.add_argument('--quotes', type=int, default=20000, help='number of synthetic quotes when no events are given')
+    parser.add_argument('--rolling-window', type=int, default=100)
+    parser.add_argument('--bar-interval', type=int, default=3)
+    parser.add_argument('--historical-pacing', type=int, help='historical requests per second the fake gateway accepts')
+    args = parser.parse_args()
+    if args.events:
+        with open(args.bonds, 'r') as f:
+            bonds = [USTreasurySecurity.from_dict(record) for record in json.load(f)]
+        scenario = scenario_from_events(bonds, load_events(args.events), bar_interval=args.bar_interval)
+    else:
+        scenario = synthetic_scenario(session_quotes=args.quotes, bar_interval=args.bar_interval)
+    app = TradingApp('SIMULATED', scenario.bar_interval, args.rolling_window, 50,
+                     execution=ExecutionEngine(ExecutionParameters(ExecutionMode(args.execution))))
+    report = ReplayEngine(scenario, app, args.speed, args.transport, historical_requests_per_second=args.historical_pacing).run()
+    log.info(f'Replay report: {json.dumps(report.summary())}')
+
+
+if __name__ == '__main__':
+    main()
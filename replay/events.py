@@ -0,0 +1,106 @@
+import datetime as dt
+import json
+from dataclasses import dataclass, field
+from typing import Optional
+import numpy as np
+from market_data.ust_bonds import USTreasurySecurity
+
+QUOTE = 'quote'
+BAR = 'bar'
+NANOSECONDS_PER_SECOND = 1_000_000_000
+
+
+@dataclass
+class ReplayEvent:
+    """One recorded market data event for the instrument whose cusip is symbol.
+    quote values: bid_price, ask_price, bid_size, ask_size
+    bar values: open, high, low, close, volume, wap, bar_count"""
+    timestamp_ns: int
+    symbol: str
+    kind: str
+    values: dict[str, float] = field(default_factory=dict)
+
+    def to_json(self) -> str:
+        return json.dumps({'timestamp_ns': self.timestamp_ns, 'symbol': self.symbol, 'kind': self.kind, **self.values})
+
+    @classmethod
+    def from_json(cls, line: str) -> 'ReplayEvent':
+        data = json.loads(line)
+        return cls(data.pop('timestamp_ns'), data.pop('symbol'), data.pop('kind'), data)
+
+
+@dataclass
+class ReplayScenario:
+    """Everything the fake gateway needs to stand in for IB: the securities, their history and the live session.
+    Bars stamped before session_start_ns are served as history, later events are replayed as live data."""
+    bonds: list[USTreasurySecurity]
+    events: list[ReplayEvent]
+    session_start_ns: int
+    bar_interval: int = 3
+
+    def history(self, symbol: str) -> list[ReplayEvent]:
+        return [e for e in self.events if e.symbol == symbol and e.kind == BAR and e.timestamp_ns < self.session_start_ns]
+
+    def session(self) -> list[ReplayEvent]:
+        return [e for e in self.events if e.timestamp_ns >= self.session_start_ns]
+
+
+def save_events(filepath: str, events: list[ReplayEvent]) -> None:
+    with open(filepath, 'w') as f:
+        for event in events:
+            f.write(event.to_json() + '\n')
+
+
+def load_events(filepath: str) -> list[ReplayEvent]:
+    with open(filepath, 'r') as f:
+        events = [ReplayEvent.from_json(line) for line in f if line.strip()]
+    events.sort(key=lambda e: e.timestamp_ns)
+    return events
+
+
+def synthetic_bond(cusip: str, term: str, years: int, issue_date: dt.date) -> USTreasurySecurity:
+    """Minimal Treasury Direct record, enough for get_bonds_info style filtering and contract creation"""
+    maturity = issue_date.replace(year=issue_date.year + years)
+    return USTreasurySecurity.from_dict({'cusip': cusip, 'issueDate': f'{issue_date}T00:00:00', 'securityType': 'Note',
+                                         'securityTerm': term, 'maturityDate': f'{maturity}T00:00:00', 'interestRate': '3.000000',
+                                         'auctionDate': f'{issue_date}T00:00:00', 'type': 'Note'})
+
+
+def synthetic_scenario(history_bars: int = 2000, session_quotes: int = 20000, bar_interval: int = 3, seed: int = 0) -> ReplayScenario:
+    """Five Treasury tenors driven by one level factor so that the pairs are cointegrated and spreads mean revert.
+    Live quotes are 100 ms apart, bars bar_interval minutes apart."""
+    rng = np.random.default_rng(seed)
+    terms = [('2-Year', 2), ('5-Year', 5), ('10-Year', 10), ('20-Year', 20), ('30-Year', 30)]
+    issue_date = dt.date.today() - dt.timedelta(days=60)
+    bonds = [synthetic_bond(f'91282C{i:03d}', term, years, issue_date) for i, (term, years) in enumerate(terms)]
+    bar_ns = bar_interval*60*NANOSECONDS_PER_SECOND
+    quote_ns = NANOSECONDS_PER_SECOND // 10
+    session_start_ns = int(np.datetime64(dt.datetime.now().replace(microsecond=0), 'ns').astype(np.int64))
+    history_start_ns = session_start_ns - history_bars*bar_ns
+    history_steps = history_bars
+    session_steps = session_quotes // len(bonds)
+    factor = np.cumsum(rng.normal(0, 0.04, history_steps + session_steps))
+    events: list[ReplayEvent] = []
+    for i, bond in enumerate(bonds):
+        duration = 1.5 + 3*i
+        mid = 100 - 0.5*i + 0.1*duration*factor + rng.normal(0, 0.02, len(factor))
+        for step in range(history_steps):
+            price = round(float(mid[step]), 4)
+            events.append(ReplayEvent(history_start_ns + step*bar_ns, bond.cusip, BAR,
+                                      {'open': price, 'high': price, 'low': price, 'close': price, 'volume': 0, 'wap': price, 'bar_count': 0}))
+        half_spread = 0.01 + 0.005*i
+        for step in range(session_steps):
+            price = float(mid[history_steps + step])
+            timestamp = session_start_ns + (step*len(bonds) + i)*quote_ns
+            events.append(ReplayEvent(timestamp, bond.cusip, QUOTE, {'bid_price': round(price - half_spread, 4), 'ask_price': round(price + half_spread, 4),
+                                                                     'bid_size': float(rng.integers(1, 50)*100), 'ask_size': float(rng.integers(1, 50)*100)}))
+    events.sort(key=lambda e: e.timestamp_ns)
+    return ReplayScenario(bonds, events, session_start_ns, bar_interval)
+
+
+def scenario_from_events(bonds: list[USTreasurySecurity], events: list[ReplayEvent], session_start_ns: Optional[int] = None, bar_interval: int = 3) -> ReplayScenario:
+    """Wraps recorded events, the session starts at the first quote unless given"""
+    if session_start_ns is None:
+        quotes = [e.timestamp_ns for e in events if e.kind == QUOTE]
+        session_start_ns = min(quotes) if quotes else events[-1].timestamp_ns + 1
+    return ReplayScenario(bonds, events, session_start_ns, bar_interval)
@@ -0,0 +1,222 @@
+import socket
+import threading
+import time
+from decimal import Decimal
+from typing import Optional
+from ibapi.comm import make_field_handle_empty, make_msg, read_fields, read_msg
+from ibapi.contract import Contract
+from ibapi.message import IN, OUT
+from ibapi.order import Order
+from ibapi.ticktype import TickTypeEnum
+from log_config import log
+from replay.broker import SimulatedBroker
+
+# wire protocol version spoken by the stand-in, supported by every ibapi 10.x client
+SERVER_VERSION = 163
+TICK_TYPES = ('tickPrice', 'tickSize', 'tickByTickBidAsk')
+
+
+def _fields(*values) -> str:
+    return ''.join(make_field_handle_empty(value) for value in values)
+
+
+def _size(value: Decimal) -> str:
+    return str(value)
+
+
+def _contract_from_fields(fields: list[str], start: int) -> Contract:
+    """Reads the conId, symbol, secType, lastTradeDate ... block that most client requests carry"""
+    contract = Contract()
+    contract.conId = int(fields[start] or 0)
+    contract.symbol = fields[start + 1]
+    contract.secType = fields[start + 2]
+    contract.lastTradeDateOrContractMonth = fields[start + 3]
+    return contract
+
+
+class FakeGateway:
+    """Local TCP stand-in for TWS / IB gateway speaking the IB socket protocol at SERVER_VERSION.
+    It decodes the client requests TradingApp uses, hands them to a SimulatedBroker and encodes the
+    broker callbacks back into IB messages, so the app runs unmodified through EClient.connect and run."""
+
+    def __init__(self, broker: SimulatedBroker, host: str = '127.0.0.1', port: int = 0):
+        self.broker = broker
+        broker.emit = self.emit
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(1)
+        self.port: int = self.server.getsockname()[1]
+        self.client: Optional[socket.socket] = None
+        self.send_lock = threading.Lock()
+        self.callbacks_sent = 0
+        self.pending_bars: dict[int, list] = {}
+        self.thread = threading.Thread(target=self.serve, name='FakeGateway', daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        for sock in (self.client, self.server):
+            if sock:
+                try:
+                    sock.close()
+                except OSError:
+                    pass
+
+    def serve(self) -> None:
+        self.client, _ = self.server.accept()
+        self.client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buffer = self.client.recv(4)
+        if buffer != b'API\0':
+            log.error('Fake gateway: unexpected handshake')
+            return
+        buffer = b''
+        handshake_done = False
+        while True:
+            try:
+                data = self.client.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            buffer += data
+            while True:
+                size, text, buffer = read_msg(buffer)
+                if not text:
+                    break
+                if not handshake_done:
+                    # the client sends its version range, answer with the server version and connection time
+                    self.send(_fields(SERVER_VERSION, time.strftime('%Y%m%d %H:%M:%S')))
+                    handshake_done = True
+                    continue
+                fields = [field.decode() for field in read_fields(text)]
+                self.handle_request(fields)
+
+    def send(self, text: str) -> None:
+        with self.send_lock:
+            self.client.sendall(make_msg(text))
+
+    def handle_request(self, fields: list[str]) -> None:
+        message_id = int(fields[0])
+        broker = self.broker
+        match message_id:
+            case OUT.START_API:
+                broker.start_api()
+            case OUT.REQ_POSITIONS:
+                broker.req_positions()
+            case OUT.REQ_ACCOUNT_SUMMARY:
+                broker.req_account_summary(int(fields[2]))
+            case OUT.REQ_OPEN_ORDERS:
+                broker.req_open_orders()
+            case OUT.REQ_CONTRACT_DATA:
+                broker.req_contract_details(int(fields[2]), _contract_from_fields(fields, 3))
+            case OUT.REQ_HISTORICAL_DATA:
+                # reqId, 12 contract fields, includeExpired, endDateTime, barSize, duration, useRTH, whatToShow, formatDate, keepUpToDate
+                broker.req_historical_data(int(fields[1]), _contract_from_fields(fields, 2), fields[21] == '1')
+            case OUT.REQ_MKT_DATA:
+                broker.req_mkt_data(int(fields[2]), _contract_from_fields(fields, 3))
+            case OUT.REQ_TICK_BY_TICK_DATA:
+                broker.req_tick_by_tick(int(fields[1]), _contract_from_fields(fields, 2))
+            case OUT.PLACE_ORDER:
+                # orderId, 12 contract fields, secIdType, secId, action, totalQuantity, orderType, lmtPrice
+                order = Order()
+                order.action = fields[16]
+                order.totalQuantity = Decimal(fields[17])
+                order.orderType = fields[18]
+                if fields[19]:
+                    order.lmtPrice = float(fields[19])
+                broker.place_order(int(fields[1]), _contract_from_fields(fields, 2), order)
+            case OUT.CANCEL_ORDER:
+                # version, orderId
+                broker.cancel_order(int(fields[2]))
+            case _:
+                log.debug(f'Fake gateway ignored request {message_id}')
+
+    def emit(self, method: str, args: tuple) -> None:
+        """Encodes one EWrapper callback as the IB message that produces it"""
+        if method in TICK_TYPES:
+            self.broker.last_tick_ns = time.monotonic_ns()
+        text = getattr(self, f'_encode_{method}')(*args)
+        if text is not None:
+            self.callbacks_sent += 1
+            self.send(text)
+
+    def _encode_nextValidId(self, order_id):
+        return _fields(IN.NEXT_VALID_ID, 1, order_id)
+
+    def _encode_managedAccounts(self, accounts):
+        return _fields(IN.MANAGED_ACCTS, 1, accounts)
+
+    def _encode_error(self, req_id, code, message):
+        return _fields(IN.ERR_MSG, 2, req_id, code, message)
+
+    def _encode_position(self, account, contract, position, average_cost):
+        return _fields(IN.POSITION_DATA, 3, account, contract.conId, contract.symbol, contract.secType,
+                       contract.lastTradeDateOrContractMonth, 0.0, '', '', contract.exchange, contract.currency, '', '',
+                       _size(position), average_cost)
+
+    def _encode_positionEnd(self):
+        return _fields(IN.POSITION_END, 1)
+
+    def _encode_accountSummary(self, req_id, account, tag, value, currency):
+        return _fields(IN.ACCOUNT_SUMMARY, 1, req_id, account, tag, value, currency)
+
+    def _encode_accountSummaryEnd(self, req_id):
+        return _fields(IN.ACCOUNT_SUMMARY_END, 1, req_id)
+
+    def _encode_openOrderEnd(self):
+        return _fields(IN.OPEN_ORDER_END, 1)
+
+    def _encode_bondContractDetails(self, req_id, details):
+        contract = details.contract
+        return _fields(IN.BOND_CONTRACT_DATA, 6, req_id, contract.symbol, contract.secType, details.cusip, 0.0,
+                       contract.lastTradeDateOrContractMonth, '', '', '', '', 0, 0, 0, '', contract.exchange, contract.currency,
+                       '', '', contract.conId, 0.0001, 1, '', '', '', '', 0, '', '', '', 0, 0, 0, '')
+
+    def _encode_contractDetailsEnd(self, req_id):
+        return _fields(IN.CONTRACT_DATA_END, 1, req_id)
+
+    def _encode_historicalData(self, req_id, bar):
+        # IB sends a whole history in one message and the decoder treats its end as historicalDataEnd
+        self.pending_bars.setdefault(req_id, []).append(bar)
+        return None
+
+    def _encode_historicalDataEnd(self, req_id, start, end):
+        bars = self.pending_bars.pop(req_id, [])
+        values = [IN.HISTORICAL_DATA, req_id, start, end, len(bars)]
+        for bar in bars:
+            values += [bar.date, bar.open, bar.high, bar.low, bar.close, _size(bar.volume), _size(bar.wap), bar.barCount]
+        return _fields(*values)
+
+    def _encode_historicalDataUpdate(self, req_id, bar):
+        return _fields(IN.HISTORICAL_DATA_UPDATE, req_id, bar.barCount, bar.date, bar.open, bar.close, bar.high, bar.low,
+                       _size(bar.wap), _size(bar.volume))
+
+    def _encode_tickPrice(self, req_id, tick_type, price, attrib):
+        size_key = 'bid_size' if tick_type == TickTypeEnum.BID else 'ask_size'
+        size = self.broker.books.get(self.broker.request_symbols.get(req_id), {}).get(size_key, 0)
+        return _fields(IN.TICK_PRICE, 6, req_id, tick_type, price, _size(Decimal(str(size))), 0)
+
+    def _encode_tickSize(self, req_id, tick_type, size):
+        return _fields(IN.TICK_SIZE, 6, req_id, tick_type, _size(size))
+
+    def _encode_tickByTickBidAsk(self, req_id, tick_time, bid_price, ask_price, bid_size, ask_size, attrib):
+        return _fields(IN.TICK_BY_TICK, req_id, 3, tick_time, bid_price, ask_price, _size(bid_size), _size(ask_size), 0)
+
+    def _encode_orderStatus(self, order_id, status, filled, remaining, average_price, perm_id, parent_id, last_price, client_id, why_held, cap_price):
+        return _fields(IN.ORDER_STATUS, order_id, status, _size(filled), _size(remaining), average_price, perm_id, parent_id,
+                       last_price, client_id, why_held, cap_price)
+
+    def _encode_execDetails(self, req_id, contract, execution):
+        # the pnl engine matches the commission report to this execution by execId
+        return _fields(IN.EXECUTION_DATA, req_id, execution.orderId, contract.conId, contract.symbol, contract.secType,
+                       contract.lastTradeDateOrContractMonth, 0.0, '', '', contract.exchange, contract.currency, '', '',
+                       execution.execId, '', execution.acctNumber, '', execution.side, _size(execution.shares),
+                       execution.price, execution.orderId, 0, 0, _size(execution.cumQty), execution.avgPrice, '', '', '',
+                       '', 0)
+
+    def _encode_commissionReport(self, report):
+        # TWS sends unset doubles as the max double, an empty field would decode to a realized pnl of 0
+        return _fields(IN.COMMISSION_REPORT, 1, report.execId, report.commission, report.currency, str(report.realizedPNL),
+                       str(report.yield_), report.yieldRedemptionDate)
@@ -0,0 +1,77 @@
+import datetime
+import json
+import queue
+import threading
+from dataclasses import dataclass
+from typing import IO, Optional
+from others import rows_to_table
+from log_config import log
+
+# reports waiting to be written, a full queue drops new reports instead of blocking the thread that made them
+DEFAULT_QUEUE_SIZE = 1024
+
+
+@dataclass
+class Report:
+    name: str
+    title: str
+    rows: list[dict]
+    # wall clock time the rows were taken
+    timestamp: float
+
+
+class Reporter:
+    """Writes reports on its own thread: the strategy and IB reader threads only copy the rows out of their records,
+    the terminal table and the JSON line are rendered and written here. Every report is logged as a table and, when
+    json_path is set, appended to it as one JSON object per line with the report name, time and rows."""
+
+    def __init__(self, json_path: Optional[str] = None, queue_size: int = DEFAULT_QUEUE_SIZE):
+        self.json_path = json_path
+        self.queue: queue.Queue[Optional[Report]] = queue.Queue(queue_size)
+        self.dropped = 0
+        self._json_file: Optional[IO[str]] = None
+        self._thread = threading.Thread(target=self.run, name='Reporter', daemon=True)
+        self._thread.start()
+
+    def report(self, name: str, title: str, rows: list[dict]) -> None:
+        """Queues rows that are not touched again by the caller, nothing is rendered on the calling thread"""
+        if not rows:
+            return
+        try:
+            self.queue.put_nowait(Report(name, title, rows, datetime.datetime.now().timestamp()))
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self) -> None:
+        while True:
+            report = self.queue.get()
+            try:
+                if report is None:
+                    return
+                self.write(report)
+            except Exception as e:
+                log.error(f'Failed to write report {report.name}: {e}')
+            finally:
+                self.queue.task_done()
+
+    def write(self, report: Report) -> None:
+        log.info(f'{report.title}: \n{rows_to_table(report.rows)}')
+        if self.json_path is None:
+            return
+        if self._json_file is None:
+            self._json_file = open(self.json_path, 'a')
+        self._json_file.write(json.dumps({'report': report.name, 'timestamp': report.timestamp, 'rows': report.rows}, default=str) + '\n')
+        self._json_file.flush()
+
+    def flush(self) -> None:
+        """Waits until every queued report is written"""
+        self.queue.join()
+
+    def close(self) -> None:
+        if not self._thread.is_alive():
+            return
+        self.queue.put(None)
+        self._thread.join()
+        if self._json_file is not None:
+            self._json_file.close()
+            self._json_file = None
@@ -0,0 +1,107 @@
+import datetime
+import threading
+from typing import Iterator, Optional
+from ibapi.contract import Contract
+from data_requests import DataRequest, RequestState, Subscription
+
+
+class RequestRegistry:
+    """Requests by request id and by (conId or symbol, DataRequest), so that dedup and callback lookups are O(1).
+    Tracks the state of every request and the time it took to complete."""
+
+    def __init__(self, first_request_id: int = 1):
+        self._next_id = first_request_id
+        self._by_id: dict[int, Subscription] = {}
+        self._by_key: dict[tuple, int] = {}
+        self._pending: dict[int, None] = {}
+        self._lock = threading.Lock()
+
+    def add(self, subscription: Subscription) -> int:
+        """Registers the subscription unless an equal one exists, returns the request id in both cases"""
+        key = subscription.key()
+        with self._lock:
+            if key in self._by_key:
+                return self._by_key[key]
+            request_id = self._next_id
+            self._next_id += 1
+            self._by_id[request_id] = subscription
+            self._by_key[key] = request_id
+            self._pending[request_id] = None
+            return request_id
+
+    def find(self, contract: Optional[Contract], data_type: DataRequest) -> Optional[int]:
+        return self._by_key.get(Subscription(data_type, contract, '').key())
+
+    def __contains__(self, item) -> bool:
+        if isinstance(item, Subscription):
+            return item.key() in self._by_key
+        return item in self._by_id
+
+    def __getitem__(self, request_id: int) -> Subscription:
+        return self._by_id[request_id]
+
+    def get(self, request_id: int) -> Optional[Subscription]:
+        return self._by_id.get(request_id)
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(list(self._by_id))
+
+    def items(self) -> list[tuple[int, Subscription]]:
+        return list(self._by_id.items())
+
+    def values(self) -> list[Subscription]:
+        return list(self._by_id.values())
+
+    def pending(self) -> list[tuple[int, Subscription]]:
+        with self._lock:
+            return [(request_id, self._by_id[request_id]) for request_id in self._pending]
+
+    def mark_sent(self, request_id: int) -> None:
+        request = self._by_id[request_id]
+        request.was_sent = True
+        request.state = RequestState.Sent
+        request.send_time = datetime.datetime.now().timestamp()
+        with self._lock:
+            self._pending.pop(request_id, None)
+
+    def requeue(self, request_id: int) -> None:
+        """Puts a sent request back in the pending set so it is sent again"""
+        request = self._by_id[request_id]
+        request.was_sent = False
+        request.state = RequestState.Pending
+        request.send_time = None
+        with self._lock:
+            self._pending[request_id] = None
+
+    def mark_complete(self, request_id: int) -> None:
+        """First completion wins, later data on a streaming request leaves the timing alone"""
+        request = self._by_id.get(request_id)
+        if request is not None and request.state == RequestState.Sent:
+            request.state = RequestState.Complete
+            request.complete_time = datetime.datetime.now().timestamp()
+
+    def mark_type_complete(self, data_type: DataRequest) -> None:
+        """For account wide requests whose end callbacks carry no request id (positions, open orders)"""
+        self.mark_complete(self._by_key.get((None, data_type)))
+
+    def mark_errored(self, request_id: int, error_code: int) -> None:
+        request = self._by_id.get(request_id)
+        if request is not None:
+            request.state = RequestState.Errored
+            request.error_code = error_code
+            request.complete_time = datetime.datetime.now().timestamp()
+
+    def latencies(self) -> dict[int, float]:
+        """Round trip seconds of every completed request"""
+        return {request_id: request.latency() for request_id, request in self._by_id.items() if request.latency() is not None}
+
+    def summary_rows(self) -> list[dict]:
+        rows = []
+        for request_id, request in self._by_id.items():
+            latency = request.latency()
+            rows.append({'id': request_id, 'name': request.name, 'type': str(request.data_type), 'state': str(request.state),
+                         'latency_ms': round(1000*latency, 1) if latency is not None else None, 'error': request.error_code})
+        return rows
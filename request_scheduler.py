@@ -0,0 +1,157 @@
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+from data_requests import DataRequest, Subscription
+
+# lower goes first: market data and account data, then contract details, then history
+PRIORITIES = {DataRequest.QuoteData: 0, DataRequest.TickData: 0, DataRequest.MarketDepth: 0, DataRequest.Positions: 0,
+              DataRequest.Orders: 0, DataRequest.Account: 0, DataRequest.Executions: 0,
+              DataRequest.ContractInfo: 1, DataRequest.HistoricalData: 2}
+# 100: max rate of messages per second exceeded, 420: invalid real-time query (pacing violation)
+PACING_ERROR_CODES = {100, 420}
+# 162 is also used for permission and no data errors, only its pacing violation variant is retried
+HISTORICAL_PACING_ERROR_CODE = 162
+
+
+class TokenBucket:
+    """Allows rate requests per second on average with bursts of up to capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated)*self.rate)
+        self.updated = now
+
+    def try_take(self, now: float, count: int = 1) -> bool:
+        self._refill(now)
+        if self.tokens >= count:
+            self.tokens -= count
+            return True
+        return False
+
+    def seconds_until_token(self, now: float, count: int = 1) -> float:
+        self._refill(now)
+        return 0.0 if self.tokens >= count else (count - self.tokens)/self.rate
+
+    def drain(self, now: float) -> None:
+        """Empties the bucket after IB reported a pacing violation"""
+        self._refill(now)
+        self.tokens = 0
+
+
+@dataclass
+class SchedulerMetrics:
+    sent: dict[str, int] = field(default_factory=dict)
+    retries: int = 0
+    pacing_errors: int = 0
+    abandoned: int = 0
+    max_queue_seconds: float = 0.0
+    total_queue_seconds: float = 0.0
+
+    def as_dict(self) -> dict:
+        sent = sum(self.sent.values())
+        return {'sent': dict(self.sent), 'retries': self.retries, 'pacing_errors': self.pacing_errors, 'abandoned': self.abandoned,
+                'max_queue_seconds': round(self.max_queue_seconds, 3),
+                'average_queue_seconds': round(self.total_queue_seconds/sent, 3) if sent else 0.0}
+
+
+class RequestScheduler:
+    """Decides which pending requests TradingApp may send now.
+    Every request takes a token from the message bucket, historical requests are also limited by the number
+    in flight and optionally by a historical request bucket. Requests rejected for pacing are retried with backoff."""
+
+    def __init__(self, messages_per_second: float = 40, max_historical_in_flight: int = 50,
+                 historical_requests_per_10_minutes: Optional[int] = None, max_retries: int = 5, retry_delay: float = 2.0):
+        self.messages = TokenBucket(messages_per_second, messages_per_second)
+        self.historical = TokenBucket(historical_requests_per_10_minutes/600, historical_requests_per_10_minutes) \
+            if historical_requests_per_10_minutes else None
+        self.max_historical_in_flight = max_historical_in_flight
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.historical_in_flight: set[int] = set()
+        self.not_before: dict[int, float] = {}
+        self.attempts: dict[int, int] = {}
+        self.first_seen: dict[int, float] = {}
+        self.metrics = SchedulerMetrics()
+        self._lock = threading.Lock()
+
+    def select(self, pending: list[tuple[int, Subscription]], now: Optional[float] = None) -> list[tuple[int, Subscription]]:
+        """Pending requests that may be sent now, highest priority first. Tokens are taken for the returned requests."""
+        now = time.monotonic() if now is None else now
+        selected = []
+        with self._lock:
+            for request_id, request in sorted(pending, key=lambda item: (PRIORITIES.get(item[1].data_type, 0), item[0])):
+                self.first_seen.setdefault(request_id, now)
+                if self.not_before.get(request_id, 0.0) > now:
+                    continue
+                is_historical = request.data_type == DataRequest.HistoricalData
+                if is_historical:
+                    if len(self.historical_in_flight) >= self.max_historical_in_flight:
+                        continue
+                    if self.historical and self.historical.seconds_until_token(now) > 0:
+                        continue
+                if not self.messages.try_take(now):
+                    break
+                if is_historical:
+                    if self.historical:
+                        self.historical.try_take(now)
+                    self.historical_in_flight.add(request_id)
+                self._record_sent(request_id, request, now)
+                selected.append((request_id, request))
+        return selected
+
+    def _record_sent(self, request_id: int, request: Subscription, now: float) -> None:
+        waited = now - self.first_seen.pop(request_id, now)
+        self.metrics.sent[str(request.data_type)] = self.metrics.sent.get(str(request.data_type), 0) + 1
+        self.metrics.total_queue_seconds += waited
+        self.metrics.max_queue_seconds = max(self.metrics.max_queue_seconds, waited)
+        self.not_before.pop(request_id, None)
+
+    def release(self, request_id: int) -> None:
+        """A historical request finished, successfully or not"""
+        with self._lock:
+            self.historical_in_flight.discard(request_id)
+
+    def is_pacing_error(self, error_code: int, error_string: str) -> bool:
+        return error_code in PACING_ERROR_CODES or \
+            (error_code == HISTORICAL_PACING_ERROR_CODE and 'pacing' in error_string.lower())
+
+    def retry(self, request_id: int, now: Optional[float] = None) -> Optional[float]:
+        """Schedules a request rejected for pacing, returns the backoff delay or None once max_retries is reached"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.metrics.pacing_errors += 1
+            self.historical_in_flight.discard(request_id)
+            self.messages.drain(now)
+            attempt = self.attempts.get(request_id, 0) + 1
+            if attempt > self.max_retries:
+                self.metrics.abandoned += 1
+                return None
+            self.attempts[request_id] = attempt
+            delay = self.retry_delay*2**(attempt - 1)
+            self.not_before[request_id] = now + delay
+            self.metrics.retries += 1
+            return delay
+
+    def seconds_until_next(self, pending: list[tuple[int, Subscription]], now: Optional[float] = None) -> Optional[float]:
+        """How long until one of the pending requests can go out, None when nothing is pending"""
+        if not pending:
+            return None
+        now = time.monotonic() if now is None else now
+        waits = []
+        with self._lock:
+            for request_id, request in pending:
+                wait = max(self.not_before.get(request_id, 0.0) - now, self.messages.seconds_until_token(now))
+                if request.data_type == DataRequest.HistoricalData:
+                    if len(self.historical_in_flight) >= self.max_historical_in_flight:
+                        # release() is driven by a callback, which wakes the strategy anyway
+                        continue
+                    if self.historical:
+                        wait = max(wait, self.historical.seconds_until_token(now))
+                waits.append(wait)
+        return max(0.0, min(waits)) if waits else None
@@ -0,0 +1,164 @@
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+from ibapi.contract import Contract
+from market_data.quotes import Quote
+from request_scheduler import TokenBucket
+from strategy.orders import StrategyOrder
+
+# order messages price modifications leave in the rate limit, so that a hedge goes out as soon as its leg fills
+MODIFICATION_RESERVE = 1
+
+
+def notional_per_unit(contract: Contract) -> float:
+    """Account currency per order unit and point of price, bond prices are per 100 of face value and a unit is 1000"""
+    return 10.0 if contract.secType == 'BOND' else float(contract.multiplier or 1)
+
+
+@dataclass
+class RiskLimits:
+    """Pre-trade limits, None disables a limit. Notionals are in account currency, quantities in order units."""
+    max_order_quantity: Optional[float] = None
+    max_order_notional: Optional[float] = None
+    max_instrument_notional: Optional[float] = None
+    max_account_notional: Optional[float] = None
+    max_orders_per_second: float = 10.0
+    order_burst: int = 4
+    max_open_legs: int = 2
+    max_quote_age_seconds: float = 5.0
+
+
+@dataclass
+class InstrumentLimits:
+    """Limits of one instrument resolved once, a check is then a few multiplications and comparisons"""
+    notional_per_unit: float
+    max_quantity: float
+    max_notional: float
+
+
+@dataclass
+class RiskMetrics:
+    checked: int = 0
+    rejected: dict[str, int] = field(default_factory=dict)
+
+    def as_dict(self) -> dict:
+        return {'checked': self.checked, 'rejected': dict(self.rejected)}
+
+    def is_worth_logging(self, reason: str) -> bool:
+        """A strategy retries on every tick while a limit holds, only the first and every 100th rejection are logged"""
+        count = self.rejected.get(reason, 0)
+        return count == 1 or count % 100 == 0
+
+
+class RiskGate:
+    """Checks orders right before placeOrder against precomputed limits: fat finger quantity, order and exposure
+    notional, order rate, working legs and quote staleness. Exposure is the position plus the working orders.
+    Orders that reduce exposure are only held to the quantity and rate limits, so positions can always be closed."""
+
+    def __init__(self, limits: Optional[RiskLimits] = None):
+        self.limits = limits or RiskLimits()
+        self.instruments: dict[int, InstrumentLimits] = {}
+        self.orders = TokenBucket(self.limits.max_orders_per_second, self.limits.order_burst)
+        # signed quantity of the working orders by conId, and the number of working orders
+        self.working_quantity: dict[int, float] = {}
+        self.open_legs = 0
+        self.metrics = RiskMetrics()
+        self._lock = threading.Lock()
+
+    def instrument(self, contract: Contract) -> InstrumentLimits:
+        limits = self.instruments.get(contract.conId)
+        if limits is None:
+            limits = InstrumentLimits(notional_per_unit(contract), self.limits.max_order_quantity or float('inf'),
+                                      self.limits.max_instrument_notional or float('inf'))
+            self.instruments[contract.conId] = limits
+        return limits
+
+    def check(self, orders: list[StrategyOrder], positions: dict, quotes: dict[int, Quote], position_notional: float = 0.0) -> Optional[str]:
+        """Reason to reject a burst of orders, all legs are sent or none. Positions and quotes are TradingApp's,
+        position_notional the gross exposure of the pnl engine."""
+        now_ns = time.monotonic_ns()
+        with self._lock:
+            self.metrics.checked += 1
+            reason = self._check(orders, positions, quotes, position_notional, now_ns)
+            if reason is not None:
+                self.metrics.rejected[reason] = self.metrics.rejected.get(reason, 0) + 1
+            return reason
+
+    def _check(self, orders: list[StrategyOrder], positions: dict, quotes: dict[int, Quote], position_notional: float, now_ns: int) -> Optional[str]:
+        limits = self.limits
+        if self.open_legs + len(orders) > limits.max_open_legs:
+            return 'max_open_legs'
+        added_notional = 0.0
+        for order in orders:
+            instrument = self.instrument(order.contract)
+            quantity = float(order.order.totalQuantity)
+            if quantity > instrument.max_quantity:
+                return 'fat_finger_quantity'
+            con_id = order.contract.conId
+            position = positions.get(con_id)
+            exposure = (float(position.quantity) if position else 0.0) + self.working_quantity.get(con_id, 0.0)
+            after = exposure + (quantity if order.order.action == 'BUY' else -quantity)
+            if abs(after) <= abs(exposure):
+                continue
+            quote = quotes.get(con_id)
+            snapshot = quote.snapshot() if quote is not None else None
+            if snapshot is None or not snapshot.is_valid(limits.max_quote_age_seconds, now_ns):
+                return 'stale_quote'
+            price = snapshot.mid_price*instrument.notional_per_unit
+            if limits.max_order_notional is not None and quantity*price > limits.max_order_notional:
+                return 'max_order_notional'
+            if abs(after)*price > instrument.max_notional:
+                return 'max_instrument_notional'
+            added_notional += (abs(after) - abs(exposure))*price
+        if limits.max_account_notional is not None and added_notional > 0 and \
+                self.account_notional(position_notional, quotes) + added_notional > limits.max_account_notional:
+            return 'max_account_notional'
+        if not self.orders.try_take(now_ns/1e9, len(orders)):
+            return 'max_orders_per_second'
+        return None
+
+    def allow_modification(self) -> bool:
+        """A price change of a working order costs an order message like a new order, it waits while the rate limit holds"""
+        with self._lock:
+            now = time.monotonic_ns()/1e9
+            allowed = self.orders.seconds_until_token(now, 1 + MODIFICATION_RESERVE) == 0 and self.orders.try_take(now)
+            if not allowed:
+                self.metrics.rejected['modification_rate'] = self.metrics.rejected.get('modification_rate', 0) + 1
+            return allowed
+
+    def seconds_until_orders(self, count: int) -> float:
+        """Wait before the rate limit lets count orders through"""
+        with self._lock:
+            return self.orders.seconds_until_token(time.monotonic_ns()/1e9, count)
+
+    def account_notional(self, position_notional: float, quotes: dict[int, Quote]) -> float:
+        """Gross notional of the positions, kept up to date by the pnl engine, plus the working orders at their latest
+        mid prices. Working orders that reduce a position are counted too, which errs on the safe side."""
+        notional = position_notional
+        for con_id, quantity in self.working_quantity.items():
+            quote = quotes.get(con_id)
+            instrument = self.instruments.get(con_id)
+            if quote is None or quote.mid_price is None or instrument is None:
+                continue
+            notional += abs(quantity)*quote.mid_price*instrument.notional_per_unit
+        return notional
+
+    def on_sent(self, order: StrategyOrder) -> None:
+        quantity = float(order.order.totalQuantity)
+        with self._lock:
+            con_id = order.contract.conId
+            self.working_quantity[con_id] = self.working_quantity.get(con_id, 0.0) + (quantity if order.order.action == 'BUY' else -quantity)
+            self.open_legs += 1
+
+    def on_done(self, order: StrategyOrder) -> None:
+        """A sent order reached a terminal status, its fill, complete or partial, is in the positions from now on"""
+        quantity = float(order.order.totalQuantity)
+        with self._lock:
+            con_id = order.contract.conId
+            remaining = self.working_quantity.get(con_id, 0.0) - (quantity if order.order.action == 'BUY' else -quantity)
+            if remaining:
+                self.working_quantity[con_id] = remaining
+            else:
+                self.working_quantity.pop(con_id, None)
+            self.open_legs = max(0, self.open_legs - 1)
@@ -0,0 +1,150 @@
+import datetime
+import os
+import pickle
+import queue
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+from data_requests import Subscription
+from market_data.quotes import Quote, QuoteSnapshot
+from strategy.status import StrategyStatus
+from log_config import log
+
+# bump when a field is added, removed or changes meaning, snapshots of another version are ignored
+SNAPSHOT_VERSION = 6
+DEFAULT_SNAPSHOT_PATH = 'runtime_state.snapshot'
+# a process restarted in one of these states resumes there, in any other state it starts over
+RESUMABLE_STATUSES = {StrategyStatus.WAITING_FOR_TRADES, StrategyStatus.SENT_ENTRY_ORDERS,
+                      StrategyStatus.IN_A_TRADE, StrategyStatus.SENT_EXIT_ORDERS}
+
+
+@dataclass
+class RuntimeSnapshot:
+    """Everything TradingApp needs to resume without walking through INITIALIZED and AWARE_OF_ACCOUNT again"""
+    status: StrategyStatus
+    # running PairStrategy objects by pair key, with their statistics, orders, positions and trades
+    strategies: dict
+    order_strategies: dict[int, str]
+    trades: list
+    orders: dict
+    positions: dict
+    bonds_general_info: list
+    buying_powers: dict[str, float]
+    # quotes with last_update_ns replaced by a wall clock time, monotonic clocks do not survive a restart
+    quotes: dict[int, QuoteSnapshot]
+    subscriptions: list[Subscription]
+    version: int = SNAPSHOT_VERSION
+    sequence: int = 0
+    written_at: float = field(default_factory=lambda: datetime.datetime.now().timestamp())
+
+    def is_resumable(self) -> bool:
+        return self.version == SNAPSHOT_VERSION and (self.status in RESUMABLE_STATUSES or bool(self.strategies))
+
+
+def wall_clock_quote(quote: Quote, now_ns: int, now_wall_ns: int) -> QuoteSnapshot:
+    snapshot = quote.snapshot()
+    if snapshot.last_update_ns is None:
+        return snapshot
+    return snapshot._replace(last_update_ns=now_wall_ns - (now_ns - snapshot.last_update_ns))
+
+
+def restored_quote(snapshot: QuoteSnapshot, now_ns: int, now_wall_ns: int) -> Quote:
+    """Quote with the age it had in the snapshot, so stale prices stay stale"""
+    quote = Quote()
+    quote.bid_price, quote.ask_price, quote.bid_size, quote.ask_size, quote.mid_price = snapshot[:5]
+    if snapshot.last_update_ns is not None:
+        quote.last_update_ns = now_ns - (now_wall_ns - snapshot.last_update_ns)
+    return quote
+
+
+class SnapshotStore:
+    """Writes snapshots atomically: the pickle goes to a temporary file in the same directory, is flushed to disk
+    and renamed over the previous snapshot, so a crash leaves either the old or the new file, never a torn one.
+    The caller only pickles, the file is written on the store's own thread, which skips to the newest pickle when
+    several are waiting."""
+
+    def __init__(self, path: str = DEFAULT_SNAPSHOT_PATH):
+        self.path = path
+        self.sequence = 0
+        self.queue: queue.Queue[Optional[bytes]] = queue.Queue()
+        self._thread = threading.Thread(target=self.run, name='SnapshotWriter', daemon=True)
+        self._thread.start()
+
+    def write(self, snapshot: RuntimeSnapshot) -> None:
+        """Pickles the snapshot right away, the caller holds whatever lock keeps its state still meanwhile"""
+        self.sequence += 1
+        snapshot.sequence = self.sequence
+        try:
+            self.queue.put(pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL))
+        except Exception as e:
+            log.error(f'Error pickling snapshot {self.sequence}: {e}')
+
+    def run(self) -> None:
+        while True:
+            data = self.queue.get()
+            closing = data is None
+            taken = 1
+            # an older pickle waiting behind a newer one is never written, close waits behind the last one
+            while not self.queue.empty():
+                newer = self.queue.get()
+                taken += 1
+                if newer is None:
+                    closing = True
+                else:
+                    data = newer
+            try:
+                if data is not None:
+                    self.write_file(data)
+            finally:
+                for _ in range(taken):
+                    self.queue.task_done()
+            if closing:
+                return
+
+    def write_file(self, data: bytes) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        handle, temporary = tempfile.mkstemp(prefix='.snapshot_', dir=directory)
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, self.path)
+        except Exception as e:
+            log.error(f'Error writing snapshot {self.path}: {e}')
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+
+    def flush(self) -> None:
+        """Waits until the newest snapshot is on disk"""
+        self.queue.join()
+
+    def close(self) -> None:
+        if not self._thread.is_alive():
+            return
+        self.queue.put(None)
+        self._thread.join()
+
+    def read(self) -> Optional[RuntimeSnapshot]:
+        try:
+            with open(self.path, 'rb') as f:
+                snapshot = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.error(f'Error reading snapshot {self.path}: {e}')
+            return None
+        if getattr(snapshot, 'version', None) != SNAPSHOT_VERSION:
+            log.info(f'Ignoring snapshot {self.path} of version {getattr(snapshot, "version", None)}, expected {SNAPSHOT_VERSION}')
+            return None
+        self.sequence = snapshot.sequence
+        return snapshot
+
+
+def clocks_ns() -> tuple[int, int]:
+    """Monotonic and wall clock nanoseconds read together, to translate quote times across processes"""
+    return time.monotonic_ns(), time.time_ns()
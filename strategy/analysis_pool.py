@@ -0,0 +1,133 @@
+import multiprocessing
+from multiprocessing.connection import Connection
+from typing import Optional
+import numpy as np
+from log_config import log
+
+INITIAL_CAPACITY = 1024
+
+
+class ResidentPrices:
+    """Aligned (instruments x bars) close matrix kept by a worker, grown in place by appended bar columns"""
+
+    def __init__(self, names: list[str], timestamps: np.ndarray, closes: np.ndarray):
+        self.names = names
+        self.size = 0
+        capacity = max(INITIAL_CAPACITY, 2*len(timestamps))
+        self._timestamps = np.empty(capacity, dtype=np.int64)
+        self._closes = np.empty((len(names), capacity))
+        self.append(timestamps, closes)
+
+    def append(self, timestamps: np.ndarray, closes: np.ndarray) -> None:
+        """Adds bar columns, columns at or after the first new timestamp are replaced"""
+        if not len(timestamps):
+            return
+        self.size = int(np.searchsorted(self._timestamps[:self.size], timestamps[0]))
+        needed = self.size + len(timestamps)
+        if needed > len(self._timestamps):
+            capacity = 2*needed
+            self._timestamps = np.concatenate((self._timestamps[:self.size], np.empty(capacity - self.size, dtype=np.int64)))
+            self._closes = np.concatenate((self._closes[:, :self.size], np.empty((len(self.names), capacity - self.size))), axis=1)
+        self._timestamps[self.size:needed] = timestamps
+        self._closes[:, self.size:needed] = closes
+        self.size = needed
+
+    @property
+    def closes(self) -> np.ndarray:
+        return self._closes[:, :self.size]
+
+
+def _worker_main(connection: Connection) -> None:
+    """Worker loop, the scoring imports happen once when the worker starts"""
+    from strategy.pair_scoring import score_pairs
+    prices: Optional[ResidentPrices] = None
+    connection.send(('ready', None))
+    while True:
+        try:
+            command, args = connection.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            match command:
+                case 'load':
+                    prices = ResidentPrices(*args)
+                    connection.send(('ok', prices.size))
+                case 'append':
+                    prices.append(*args)
+                    connection.send(('ok', prices.size))
+                case 'score':
+                    pairs, rolling_window = args
+                    connection.send(('ok', score_pairs(prices.names, prices.closes, rolling_window, pairs)))
+                case 'stop':
+                    return
+        except Exception as e:
+            connection.send(('error', repr(e)))
+
+
+class PairAnalysisPool:
+    """Long lived worker processes for pair scoring, owned by TradingApp.
+    Workers are started once with the scoring code imported and keep the aligned price matrix resident,
+    later calls only ship the bar columns added since the previous call and the pair indices to score."""
+
+    def __init__(self, workers: int):
+        context = multiprocessing.get_context('spawn')
+        self.connections: list[Connection] = []
+        self.processes = []
+        for i in range(workers):
+            parent_end, worker_end = context.Pipe()
+            process = context.Process(target=_worker_main, args=(worker_end,), name=f'PairAnalysis-{i}', daemon=True)
+            process.start()
+            worker_end.close()
+            self.connections.append(parent_end)
+            self.processes.append(process)
+        self.names: Optional[list[str]] = None
+        self.timestamps = np.empty(0, dtype=np.int64)
+        for connection in self.connections:
+            connection.recv()
+        log.info(f'Pair analysis pool ready with {workers} workers')
+
+    def _broadcast(self, command: str, args: tuple) -> None:
+        for connection in self.connections:
+            connection.send((command, args))
+        for connection in self.connections:
+            self._reply(connection)
+
+    def _reply(self, connection: Connection):
+        status, value = connection.recv()
+        if status == 'error':
+            raise RuntimeError(f'Pair analysis worker failed: {value}')
+        return value
+
+    def sync(self, names: list[str], timestamps: np.ndarray, closes: np.ndarray) -> None:
+        """Brings the resident matrices up to date, sending the whole matrix only when the universe or the
+        history before the last known bar changed"""
+        known = len(self.timestamps)
+        unchanged = (names == self.names and known and len(timestamps) >= known
+                     and np.array_equal(timestamps[:known - 1], self.timestamps[:known - 1]))
+        if unchanged:
+            start = known - 1
+            self._broadcast('append', (timestamps[start:], closes[:, start:]))
+        else:
+            self._broadcast('load', (list(names), timestamps, closes))
+            self.names = list(names)
+        self.timestamps = timestamps.copy()
+
+    def score(self, pairs: np.ndarray, rolling_window: int) -> list[dict]:
+        """score_pairs over the resident matrix, pairs are split across the workers and results keep their order"""
+        chunks = [chunk for chunk in np.array_split(pairs, len(self.connections)) if len(chunk)]
+        for connection, chunk in zip(self.connections, chunks):
+            connection.send(('score', (chunk, rolling_window)))
+        results: list[dict] = []
+        for connection, _ in zip(self.connections, chunks):
+            results.extend(self._reply(connection))
+        return results
+
+    def close(self) -> None:
+        for connection in self.connections:
+            try:
+                connection.send(('stop', None))
+                connection.close()
+            except OSError:
+                pass
+        for process in self.processes:
+            process.join(timeout=1)
@@ -0,0 +1,200 @@
+"""Vectorized backtest of the strategy_loop pairs rule over historical bars.
+
+The state machine WAITING_FOR_TRADES -> SENT_ENTRY_ORDERS -> IN_A_TRADE -> SENT_EXIT_ORDERS is replayed bar by bar:
+- entry when the bid/ask true spread (calculate_true_spread) crosses the StrategyParameters band on the side of the mean
+  the mid price spread is on, selling the spread above the top band and buying it below the bottom band
+- exit when the mid price spread crosses the rolling mean, closing both legs at market
+- calculate_position_sizes quantities and bond pnl of 10x the price move per bond
+
+Signals are computed for the whole history with array operations, only the entry/exit sequencing walks the
+candidate indices. Historical bars are MIDPOINT bars, bid and ask are modelled as mid -/+ a fixed half spread per leg.
+"""
+import itertools
+from dataclasses import dataclass
+from typing import Optional
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from market_data.bar_store import BarStore
+from strategy.positions import position_sizes
+
+NANOSECONDS_PER_MINUTE = 60*10**9
+SELL_THE_SPREAD = 'sell'
+BUY_THE_SPREAD = 'buy'
+
+
+@dataclass
+class BacktestSettings:
+    buying_power: float = 1_000_000
+    percent_of_account_to_use: float = 50
+    bond_1_half_spread: float = 0.01
+    bond_2_half_spread: float = 0.01
+    commission_per_bond: float = 0.0
+    # share of the bars used as the history find_pairs_trades sees, trading starts after it
+    training_fraction: float = 0.5
+
+    def money_available(self) -> float:
+        return self.buying_power*self.percent_of_account_to_use/100
+
+
+@dataclass
+class BacktestResult:
+    trades: pd.DataFrame
+    summary: pd.DataFrame
+
+
+def resample_closes(timestamps: np.ndarray, closes: np.ndarray, bar_interval: int) -> tuple[np.ndarray, np.ndarray]:
+    """Last close of every bar_interval minute bucket, closes is (series x bars)"""
+    buckets = timestamps // (bar_interval*NANOSECONDS_PER_MINUTE)
+    last = np.flatnonzero(np.append(buckets[1:] != buckets[:-1], True))
+    return timestamps[last], closes[:, last]
+
+
+def training_hedge_ratio(close_1: np.ndarray, close_2: np.ndarray) -> float:
+    """OLS slope without intercept over the first half of the data, rounded as is_cointegrated does"""
+    half = len(close_1)//2
+    x, y = close_1[:half], close_2[:half]
+    return round(float(x @ y)/float(y @ y), 2)
+
+
+def rolling_spread_bands(spread: np.ndarray, rolling_window: int) -> tuple[np.ndarray, np.ndarray]:
+    """Mean and std of the previous rolling_window spreads at every bar, rounded like update_spread_statistics.
+    Bars without a full window are nan."""
+    shifted = spread - spread[0]
+    sums = np.concatenate(([0.0], np.cumsum(shifted)))
+    squares = np.concatenate(([0.0], np.cumsum(shifted*shifted)))
+    window_sum = sums[rolling_window:-1] - sums[:-rolling_window - 1]
+    window_squares = squares[rolling_window:-1] - squares[:-rolling_window - 1]
+    mean = np.full(len(spread), np.nan)
+    std = np.full(len(spread), np.nan)
+    mean[rolling_window:] = window_sum/rolling_window + spread[0]
+    variance = (window_squares - window_sum*window_sum/rolling_window)/(rolling_window - 1)
+    std[rolling_window:] = np.sqrt(np.maximum(variance, 0.0))
+    return np.round(mean, 2), np.round(std, 2)
+
+
+def _walk_trades(entries: np.ndarray, exits: np.ndarray, start: int) -> tuple[np.ndarray, np.ndarray, bool]:
+    """Pairs every entry with the first exit after it, the next entry can only come after that exit"""
+    entry_bars, exit_bars = [], []
+    cursor = start
+    open_at_end = False
+    while True:
+        i = np.searchsorted(entries, cursor)
+        if i == len(entries):
+            break
+        entry = entries[i]
+        j = np.searchsorted(exits, entry + 1)
+        if j == len(exits):
+            open_at_end = True
+            break
+        entry_bars.append(entry)
+        exit_bars.append(exits[j])
+        cursor = exits[j] + 1
+    return np.array(entry_bars, dtype=np.intp), np.array(exit_bars, dtype=np.intp), open_at_end
+
+
+def _max_drawdown(pnl: np.ndarray) -> float:
+    if not len(pnl):
+        return 0.0
+    equity = np.concatenate(([0.0], np.cumsum(pnl)))
+    return float(np.max(np.maximum.accumulate(equity) - equity))
+
+
+def _run_group(timestamps: np.ndarray, closes: np.ndarray, rolling_window: int, bar_interval: int, band_ratios: list[float],
+               settings: BacktestSettings) -> tuple[list[pd.DataFrame], list[dict]]:
+    """Backtests every band ratio for one (rolling_window, bar_interval), the spread statistics are shared"""
+    times, (mid_1, mid_2) = resample_closes(timestamps, closes, bar_interval)
+    training_bars = int(settings.training_fraction*len(times))
+    start = max(training_bars, rolling_window)
+    trade_frames: list[pd.DataFrame] = []
+    summaries: list[dict] = []
+
+    def parameters(band_ratio: float, hedge_ratio: float) -> dict:
+        return {'rolling_window': rolling_window, 'band_ratio': band_ratio, 'bar_interval': bar_interval, 'hedge_ratio': hedge_ratio}
+
+    if training_bars < 4 or start >= len(times) - 1:
+        for band_ratio in band_ratios:
+            summaries.append(_summarize(parameters(band_ratio, np.nan), np.array([]), np.array([]), False))
+        return trade_frames, summaries
+    hedge_ratio = training_hedge_ratio(mid_1[:training_bars], mid_2[:training_bars])
+    bid_1, ask_1 = mid_1 - settings.bond_1_half_spread, mid_1 + settings.bond_1_half_spread
+    bid_2, ask_2 = mid_2 - settings.bond_2_half_spread, mid_2 + settings.bond_2_half_spread
+    spread = np.round(mid_1 - hedge_ratio*mid_2, 4)
+    mean, std = rolling_spread_bands(spread, rolling_window)
+    above_mean = spread > mean
+    sell_true_spread = np.round(bid_1 - hedge_ratio*ask_2, 4)
+    buy_true_spread = np.round(ask_1 - hedge_ratio*bid_2, 4)
+    previous = np.concatenate(([np.nan], spread[:-1]))
+    crossed_mean = ((spread > mean) & (previous < mean)) | ((spread < mean) & (previous > mean))
+    exits = np.flatnonzero(crossed_mean)
+    quantity_1, quantity_2 = position_sizes(settings.money_available(), hedge_ratio)
+    for band_ratio in band_ratios:
+        sell_signal = above_mean & (sell_true_spread > np.round(mean + band_ratio*std, 4))
+        buy_signal = ~above_mean & (buy_true_spread < np.round(mean - band_ratio*std, 4))
+        entries = np.flatnonzero(sell_signal | buy_signal)
+        entry_bars, exit_bars, open_at_end = _walk_trades(entries, exits, start)
+        sells = sell_signal[entry_bars]
+        # signed quantities: selling the spread is short bond 1 and long bond 2
+        signed_1 = np.where(sells, -quantity_1, quantity_1)
+        signed_2 = np.where(sells, quantity_2, -quantity_2)
+        entry_1 = np.where(sells, bid_1[entry_bars], ask_1[entry_bars])
+        entry_2 = np.where(sells, ask_2[entry_bars], bid_2[entry_bars])
+        exit_1 = np.where(sells, ask_1[exit_bars], bid_1[exit_bars])
+        exit_2 = np.where(sells, bid_2[exit_bars], ask_2[exit_bars])
+        gross_pnl = 10*(signed_1*(exit_1 - entry_1) + signed_2*(exit_2 - entry_2))
+        commissions = np.full(len(entry_bars), 2*settings.commission_per_bond*(quantity_1 + quantity_2))
+        net_pnl = gross_pnl - commissions
+        row_parameters = parameters(band_ratio, hedge_ratio)
+        if len(entry_bars):
+            trade_frames.append(pd.DataFrame({
+                **row_parameters,
+                'side': np.where(sells, SELL_THE_SPREAD, BUY_THE_SPREAD),
+                'entry_time': pd.to_datetime(times[entry_bars]), 'exit_time': pd.to_datetime(times[exit_bars]),
+                'bars_held': exit_bars - entry_bars,
+                'entry_spread': spread[entry_bars], 'exit_spread': spread[exit_bars], 'spread_mean': mean[entry_bars],
+                'bond_1_quantity': signed_1, 'bond_2_quantity': signed_2,
+                'bond_1_entry': entry_1, 'bond_2_entry': entry_2, 'bond_1_exit': exit_1, 'bond_2_exit': exit_2,
+                'gross_pnl': gross_pnl, 'commissions': commissions, 'net_pnl': net_pnl}))
+        summaries.append(_summarize(row_parameters, net_pnl, exit_bars - entry_bars, open_at_end, gross_pnl))
+    return trade_frames, summaries
+
+
+def _summarize(parameters: dict, net_pnl: np.ndarray, bars_held: np.ndarray, open_at_end: bool,
+               gross_pnl: Optional[np.ndarray] = None) -> dict:
+    trades = len(net_pnl)
+    pnl_std = float(net_pnl.std(ddof=1)) if trades > 1 else np.nan
+    return {**parameters, 'trades': trades,
+            'win_rate': float((net_pnl > 0).mean()) if trades else np.nan,
+            'gross_pnl': float(gross_pnl.sum()) if gross_pnl is not None else 0.0,
+            'net_pnl': float(net_pnl.sum()),
+            'average_net_pnl': float(net_pnl.mean()) if trades else np.nan,
+            'pnl_std': pnl_std,
+            'sharpe_per_trade': float(net_pnl.mean())/pnl_std if trades > 1 and pnl_std > 0 else np.nan,
+            'max_drawdown': _max_drawdown(net_pnl),
+            'average_bars_held': float(bars_held.mean()) if trades else np.nan,
+            'open_at_end': open_at_end}
+
+
+def sweep(timestamps: np.ndarray, close_1: np.ndarray, close_2: np.ndarray, rolling_windows: list[int], band_ratios: list[float],
+          bar_intervals: list[int], settings: Optional[BacktestSettings] = None, n_jobs: int = -1) -> BacktestResult:
+    """Backtests every (rolling_window, band_ratio, bar_interval) combination on one pair of aligned closes.
+    timestamps are epoch nanoseconds of the source bars, bar_intervals are minutes and should be multiples of the
+    source bar size. (rolling_window, bar_interval) groups run in parallel on n_jobs processes."""
+    settings = settings or BacktestSettings()
+    closes = np.vstack((close_1, close_2)).astype(float)
+    groups = list(itertools.product(rolling_windows, bar_intervals))
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(_run_group)(timestamps, closes, rolling_window, bar_interval, list(band_ratios), settings)
+        for rolling_window, bar_interval in groups)
+    trade_frames = [frame for frames, _ in results for frame in frames]
+    summaries = [summary for _, group_summaries in results for summary in group_summaries]
+    trades = pd.concat(trade_frames, ignore_index=True) if trade_frames else pd.DataFrame()
+    summary = pd.DataFrame(summaries).sort_values('net_pnl', ascending=False, ignore_index=True)
+    return BacktestResult(trades, summary)
+
+
+def sweep_pair(bond_1_data: BarStore, bond_2_data: BarStore, rolling_windows: list[int], band_ratios: list[float],
+               bar_intervals: list[int], settings: Optional[BacktestSettings] = None, n_jobs: int = -1) -> BacktestResult:
+    """sweep over the bars two instruments have in common, the inputs of check_bonds"""
+    timestamps, close_1, close_2 = bond_1_data.join_closes(bond_2_data)
+    return sweep(timestamps, close_1, close_2, rolling_windows, band_ratios, bar_intervals, settings, n_jobs)
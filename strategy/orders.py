@@ -1,7 +1,9 @@
+import time
 from dataclasses import dataclass
 from typing import Optional
 from ibapi.order import Order
 from ibapi.contract import Contract
+from ibapi.tag_value import TagValue
 
 @dataclass
 class StrategyOrder:
@@ -11,10 +13,18 @@ class StrategyOrder:
     fill_price: Optional[float]
     sent_time: Optional[float]
     fill_time: Optional[float]
+    # monotonic nanoseconds of the tick that triggered the order, its creation and placeOrder, for latency histograms
+    tick_ns: Optional[int] = None
+    created_ns: Optional[int] = None
+    sent_ns: Optional[int] = None
+    # how the order was executed, see order_execution.ExecutionMode, and the mid price when it was decided on
+    execution: str = 'market'
+    arrival_price: Optional[float] = None
 
     @classmethod
-    def create(cls, order: Order, contract: Contract) -> 'StrategyOrder':
-        return cls(order=order, contract=contract, status='Unsent', fill_price=None, sent_time=None, fill_time=None)
+    def create(cls, order: Order, contract: Contract, tick_ns: Optional[int] = None) -> 'StrategyOrder':
+        return cls(order=order, contract=contract, status='Unsent', fill_price=None, sent_time=None, fill_time=None,
+                   tick_ns=tick_ns, created_ns=time.monotonic_ns())
 
     def is_filled(self) -> bool:
         return self.status == 'FILLED'
@@ -25,7 +35,7 @@ class StrategyOrder:
         return self.status in open_order_statuses
 
     def get_summary(self) -> dict:
-        return {'account': self.order.account, 'action': self.order.action, 'quantity': self.order.totalQuantity, 'status': self.status, 'fill_price': self.fill_price, 'sent_time': self.sent_time, 'fill_time': self.fill_time, 'contract': self.contract.conId}
+        return {'account': self.order.account, 'action': self.order.action, 'quantity': self.order.totalQuantity, 'status': self.status, 'fill_price': self.fill_price, 'sent_time': self.sent_time, 'fill_time': self.fill_time, 'contract': self.contract.conId, 'execution': self.execution}
     
     def __eq__(self, __o: object) -> bool:
         return self.order.orderId == __o.order.orderId
@@ -43,4 +53,17 @@ def create_market_order(action: str, quantity: int, account: str) -> Order:
     order.account = account
     order.orderType = 'MKT'
     order.totalQuantity = abs(quantity)
-    return order
\ No newline at end of file
+    return order
+
+def create_limit_order(action: str, quantity: int, account: str, limit_price: float) -> Order:
+    order = create_market_order(action, quantity, account)
+    order.orderType = 'LMT'
+    order.lmtPrice = limit_price
+    return order
+
+def create_adaptive_order(action: str, quantity: int, account: str, priority: str = 'Normal') -> Order:
+    """Market order worked by IB's Adaptive algo, priority is Urgent, Normal or Patient"""
+    order = create_market_order(action, quantity, account)
+    order.algoStrategy = 'Adaptive'
+    order.algoParams = [TagValue('adaptivePriority', priority)]
+    return order
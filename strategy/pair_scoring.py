@@ -0,0 +1,159 @@
+import math
+from typing import Optional
+import numpy as np
+from market_data.bar_store import BarStore, align_stores
+
+# MacKinnon (2010) response surface for the 10% ADF critical value, constant only regression, one series
+ADF_CRITICAL_10PCT = (-2.56677, -1.5384, -2.809)
+DEFAULT_CHUNK_SIZE = 256
+
+
+def align_closes(historical_data: dict[str, BarStore], names: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """Builds a (instruments x bars) close price matrix over the timestamps shared by every instrument"""
+    return align_stores([historical_data[name] for name in names])
+
+
+def ordered_pairs(number_of_instruments: int) -> np.ndarray:
+    """All (bond_1, bond_2) index pairs with bond_1 != bond_2"""
+    first, second = np.nonzero(~np.eye(number_of_instruments, dtype=bool))
+    return np.column_stack((first, second))
+
+
+def _demean(data: np.ndarray) -> np.ndarray:
+    return data - data.mean(axis=-1, keepdims=True)
+
+
+def _batched_ols(design: np.ndarray, target: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Least squares for a stack of regressions, design is (pairs x obs x regressors)"""
+    transposed = design.transpose(0, 2, 1)
+    xtx = transposed @ design
+    xty = (transposed @ target[..., None])[..., 0]
+    beta = np.linalg.solve(xtx, xty[..., None])[..., 0]
+    resid = target - (design @ beta[..., None])[..., 0]
+    ssr = np.einsum('pn,pn->p', resid, resid)
+    return beta, ssr, xtx
+
+
+def _adf_design(series: np.ndarray, diff: np.ndarray, lags: int) -> tuple[np.ndarray, np.ndarray]:
+    """Regressors (lagged level, constant, lagged differences) and target for an ADF regression"""
+    length = diff.shape[1]
+    nobs = length - lags
+    columns = [series[:, lags:length], np.ones((series.shape[0], nobs))]
+    for lag in range(1, lags + 1):
+        columns.append(diff[:, lags - lag:length - lag])
+    return np.stack(columns, axis=-1), diff[:, lags:]
+
+
+def adf_statistics(series: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """ADF statistic and 10% critical value for every row, same lag selection as adfuller(regression='c', autolag='AIC')"""
+    nobs = series.shape[1]
+    maxlag = min(nobs // 2 - 2, int(math.ceil(12.0 * math.pow(nobs / 100.0, 1 / 4.0))))
+    diff = np.diff(series, axis=1)
+    design, target = _adf_design(series, diff, maxlag)
+    sample = target.shape[1]
+    # every candidate lag is a leading block of the same moment matrices, so they are computed once
+    transposed = design.transpose(0, 2, 1)
+    xtx = transposed @ design
+    xty = (transposed @ target[..., None])[..., 0]
+    yty = np.einsum('pn,pn->p', target, target)
+    aics = np.empty((series.shape[0], maxlag + 1))
+    for lag in range(maxlag + 1):
+        size = lag + 2
+        beta = np.linalg.solve(xtx[:, :size, :size], xty[:, :size, None])[..., 0]
+        ssr = yty - np.einsum('pk,pk->p', beta, xty[:, :size])
+        aics[:, lag] = sample * np.log(ssr / sample) + 2 * size
+    best_lags = np.argmin(aics, axis=1)
+    stats = np.empty(series.shape[0])
+    critical = np.empty(series.shape[0])
+    for lag in np.unique(best_lags):
+        rows = best_lags == lag
+        design, target = _adf_design(series[rows], diff[rows], int(lag))
+        beta, ssr, xtx = _batched_ols(design, target)
+        sample, regressors = design.shape[1], design.shape[2]
+        variance = ssr / (sample - regressors) * np.linalg.inv(xtx)[:, 0, 0]
+        stats[rows] = beta[:, 0] / np.sqrt(variance)
+        critical[rows] = ADF_CRITICAL_10PCT[0] + ADF_CRITICAL_10PCT[1] / sample + ADF_CRITICAL_10PCT[2] / sample**2
+    return stats, critical
+
+
+def _residualize(data: np.ndarray, regressors: np.ndarray) -> np.ndarray:
+    """Removes the projection of data (pairs x series x obs) on regressors (pairs x k x obs)"""
+    zzt = regressors @ regressors.transpose(0, 2, 1)
+    coefficients = data @ regressors.transpose(0, 2, 1) @ np.linalg.inv(zzt)
+    return data - coefficients @ regressors
+
+
+def johansen_half_lives(first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    """Half life from the largest Johansen eigenvalue, same as coint_johansen(data, 0, 1)"""
+    levels = _demean(np.stack((first, second), axis=1))
+    diffs = np.diff(levels, axis=-1)
+    lagged_diffs = _demean(diffs[..., :-1])
+    r0t = _residualize(_demean(diffs[..., 1:]), lagged_diffs)
+    rkt = _residualize(_demean(levels[..., 1:-1]), lagged_diffs)
+    nobs = rkt.shape[-1]
+    skk = rkt @ rkt.transpose(0, 2, 1) / nobs
+    sk0 = rkt @ r0t.transpose(0, 2, 1) / nobs
+    s00 = r0t @ r0t.transpose(0, 2, 1) / nobs
+    eigenvalues = np.linalg.eigvals(np.linalg.inv(skk) @ sk0 @ np.linalg.inv(s00) @ sk0.transpose(0, 2, 1))
+    theta = eigenvalues.real.max(axis=1)
+    return np.log(2) / theta
+
+
+def rolling_correlation_means(first: np.ndarray, second: np.ndarray, rolling_window: int) -> np.ndarray:
+    """Mean of the rolling window pearson correlation of every row pair"""
+    first = _demean(first)
+    second = _demean(second)
+
+    def window_sums(data: np.ndarray) -> np.ndarray:
+        cumulative = np.cumsum(data, axis=1)
+        cumulative = np.concatenate((np.zeros((data.shape[0], 1)), cumulative), axis=1)
+        return cumulative[:, rolling_window:] - cumulative[:, :-rolling_window]
+
+    sx, sy = window_sums(first), window_sums(second)
+    covariance = window_sums(first * second) - sx * sy / rolling_window
+    variance_x = window_sums(first * first) - sx * sx / rolling_window
+    variance_y = window_sums(second * second) - sy * sy / rolling_window
+    denominator = np.sqrt(np.clip(variance_x, 0, None) * np.clip(variance_y, 0, None))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        correlation = np.where(denominator > 0, covariance / denominator, np.nan)
+    return np.nanmean(np.clip(correlation, -1, 1), axis=1)
+
+
+def _score_chunk(names: list[str], closes: np.ndarray, pairs: np.ndarray, rolling_window: int) -> list[dict]:
+    first = closes[pairs[:, 0]]
+    second = closes[pairs[:, 1]]
+    half = int(0.5 * closes.shape[1])
+    hedge_ratios = np.round(np.einsum('pn,pn->p', first[:, :half], second[:, :half]) /
+                            np.einsum('pn,pn->p', second[:, :half], second[:, :half]), 2)
+    spreads = first - hedge_ratios[:, None] * second
+    adf_stats, critical = adf_statistics(spreads[:, half:])
+    windows = spreads[:, -rolling_window:]
+    spread_means = windows.mean(axis=1)
+    spread_stds = windows.std(axis=1, ddof=1)
+    half_lives = johansen_half_lives(first, second)
+    correlations = rolling_correlation_means(first, second, rolling_window)
+    results = []
+    for row, (bond_1, bond_2) in enumerate(pairs):
+        spread_mean = round(float(spread_means[row]), 2)
+        spread_std = round(float(spread_stds[row]), 2)
+        time_to_revert = round(float(half_lives[row]), 2)
+        corr_mean = 100*round(float(correlations[row]), 4)
+        score = round((corr_mean * spread_std)/time_to_revert, 4)
+        results.append({'bond_1_name': names[bond_1], 'hedge_ratio': float(hedge_ratios[row]), 'bond_2_name': names[bond_2],
+                        'complete_coint': bool(adf_stats[row] <= critical[row]), 'corr_mean': int(corr_mean),
+                        'time_to_revert': time_to_revert, 'spread_mean': spread_mean, 'spread_std': spread_std, 'score': score,
+                        'top_band': round(spread_mean + spread_std, 4), 'bottom_band': round(spread_mean - spread_std, 4)})
+    return results
+
+
+def score_pairs(names: list[str], closes: np.ndarray, rolling_window: int, pairs: Optional[np.ndarray] = None, chunk_size: int = DEFAULT_CHUNK_SIZE) -> list[dict]:
+    """Vectorized equivalent of check_bonds for many pairs at once.
+    closes is a (instruments x bars) matrix aligned on timestamps, pairs are rows of (bond_1, bond_2) indices into names.
+    Returns one dict per pair with the same fields as check_bonds."""
+    if pairs is None:
+        pairs = ordered_pairs(len(names))
+    pairs = np.asarray(pairs, dtype=np.intp).reshape(-1, 2)
+    results: list[dict] = []
+    for start in range(0, len(pairs), chunk_size):
+        results.extend(_score_chunk(names, closes, pairs[start:start + chunk_size], rolling_window))
+    return results
@@ -0,0 +1,109 @@
+import datetime
+from typing import Optional
+from market_data.bar_store import BarStore
+from market_data.quotes import QuoteSnapshot
+from order_execution import LegExecution
+from strategy.orders import StrategyOrder
+from strategy.pairs_trade import PairsTrade, check_bonds
+from strategy.parameters import StrategyParameters
+from strategy.positions import StrategyPosition, apply_fill
+from strategy.rolling_stats import RollingSpreadStats
+from strategy.status import StrategyStatus
+
+
+def pair_key(bond_1_name: str, bond_2_name: str) -> str:
+    """Same key for both orders of the legs, a pair is traded by at most one strategy"""
+    return '/'.join(sorted([bond_1_name, bond_2_name]))
+
+
+class PairStrategy:
+    """One pairs trade: its parameters, rolling spread statistics, trade state machine, orders and positions.
+    TradingApp runs several of them over the shared quotes, each with a share of the capital.
+    Its status goes WAITING_FOR_TRADES -> SENT_ENTRY_ORDERS -> IN_A_TRADE -> SENT_EXIT_ORDERS once."""
+
+    def __init__(self, parameters: StrategyParameters):
+        self.parameters = parameters
+        self.key = pair_key(parameters.bond_1_name, parameters.bond_2_name)
+        self.status = StrategyStatus.WAITING_FOR_TRADES
+        self.spread_stats: Optional[RollingSpreadStats] = None
+        self.bars_since_validation = 0
+        self.previous_spread: Optional[float] = None
+        self.trades: list[PairsTrade] = []
+        self.positions: dict[int, StrategyPosition] = {}
+        self.order_ids: set[int] = set()
+        # legs worked with limit, pegged or adaptive orders by order id
+        self.executions: dict[int, LegExecution] = {}
+        self.last_report_time: float = 0.0
+
+    def __repr__(self) -> str:
+        return f'PairStrategy({self.parameters.bond_1_name}/{self.parameters.bond_2_name}, {self.status})'
+
+    def legs(self) -> tuple[int, int]:
+        return self.parameters.bond_1_contract_id, self.parameters.bond_2_contract_id
+
+    def leg_names(self) -> tuple[str, str]:
+        return self.parameters.bond_1_name, self.parameters.bond_2_name
+
+    def spread(self, snapshot: tuple[QuoteSnapshot, QuoteSnapshot]) -> float:
+        bond_1, bond_2 = snapshot
+        return round(bond_1.mid_price - self.parameters.hedge_ratio*bond_2.mid_price, 4)
+
+    def true_spread(self, mid_price_spread_above_avg: bool, snapshot: tuple[QuoteSnapshot, QuoteSnapshot]) -> float:
+        """True spread is calculated with bid and ask price."""
+        bond_1, bond_2 = snapshot
+        if mid_price_spread_above_avg:
+            true_spread = bond_1.bid_price - self.parameters.hedge_ratio*bond_2.ask_price
+        else:
+            true_spread = bond_1.ask_price - self.parameters.hedge_ratio*bond_2.bid_price
+        return round(true_spread, 4)
+
+    def is_time_to_report(self, interval_in_seconds: int = 10) -> bool:
+        now = datetime.datetime.now().timestamp()
+        if now - self.last_report_time > interval_in_seconds:
+            self.last_report_time = now
+            return True
+        return False
+
+    def on_fill(self, order: StrategyOrder, avg_fill_price: float, name: str, cusip: str) -> Optional[PairsTrade]:
+        """Books a filled order of this strategy, or the filled part of one that was cancelled, returns the trade an entry fill opened"""
+        opened = None
+        if self.status == StrategyStatus.SENT_ENTRY_ORDERS:
+            apply_fill(self.positions, order.order, order.contract, avg_fill_price, name, cusip)
+            if not self.trades or self.trades[-1].is_complete():
+                opened = PairsTrade.open(order)
+                self.trades.append(opened)
+            else:
+                self.trades[-1].add_entry_order(order)
+        if self.status == StrategyStatus.SENT_EXIT_ORDERS:
+            if order.contract.conId in self.positions:
+                apply_fill(self.positions, order.order, order.contract, avg_fill_price, name, cusip)
+                if self.trades:
+                    self.trades[-1].add_exit_order(order)
+                    self.trades[-1].closed = not self.positions
+        return opened
+
+    def update_spread_statistics(self, bond_1_bars: BarStore, bond_2_bars: BarStore, revalidation_interval: int,
+                                 update_hedge_ratio: bool) -> bool:
+        """Refreshes the spread mean and std when a new bar opened on both legs, with a full cointegration check every
+        revalidation_interval bars. Returns False when the pair is no longer cointegrated.
+        The newest bar is still forming and only the bars before it go into the statistics, with their final closes."""
+        if self.spread_stats is None:
+            _, closes_1, closes_2 = bond_1_bars.join_closes(bond_2_bars)
+            self.spread_stats = RollingSpreadStats.from_closes(
+                closes_1[:-1], closes_2[:-1], self.parameters.rolling_window, self.parameters.hedge_ratio)
+        elif len(bond_1_bars) > 1 and len(bond_2_bars) > 1:
+            self.spread_stats.update(float(bond_1_bars.closes[-2]), float(bond_2_bars.closes[-2]))
+        self.bars_since_validation += 1
+        if self.bars_since_validation >= revalidation_interval:
+            self.bars_since_validation = 0
+            parameters = check_bonds(self.parameters.bond_1_name, bond_1_bars, self.parameters.bond_2_name,
+                                     bond_2_bars, self.parameters.rolling_window)
+            if parameters['complete_coint'] is False:
+                return False
+        if update_hedge_ratio and self.status == StrategyStatus.WAITING_FOR_TRADES:
+            self.spread_stats.hedge_ratio = round(self.spread_stats.regression_hedge_ratio(), 2)
+            self.parameters.hedge_ratio = self.spread_stats.hedge_ratio
+        if self.spread_stats.count > 1:
+            self.parameters.spread_mean = round(self.spread_stats.spread_mean(), 2)
+            self.parameters.spread_std = round(self.spread_stats.spread_std(), 2)
+        return True
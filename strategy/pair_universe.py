@@ -0,0 +1,29 @@
+from typing import Optional
+import numpy as np
+
+
+def unique_names(names: list[str]) -> list[str]:
+    """Drops repeated names keeping the first occurrence, pairs of an instrument with itself are never formed"""
+    return list(dict.fromkeys(names))
+
+
+def return_correlations(closes: np.ndarray) -> np.ndarray:
+    """(instruments x instruments) correlation of bar to bar price changes, computed once for the whole universe"""
+    changes = np.diff(closes, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        correlations = np.corrcoef(changes)
+    return np.nan_to_num(np.atleast_2d(correlations), nan=0.0)
+
+
+def candidate_pairs(number_of_instruments: int, correlations: Optional[np.ndarray] = None,
+                    min_correlation: Optional[float] = None) -> np.ndarray:
+    """Every ordered (bond_1, bond_2) index pair, optionally only those whose return correlation reaches min_correlation.
+    Unordered pairs come from the upper triangle so each is generated once, then both orders are emitted."""
+    first, second = np.triu_indices(number_of_instruments, k=1)
+    if min_correlation is not None and correlations is not None:
+        keep = correlations[first, second] >= min_correlation
+        first, second = first[keep], second[keep]
+    pairs = np.empty((2*len(first), 2), dtype=np.intp)
+    pairs[0::2, 0], pairs[0::2, 1] = first, second
+    pairs[1::2, 0], pairs[1::2, 1] = second, first
+    return pairs
@@ -2,44 +2,28 @@ from dataclasses import dataclass
 from typing import Optional
 import numpy as np
 import pandas as pd
-from market_data.historical import PriceBar
-from others import create_pickle_file, delete_file,read_pickle_file
+from market_data.bar_store import BarStore
 from statsmodels.api import OLS
 from statsmodels.tsa.stattools import adfuller
 from statsmodels.tsa.vector_ar.vecm import coint_johansen
 from strategy.orders import StrategyOrder
-from ibapi.commission_report import CommissionReport
 
 @dataclass
 class PairsTrade:
     entry_orders:list[StrategyOrder]
     exit_orders:list[StrategyOrder]
     gross_pnl: Optional[float]
-    commission_reports: list[CommissionReport] 
-
-    _FILENAME: str = 'pairs_trade.pickle'
+    # the exits flattened the positions of the trade, see PairStrategy.on_fill
+    closed: bool = False
 
     @classmethod
     def open(cls, entry_order:StrategyOrder) -> 'PairsTrade':
         """Starts the class from a single trade entry"""
-        return PairsTrade([entry_order], [], None,[])
-
-    @classmethod
-    def from_pickle_file(cls) -> Optional['PairsTrade']:
-        return read_pickle_file(cls._FILENAME)
-    
-    def create_pickle_file(self) -> None:
-        create_pickle_file(self,self._FILENAME)
-    
-    def delete_pickle_file(self):
-        delete_file(self._FILENAME)
+        return PairsTrade([entry_order], [], None)
 
     def add_exit_order(self, other_order:StrategyOrder) -> None:
-        if self.exit_orders:
-            if len(self.exit_orders) < 2:
-                if self.exit_orders[0] != other_order:
-                    self.exit_orders.append(other_order)
-        else:
+        # a leg whose worked exit partly filled is closed by more than one order
+        if other_order not in self.exit_orders:
             self.exit_orders.append(other_order)
 
     def add_entry_order(self, other_order:StrategyOrder) -> None:
@@ -51,49 +35,17 @@ class PairsTrade:
             self.entry_orders.append(other_order)
 
     def is_complete(self) -> bool:
-        return len(self.entry_orders) == 2 and len(self.exit_orders) == 2
+        return self.closed
 
     def has_both_entries(self) -> bool:
         return len(self.entry_orders) == 2
 
-    def calculate_gross_pnl(self) -> Optional[float]:
-        if self.is_complete():
-            contracts = [order.contract for order in self.exit_orders]
-            gross_pnl = 0.0
-            for contract in contracts:
-                for order in self.entry_orders:
-                    if order.contract.conId == contract.conId:
-                        entry_order = order
-                for order in self.exit_orders:
-                    if order.contract.conId == contract.conId:
-                        exit_order = order
-                if entry_order.order.action == 'BUY':
-                    gross_pnl += float(exit_order.order.totalQuantity) *(
-                        float(exit_order.fill_price) - float(entry_order.fill_price))
-                elif entry_order.order.action == 'SELL':
-                    gross_pnl += -float(exit_order.order.totalQuantity) *(
-                        float(exit_order.fill_price) - float(entry_order.fill_price))
-            return gross_pnl
-        else:
-            return None
-
-    def calculate_total_commissions(self) -> float:
-        commissions = 0.0
-        for report in self.commission_reports:
-            commissions += report.commission
-        return commissions
-
-    def report(self) -> dict:
-        realized_pnl_sum = self.commission_reports[2].realizedPNL + self.commission_reports[3].realizedPNL
-        gross = self.calculate_gross_pnl()
-        if gross and self.entry_orders[0].contract.secType == 'BOND':
-            gross = round(10*gross,2)
-        total_commissions = round(self.calculate_total_commissions(),2)
-        if gross:
-            net = round(gross - total_commissions,2)
-            return {'gross pnl': gross, 'net pnl': net, 'total_commissions': total_commissions, 'executions': realized_pnl_sum}
-        else:
+    def report(self, commissions: float, realized: float) -> dict:
+        """Commissions and realized pnl of the executions of the trade come from the pnl engine, see TradingApp.trade_report"""
+        if not self.is_complete():
             return {}
+        self.gross_pnl = round(realized, 2)
+        return {'gross pnl': self.gross_pnl, 'net pnl': round(realized - commissions, 2), 'total_commissions': round(commissions, 2)}
 
 def is_cointegrated_simple(spread: pd.Series):
     """Checks for cointegration of two series without a data split"""
@@ -128,13 +80,10 @@ def calculate_time_to_revert(data):
     half_life = round(np.log(2) / theta, 2)
     return half_life
 
-def check_bonds(bond_1_name: str, bond_1_data: list[PriceBar], bond_2_name: str, bond_2_data: list[PriceBar], rolling_window: int):
-    bond_1_data = pd.DataFrame([x.__dict__ for x in bond_1_data])
-    bond_2_data = pd.DataFrame([x.__dict__ for x in bond_2_data])
-    bond_1_data.set_index('timestamp', inplace=True)
-    bond_2_data.set_index('timestamp', inplace=True)
-    both = pd.merge(bond_1_data, bond_2_data, how='inner',
-                    left_index=True, right_index=True, suffixes=('_1', '_2'))
+def check_bonds(bond_1_name: str, bond_1_data: BarStore, bond_2_name: str, bond_2_data: BarStore, rolling_window: int):
+    timestamps, close_1, close_2 = bond_1_data.join_closes(bond_2_data)
+    both = pd.DataFrame({'close_1': close_1, 'close_2': close_2},
+                        index=pd.to_datetime(timestamps))
     both['rolling_corr'] = both['close_1'].rolling(window=rolling_window).corr(both['close_2'])
     complete_coint, hedge_ratio = is_cointegrated(both['close_1'], both['close_2'])
     spread = both['close_1'] - hedge_ratio*both['close_2']
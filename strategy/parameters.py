@@ -1,7 +1,6 @@
 from dataclasses import dataclass
 from typing import Optional
 from ibapi.contract import Contract
-from others import create_pickle_file, delete_file, read_pickle_file
 
 @dataclass
 class StrategyParameters:
@@ -17,24 +16,11 @@ class StrategyParameters:
     time_to_revert: float
     rolling_window: int
 
-    _FILENAME: str = 'strategy_params.pickle'
-
-    @classmethod
-    def from_pickle(cls) -> Optional['StrategyParameters']:
-        return read_pickle_file(cls._FILENAME)
-
-    def create_pickle_file(self):
-        create_pickle_file(self, self._FILENAME)
-
     def top_band(self,ratio:float=1.0) -> float:
         return round(self.spread_mean + ratio*self.spread_std, 4)
 
     def bottom_band(self,ratio:float=1.0) -> float:
         return round(self.spread_mean - ratio*self.spread_std, 4)
-    
-    def delete_pickle_file(self):
-        delete_file(self._FILENAME)
-        return
 
 
 
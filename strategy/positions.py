@@ -1,10 +1,21 @@
+import math
 from dataclasses import dataclass
 from ibapi.contract import Contract
 from ibapi.order import Order
-from typing import Optional
-from market_data.quotes import Quote
 from strategy.orders import create_market_order
 
+
+def position_sizes(money_available: float, hedge_ratio: float) -> tuple[int, int]:
+    """Bond 1 and bond 2 quantities in 1000 dollar units, half of the money goes to the leg with the larger quantity"""
+    one_thousand_dollar_units = math.floor(money_available/1000)
+    if hedge_ratio < 1:
+        contract_1_amount = math.floor(0.5*one_thousand_dollar_units)
+        contract_2_amount = math.floor(hedge_ratio*contract_1_amount)
+    else:
+        contract_2_amount = math.floor(0.5*one_thousand_dollar_units)
+        contract_1_amount = math.floor(contract_2_amount/hedge_ratio)
+    return contract_1_amount, contract_2_amount
+
 @dataclass
 class StrategyPosition:
     contract: Contract
@@ -17,17 +28,7 @@ class StrategyPosition:
 
     @classmethod
     def from_filled_order(cls, order: Order, contract: Contract, avg_price: float,name:str,cusip:str) -> 'StrategyPosition':
-        return cls(contract=contract, account=order.account, average_price=avg_price, quantity=order.totalQuantity,name=name,cusip=cusip)
-
-    def unrealized_pnl(self, quote: Quote) -> Optional[float]:
-        if quote.is_valid(5.0):
-            price = quote.bid_price if self.quantity > 0 else quote.ask_price
-            pnl = float(self.quantity) * (float(price) - float(self.average_price))
-            if self.contract.secType == 'BOND':
-                pnl *= 10
-            return pnl
-        else:
-            return None
+        return cls(contract=contract, account=order.account, average_price=avg_price, quantity=order.totalQuantity if order.action == 'BUY' else -order.totalQuantity,name=name,cusip=cusip)
 
     def create_closing_order(self) -> Order:
         order = Order()
@@ -35,12 +36,20 @@ class StrategyPosition:
         if self.quantity > 0:
             order = create_market_order('SELL', self.quantity, self.account)
         elif self.quantity < 0:
-            order = create_market_order('BUY', self.quantity, self.account)
+            order = create_market_order('BUY', -self.quantity, self.account)
         return order
 
     def to_row(self) -> dict:
         return {'contract': self.contract.conId, 'cusip':self.cusip,'name':self.name,'account': self.account, 'average_price': self.average_price, 'quantity': self.quantity}
 
-    def to_row_with_unrealized_pnl(self, quote:Quote) -> dict:
-        pnl = round(self.unrealized_pnl(quote),2)
-        return {'cusip':self.cusip,'contract': self.contract.conId,'term':self.name,'account': self.account, 'average_price': round(self.average_price,2), 'quantity': self.quantity,'bid price':quote.bid_price,'ask_price':quote.ask_price, 'unrealized_pnl': pnl}
+
+def apply_fill(positions: dict[int, StrategyPosition], order: Order, contract: Contract, avg_price: float, name: str, cusip: str) -> None:
+    """Adds a completely filled order to the position of its contract, positions that reach zero are removed"""
+    position = positions.get(contract.conId)
+    if position is None:
+        positions[contract.conId] = StrategyPosition.from_filled_order(order, contract, avg_price, name=name, cusip=cusip)
+        return
+    quantity = float(order.totalQuantity)
+    position.quantity = float(position.quantity) + (quantity if order.action == 'BUY' else -quantity)
+    if position.quantity == 0:
+        positions.pop(contract.conId)
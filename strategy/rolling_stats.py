@@ -0,0 +1,93 @@
+import math
+from typing import Optional
+import numpy as np
+
+
+class RollingSpreadStats:
+    """Rolling window statistics of spread = x - hedge_ratio*y, updated in O(1) per bar.
+    Sums are kept on prices shifted by the first observation to avoid cancellation, and are rebuilt
+    from the window buffer once per window length so floating point drift cannot accumulate."""
+
+    def __init__(self, rolling_window: int, hedge_ratio: float):
+        self.rolling_window = rolling_window
+        self.hedge_ratio = hedge_ratio
+        self._x = np.zeros(rolling_window)
+        self._y = np.zeros(rolling_window)
+        self._position = 0
+        self.count = 0
+        self._updates_since_rebuild = 0
+        self._x_shift: Optional[float] = None
+        self._y_shift: Optional[float] = None
+        self._sx = self._sy = self._sxx = self._syy = self._sxy = 0.0
+
+    @classmethod
+    def from_closes(cls, closes_1: np.ndarray, closes_2: np.ndarray, rolling_window: int, hedge_ratio: float) -> 'RollingSpreadStats':
+        """Seeds the window with the last rolling_window aligned closes of both legs"""
+        stats = cls(rolling_window, hedge_ratio)
+        for x, y in zip(closes_1[-rolling_window:], closes_2[-rolling_window:]):
+            stats.update(float(x), float(y))
+        return stats
+
+    def update(self, x: float, y: float) -> None:
+        if self._x_shift is None:
+            self._x_shift, self._y_shift = x, y
+        x -= self._x_shift
+        y -= self._y_shift
+        if self.count == self.rolling_window:
+            old_x, old_y = self._x[self._position], self._y[self._position]
+            self._sx -= old_x
+            self._sy -= old_y
+            self._sxx -= old_x*old_x
+            self._syy -= old_y*old_y
+            self._sxy -= old_x*old_y
+        else:
+            self.count += 1
+        self._x[self._position] = x
+        self._y[self._position] = y
+        self._position = (self._position + 1) % self.rolling_window
+        self._sx += x
+        self._sy += y
+        self._sxx += x*x
+        self._syy += y*y
+        self._sxy += x*y
+        self._updates_since_rebuild += 1
+        if self._updates_since_rebuild >= self.rolling_window:
+            self._rebuild_sums()
+
+    def _rebuild_sums(self) -> None:
+        x, y = self._x[:self.count], self._y[:self.count]
+        self._sx, self._sy = float(x.sum()), float(y.sum())
+        self._sxx, self._syy, self._sxy = float(x @ x), float(y @ y), float(x @ y)
+        self._updates_since_rebuild = 0
+
+    def is_full(self) -> bool:
+        return self.count == self.rolling_window
+
+    def _covariances(self) -> tuple[float, float, float]:
+        n = self.count
+        var_x = (self._sxx - self._sx*self._sx/n)/(n - 1)
+        var_y = (self._syy - self._sy*self._sy/n)/(n - 1)
+        cov_xy = (self._sxy - self._sx*self._sy/n)/(n - 1)
+        return var_x, var_y, cov_xy
+
+    def spread_mean(self) -> float:
+        shifted_mean = (self._sx - self.hedge_ratio*self._sy)/self.count
+        return shifted_mean + self._x_shift - self.hedge_ratio*self._y_shift
+
+    def spread_std(self) -> float:
+        var_x, var_y, cov_xy = self._covariances()
+        variance = var_x - 2*self.hedge_ratio*cov_xy + self.hedge_ratio**2*var_y
+        return math.sqrt(max(variance, 0.0))
+
+    def correlation(self) -> Optional[float]:
+        var_x, var_y, cov_xy = self._covariances()
+        if var_x <= 0 or var_y <= 0:
+            return None
+        return cov_xy/math.sqrt(var_x*var_y)
+
+    def regression_hedge_ratio(self) -> float:
+        """Slope of x on y without intercept over the window, the same regression is_cointegrated runs"""
+        n = self.count
+        sxy = self._sxy + self._y_shift*self._sx + self._x_shift*self._sy + n*self._x_shift*self._y_shift
+        syy = self._syy + 2*self._y_shift*self._sy + n*self._y_shift**2
+        return sxy/syy
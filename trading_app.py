@@ -1,10 +1,11 @@
+import asyncio
 import datetime
 import math
+import threading
 from dataclasses import dataclass
+from time import monotonic_ns
 from decimal import Decimal
-from typing import Optional
-from joblib import Parallel, delayed
-import pandas as pd
+from typing import Optional, Union
 from ibapi.account_summary_tags import AccountSummaryTags
 from ibapi.client import EClient, TickerId
 from ibapi.common import BarData, OrderId, TickAttribBidAsk
@@ -17,40 +18,104 @@ from ibapi.wrapper import EWrapper
 from ibapi.execution import ExecutionFilter, Execution
 from ibapi.commission_report import CommissionReport
 from requests import request
-from market_data.quotes import Quote
-from data_requests import DataRequest, Subscription
+from market_data.quotes import Quote, QuoteSnapshot, pair_snapshot
+from market_data.tick_buffer import DEFAULT_DEPTH_LEVELS, DEFAULT_TICK_CAPACITY, InstrumentTicks
+from latency import LatencyRecorder
+from order_execution import HEDGE, ExecutionEngine, LegExecution
+from order_manager import OrderManager
+from pnl_engine import ACCOUNT_BOOK, PnlEngine, par_modified_duration
+from reporting import Reporter
+from risk_gate import RiskGate, RiskLimits, notional_per_unit
+from data_requests import DataRequest, RequestState, Subscription
+from request_registry import RequestRegistry
+from request_scheduler import RequestScheduler
 from market_data.ust_bonds import get_bonds_info
 from strategy.orders import StrategyOrder, create_market_order
-from others import df_to_tt, estimate_bond_name
-from strategy.pairs_trade import PairsTrade, check_bonds
+from others import estimate_bond_name
+from strategy.pairs_trade import PairsTrade
+from strategy.analysis_pool import PairAnalysisPool
+from strategy.pair_scoring import align_closes, score_pairs
+from strategy.pair_universe import candidate_pairs, return_correlations, unique_names
 from strategy.parameters import StrategyParameters
-from strategy.positions import StrategyPosition
+from strategy.positions import StrategyPosition, apply_fill, position_sizes
+from strategy.pair_strategy import PairStrategy, pair_key
 from market_data.ust_bonds import USTreasurySecurity
-from market_data.historical import PriceBar
+from market_data.security_master import SecurityMaster
+from market_data.instrument_index import InstrumentIndex
+from market_data.archive import MarketArchive, history_duration, history_start
+from market_data.bar_store import BarStore, bar_timestamp_ns
+from runtime_snapshot import RuntimeSnapshot, SnapshotStore, clocks_ns, restored_quote, wall_clock_quote
 from strategy.status import StrategyStatus
 from strategy.pairs_trade import is_cointegrated
 from log_config import log
 
+# request ids start far above the order ids TWS hands out, error() reports both and tells them apart by id
+FIRST_REQUEST_ID = 1 << 30
+
 @dataclass
 class TradingApp(EWrapper, EClient):
-    def __init__(self, account: str,bar_interval:int,rolling_window:int, percent_of_account_to_use: float = 100):
+    def __init__(self, account: str,bar_interval:int,rolling_window:int, percent_of_account_to_use: float = 100, revalidation_interval: int = 20, update_hedge_ratio: bool = False,
+                 min_pair_correlation: Optional[float] = None, analysis_jobs: int = 1, scheduler: Optional[RequestScheduler] = None,
+                 tick_buffer_size: int = DEFAULT_TICK_CAPACITY, depth_levels: int = DEFAULT_DEPTH_LEVELS,
+                 archive: Optional[MarketArchive] = None, snapshots: Optional[SnapshotStore] = None, max_pairs: int = 1,
+                 latency: Optional[LatencyRecorder] = None, orders: Optional[OrderManager] = None,
+                 risk: Optional[RiskGate] = None, execution: Optional[ExecutionEngine] = None, pnl: Optional[PnlEngine] = None,
+                 reporter: Optional[Reporter] = None):
         EClient.__init__(self, self)
         self.account = account
         self.bar_interval = bar_interval
         self.rolling_window = rolling_window
+        # number of new bars between full cointegration checks, the rolling mean and std are updated on every bar
+        self.revalidation_interval = revalidation_interval
+        self.update_hedge_ratio = update_hedge_ratio
+        # pairs whose bar to bar return correlation is below this are not scored, None scores every pair
+        self.min_pair_correlation = min_pair_correlation
+        # worker processes are started here, before the IB and strategy threads exist, and reused by every find_pairs_trades
+        self.analysis_pool: Optional[PairAnalysisPool] = PairAnalysisPool(analysis_jobs) if analysis_jobs > 1 else None
+        # pair strategies running at once, the capital is split evenly between them
+        self.max_pairs = max_pairs
+        self.strategies: dict[str, PairStrategy] = {}
+        self.strategies_by_con_id: dict[int, list[PairStrategy]] = {}
+        self.order_strategies: dict[int, str] = {}
+        # instruments whose quote changed and strategies with order or status events since the strategy thread last looked
+        self.changed_con_ids: set[int] = set()
+        self.changed_strategies: set[str] = set()
+        self.changes_lock = threading.Lock()
+        # held by the IB reader thread while it books order events into the strategies, and while a snapshot pickles them
+        self.state_lock = threading.Lock()
         self.buying_powers: dict[str, float] = {}
         self.bonds_general_info: list[USTreasurySecurity] = []
-        self.historical_data: dict[str, list[PriceBar]] = {}
-        self.requests: dict[int, Subscription] = {}
+        self.instruments = InstrumentIndex()
+        self.historical_data: dict[str, BarStore] = {}
+        # bars and ticks persist here between runs, only the gap since the newest archived bar is requested
+        self.archive = archive
+        # bars up to this timestamp are already in the store, from the archive
+        self.loaded_until: dict[str, Optional[int]] = {}
+        self.tick_archive_positions: dict[int, int] = {}
+        self.last_tick_archive_time: float = datetime.datetime.now().timestamp()
+        self.requests = RequestRegistry(FIRST_REQUEST_ID)
+        self.scheduler = scheduler or RequestScheduler()
+        self.seconds_to_first_trade: Optional[float] = None
         self.errors: list[str] = []
-        self.request_counter: int = 1
-        self.strategy_data: Optional[StrategyParameters] = None
+        # quotes are the conflated latest view the strategy reads, ticks keep every update in fixed size buffers for analytics
         self.quotes: dict[int, Quote] = {}
+        self.ticks: dict[int, InstrumentTicks] = {}
+        self.tick_buffer_size = tick_buffer_size
+        self.depth_levels = depth_levels
         self.positions: dict[int, StrategyPosition] = {}
         self.pinged_positions = False
+        # IB's positions are loaded until positionEnd, the fills keep them from then on
+        self.positions_downloaded = False
         self.status = StrategyStatus.INITIALIZED
-        self.next_valid_order_id: Optional[int] = None
-        self.orders: dict[int, StrategyOrder] = {}
+        self.orders = orders or OrderManager()
+        # every order passes the pre-trade checks right before placeOrder
+        self.risk = risk or RiskGate(RiskLimits(order_burst=max(4, 2*max_pairs), max_open_legs=2*max_pairs))
+        # market orders on every leg unless a limit, pegged or adaptive mode is configured
+        self.execution = execution or ExecutionEngine()
+        # pnl, exposure and DV01 by strategy, moved by every quote and execution
+        self.pnl = pnl or PnlEngine()
+        # tables and JSON lines are rendered and written on the reporting thread, callers only hand over rows
+        self.reporter = reporter or Reporter()
         self.last_update_time: float = datetime.datetime.now().timestamp()
         self.account_summary_provided: bool = False
         self.position_quotes_complete: bool = False
@@ -59,27 +124,98 @@ class TradingApp(EWrapper, EClient):
         self.requests_locked: bool = False
         self.orders_locked: bool = False
         self.percent_of_account_to_use = percent_of_account_to_use
+        # every trade of every strategy, in the order they were opened
         self.trades: list[PairsTrade] = []
-        self.previous_spread: Optional[float] = None
         self.start_time: float = datetime.datetime.now()
-
-    def generate_req_id(self) -> int:
-        out = self.request_counter
-        self.request_counter += 1
-        return out
+        self.strategy_wakeup = threading.Event()
+        # the runtime state is written after every status change so a restarted process can resume the trade
+        self.snapshots = snapshots
+        self.snapshot_due = False
+        # tick to quote, band check, order, placeOrder and fill latencies
+        self.latency = latency or LatencyRecorder()
 
     def seconds_since_start(self) -> float:
         return (datetime.datetime.now() - self.start_time).total_seconds()
 
-    def nextValidId(self, orderId: int):
-        self.next_valid_order_id = orderId
-        return super().nextValidId(orderId)
+    def wake_strategy(self, con_id: Optional[int] = None) -> None:
+        """Signals the strategy thread that one of its inputs has changed, con_id is the instrument whose quote changed"""
+        if con_id is not None:
+            with self.changes_lock:
+                self.changed_con_ids.add(con_id)
+        self.strategy_wakeup.set()
+
+    def mark_strategy_changed(self, strategy: PairStrategy) -> None:
+        with self.changes_lock:
+            self.changed_strategies.add(strategy.key)
+        self.strategy_wakeup.set()
+
+    def strategies_to_evaluate(self) -> list[PairStrategy]:
+        """Strategies with a leg whose quote changed or an event of their own since the previous call"""
+        with self.changes_lock:
+            con_ids, keys = self.changed_con_ids, self.changed_strategies
+            self.changed_con_ids, self.changed_strategies = set(), set()
+        for con_id in con_ids:
+            keys.update(strategy.key for strategy in self.strategies_by_con_id.get(con_id, ()))
+        return [self.strategies[key] for key in keys if key in self.strategies]
 
-    def get_next_valid_order_id(self) -> int:
-        if self.orders:
-            return max([self.next_valid_order_id+1, max([id for id in self.orders.keys()])]) + 1
+    def add_strategy(self, strategy: PairStrategy) -> None:
+        self.strategies[strategy.key] = strategy
+        for con_id in set(strategy.legs()):
+            self.strategies_by_con_id.setdefault(con_id, []).append(strategy)
+        log.info(f'Running {strategy}')
+        self.mark_strategy_changed(strategy)
+
+    def retire_strategy(self, strategy: PairStrategy) -> None:
+        """Stops running a strategy, the freed capital goes to the next pair analysis"""
+        self.strategies.pop(strategy.key, None)
+        for con_id in set(strategy.legs()):
+            remaining = [other for other in self.strategies_by_con_id.get(con_id, []) if other is not strategy]
+            if remaining:
+                self.strategies_by_con_id[con_id] = remaining
+            else:
+                self.strategies_by_con_id.pop(con_id, None)
+        log.info(f'Stopped {strategy}')
+        if self.status == StrategyStatus.WAITING_FOR_TRADES:
+            self.update_status(StrategyStatus.ANALYZING_PAIRS)
         else:
-            return self.next_valid_order_id + 1
+            self.snapshot_due = True
+
+    def update_strategy_status(self, strategy: PairStrategy, new_status: StrategyStatus) -> None:
+        if strategy.status != new_status:
+            log.info(f'{strategy.key} Status Update: {strategy.status} -> {new_status}')
+            strategy.status = new_status
+            if new_status == StrategyStatus.SENT_ENTRY_ORDERS and self.seconds_to_first_trade is None:
+                self.seconds_to_first_trade = self.seconds_since_start()
+                log.info(f'First trade {self.seconds_to_first_trade:.1f}s after start, request pacing {self.scheduler.metrics.as_dict()}')
+            # saved at the end of the strategy step, after the orders of the new status went out
+            self.snapshot_due = True
+            # the handler of the new status must run without waiting for market data
+            self.mark_strategy_changed(strategy)
+
+    def wait_for_strategy_wakeup(self, timeout: float) -> bool:
+        """Blocks until a callback signals new data or the timeout expires, returns True if signaled"""
+        signaled = self.strategy_wakeup.wait(timeout)
+        self.strategy_wakeup.clear()
+        return signaled
+
+    def use_event_loop(self) -> None:
+        """Callbacks and the strategy run on one asyncio event loop, the strategy then waits on an asyncio.Event"""
+        self.strategy_wakeup = asyncio.Event()
+
+    async def wait_for_strategy_wakeup_async(self, timeout: float) -> bool:
+        """wait_for_strategy_wakeup for a strategy task on the event loop, other tasks run while it waits"""
+        # wait_for can drop a cancellation that lands as the event is set, cancel_tasks in main cancels until the task ends
+        try:
+            await asyncio.wait_for(self.strategy_wakeup.wait(), timeout)
+            signaled = True
+        except asyncio.TimeoutError:
+            signaled = False
+        self.strategy_wakeup.clear()
+        return signaled
+
+    def nextValidId(self, orderId: int):
+        self.orders.seed(orderId)
+        return super().nextValidId(orderId)
 
     def error(self, reqId, errorCode, errorString, contract=None):
         # check if the errorCode starts with 21
@@ -87,6 +223,18 @@ class TradingApp(EWrapper, EClient):
         is_error = False if reqId == -1 else True
         if reqId in self.requests:
             name = self.requests[reqId].name
+            if self.scheduler.is_pacing_error(errorCode, errorString):
+                delay = self.scheduler.retry(reqId)
+                if delay is not None:
+                    self.requests.requeue(reqId)
+                    log.warning(f'{name}: {errorString}. Retrying in {delay:.0f}s')
+                    self.wake_strategy()
+                    return
+            if not is_warning:
+                self.requests.mark_errored(reqId, errorCode)
+                self.scheduler.release(reqId)
+        elif reqId in self.orders:
+            name = f'Order {reqId}'
         else:
             name = 'General'
         if is_error:
@@ -94,12 +242,12 @@ class TradingApp(EWrapper, EClient):
         if is_warning:
             log.warning(f'{name}: {errorString}')
 
-    def profit_target(self) -> Optional[float]:
-        if self.positions:
+    def profit_target(self, strategy: PairStrategy) -> Optional[float]:
+        if strategy.positions:
             sizes: list[float] = [abs(float(position.quantity))
-                                for position in self.positions.values()]
-            includes_bonds = any([position.contract.secType == 'BOND' for position in self.positions.values()])
-            pt = self.strategy_data.spread_std*min(sizes)
+                                for position in strategy.positions.values()]
+            includes_bonds = any([position.contract.secType == 'BOND' for position in strategy.positions.values()])
+            pt = strategy.parameters.spread_std*min(sizes)
             if includes_bonds:
                 return 10*pt
             return pt
@@ -113,128 +261,341 @@ class TradingApp(EWrapper, EClient):
         if self.status != new_status:
             log.info(f'Status Update: {self.status} -> {new_status}')
             self.status = new_status
+            self.snapshot_due = True
+            # the handler of the new status must run without waiting for market data
+            self.wake_strategy()
+
+    def save_snapshot_if_due(self) -> None:
+        if self.snapshot_due:
+            self.snapshot_due = False
+            self.save_snapshot()
+
+    def save_snapshot(self) -> None:
+        """Bars are left out, a restart loads them from the archive and requests the gap"""
+        if self.snapshots is None:
+            return
+        now_ns, now_wall_ns = clocks_ns()
+        with self.state_lock:
+            self.snapshots.write(RuntimeSnapshot(
+                self.status, dict(self.strategies), dict(self.order_strategies), list(self.trades), self.orders.as_dict(),
+                dict(self.positions), list(self.bonds_general_info), dict(self.buying_powers),
+                {con_id: wall_clock_quote(quote, now_ns, now_wall_ns) for con_id, quote in list(self.quotes.items())},
+                [Subscription(request.data_type, request.contract, request.name) for request in self.requests.values()]))
+
+    def restore_snapshot(self) -> bool:
+        """Puts the app back in the state of the last snapshot if it was taken during a trade or while waiting for one.
+        Market data and bar subscriptions are queued again, bars only for the gap since the newest archived one."""
+        if self.snapshots is None:
+            return False
+        snapshot = self.snapshots.read()
+        if snapshot is None or not snapshot.is_resumable():
+            return False
+        for strategy in snapshot.strategies.values():
+            self.add_strategy(strategy)
+        self.order_strategies = snapshot.order_strategies
+        self.trades = snapshot.trades
+        self.orders.restore(snapshot.orders)
+        for _, order in self.orders.working():
+            self.risk.on_sent(order)
+        self.positions = snapshot.positions
+        self.set_bonds_general_info(snapshot.bonds_general_info)
+        self.buying_powers = snapshot.buying_powers
+        now_ns, now_wall_ns = clocks_ns()
+        self.quotes = {con_id: restored_quote(quote, now_ns, now_wall_ns) for con_id, quote in snapshot.quotes.items()}
+        for con_id, quote in self.quotes.items():
+            self.pnl.on_quote(con_id, quote.bid_price, quote.ask_price, quote.last_update_ns)
+        # realized pnl starts over, the open positions of every strategy are marked from their average price
+        for strategy in self.strategies.values():
+            for position in strategy.positions.values():
+                self.register_instrument(position.contract)
+                self.pnl.load_position(strategy.key, position.contract.conId, position.quantity, position.average_price)
+        for subscription in snapshot.subscriptions:
+            request_id = self.requests.add(subscription)
+            # contract details came back with bonds_general_info, the streams died with the previous connection
+            if subscription.data_type == DataRequest.ContractInfo:
+                self.requests.mark_sent(request_id)
+                self.requests.mark_complete(request_id)
+        self.status = snapshot.status
+        age = datetime.datetime.now().timestamp() - snapshot.written_at
+        log.info(f'Resumed {self.status} from snapshot {snapshot.sequence} taken {age:.1f}s ago')
+        return True
 
     def positionEnd(self):
-        table = self.produce_positions_table()
-        if table:
-            log.info(f'Positions: \n{table}')
+        self.positions_downloaded = True
+        self.requests.mark_type_complete(DataRequest.Positions)
+        # what no strategy holds is booked to the account
+        for con_id, position in self.positions.items():
+            self.register_instrument(position.contract)
+            unmanaged = float(position.quantity) - self.pnl.book_quantity(con_id, ACCOUNT_BOOK)
+            self.pnl.load_position(ACCOUNT_BOOK, con_id, unmanaged, position.average_price)
+        self.report_positions()
+        self.wake_strategy()
         return super().positionEnd()
 
-    def produce_positions_table(self) -> Optional[str]:
-        if self.is_flat():
-            return None
-        rows = []
-        for position in self.positions.values():
-            rows.append(position.to_row())
-        table = pd.DataFrame(rows)
-        tt = df_to_tt(table)
-        return tt
+    def report_positions(self) -> None:
+        self.reporter.report('positions', 'Positions', [position.to_row() for position in list(self.positions.values())])
 
     def position(self, account: str, contract: Contract, position: Decimal, avgCost: float):
         self.pinged_positions = True
-        if position != 0 and account == self.account:
-            if contract.secType == 'BOND':
-                ltd = datetime.datetime.strptime(
-                    contract.lastTradeDateOrContractMonth, '%Y%m%d').date()
-                name = estimate_bond_name(ltd)
-                cusip = '-'
-                for bond in self.bonds_general_info:
-                    if bond.securityTerm == name or bond.maturityDate == ltd:
-                        cusip = bond.cusip
-                        break
-                avg_price = 0.1*float(floatMaxString(avgCost))
-            else:
-                avg_price = float(floatMaxString(avgCost))
-            contract.exchange = 'SMART'
-            self.positions[contract.conId] = StrategyPosition(
-                contract, name, cusip, account, avg_price, float(position))
+        # updates streamed after positionEnd repeat the fills apply_fill already booked
+        if account == self.account and not self.positions_downloaded:
+            with self.state_lock:
+                if position == 0:
+                    self.positions.pop(contract.conId, None)
+                    self.pnl.load_account_position(contract.conId, 0.0, 0.0)
+                else:
+                    if contract.secType == 'BOND':
+                        name, cusip = self.instrument_name_and_cusip(contract)
+                        avg_price = 0.1*float(floatMaxString(avgCost))
+                    else:
+                        avg_price = float(floatMaxString(avgCost))
+                    contract.exchange = 'SMART'
+                    self.positions[contract.conId] = StrategyPosition(
+                        contract, name, cusip, account, avg_price, float(position))
+                    self.register_instrument(contract)
+                    self.pnl.load_account_position(contract.conId, float(position), avg_price)
+        self.wake_strategy()
         return super().position(account, contract, position, avgCost)
 
+    def instrument_name_and_cusip(self, contract: Contract) -> tuple[str, str]:
+        """Tenor and CUSIP of a bond contract from the instrument index, the tenor is estimated from the maturity
+        for bonds that are not in the index"""
+        security = self.instruments.find(contract)
+        if security is not None:
+            return security.securityTerm, security.cusip
+        return estimate_bond_name(self.instruments.contract_date(contract.lastTradeDateOrContractMonth)), '-'
+
+    def set_bonds_general_info(self, securities: list[USTreasurySecurity]) -> None:
+        self.bonds_general_info = securities
+        self.instruments = InstrumentIndex()
+        for security in securities:
+            self.instruments.add_security(security)
+
+    def register_instrument(self, contract: Contract) -> None:
+        """Terms the pnl engine needs to mark positions of a contract, the duration of a bond comes from its coupon and maturity"""
+        if self.pnl.is_registered(contract.conId):
+            return
+        security = self.instruments.find(contract)
+        name, _ = self.instrument_name_and_cusip(contract)
+        duration = 0.0
+        if contract.secType == 'BOND':
+            maturity = security.maturityDate if security is not None else self.instruments.contract_date(contract.lastTradeDateOrContractMonth)
+            # bills have no interest rate
+            coupon_rate = float(security.interestRate)/100 if security is not None and security.interestRate else 0.0
+            if maturity is not None:
+                duration = par_modified_duration(coupon_rate, (maturity - datetime.date.today()).days/365.25)
+        self.pnl.register(contract.conId, name, notional_per_unit(contract), duration)
+
     def true_unrealized_pnl_all(self) -> float:
-        pnl: float = 0
-        copy = self.positions.copy()
-        if len(copy) == 2:
-            for position in copy.values():
-                if position.contract.conId in self.quotes:
-                    if self.quotes[position.contract.conId].is_valid(5.0):
-                        this_pnl = position.unrealized_pnl(
-                            self.quotes[position.contract.conId])
-                        if this_pnl:
-                            pnl += this_pnl
-        return pnl
-
-    def close_all_positions(self):
-        if not self.is_flat():
-            for position in self.positions.values():
-                if not position.closing_order_sent:
-                    new_contract = position.contract
-                    new_contract.exchange = 'SMART'
-                    order = position.create_closing_order()
-                    strategy_order = StrategyOrder.create(order, new_contract)
-                    id = self.get_next_valid_order_id()
-                    self.orders[id] = strategy_order
+        return self.pnl.snapshot().unrealized
+
+    def close_positions(self, strategy: PairStrategy):
+        """Sends the orders that flatten the positions of one strategy"""
+        legs = []
+        for position in list(strategy.positions.values()):
+            if not position.closing_order_sent:
+                new_contract = position.contract
+                new_contract.exchange = 'SMART'
+                order = position.create_closing_order()
+                legs.append(StrategyOrder.create(order, new_contract, self.newest_tick_ns(strategy)))
+        self.execute_legs(strategy, legs, entry=False)
+        self.send_strategy_orders()
+
+    def execute_legs(self, strategy: PairStrategy, legs: list[StrategyOrder], entry: bool) -> None:
+        """Adds the orders of an entry or exit in the execution mode: every leg at market, or the least liquid leg
+        worked while the others wait in its LegExecution to hedge it"""
+        snapshots = {leg.contract.conId: self.quotes[leg.contract.conId].snapshot() for leg in legs if leg.contract.conId in self.quotes}
+        for leg in legs:
+            snapshot = snapshots.get(leg.contract.conId)
+            leg.arrival_price = snapshot.mid_price if snapshot is not None else None
+        worked = self.execution.worked_leg(legs, self.quotes) if legs and not self.execution.is_market() else None
+        if worked is None or not self.execution.work(worked, snapshots.get(worked.contract.conId)):
+            for leg in legs:
+                self.add_strategy_order(strategy, self.orders.allocate(), leg)
+            return
+        order_id = self.orders.allocate()
+        self.add_strategy_order(strategy, order_id, worked)
+        strategy.executions[order_id] = self.execution.start(order_id, entry, [leg for leg in legs if leg is not worked])
+
+    def manage_executions(self) -> None:
+        """Reprices the worked legs to the latest quotes, cancels those past their timeout and sends the legs waiting
+        on one that is done. Runs on every strategy wakeup, so a quote change from tickPrice reprices right away."""
+        for strategy in list(self.strategies.values()):
+            for order_id, execution in list(strategy.executions.items()):
+                leg = self.orders.get(order_id)
+                if leg is None:
+                    del strategy.executions[order_id]
+                elif execution.is_done():
+                    self.complete_execution(strategy, execution, leg)
+                elif execution.cancelled:
+                    # an entry whose worked leg never filled is given up, the strategy waits for the next signal
+                    del strategy.executions[order_id]
+                    strategy.order_ids.discard(order_id)
+                    if strategy.status == StrategyStatus.SENT_ENTRY_ORDERS:
+                        self.update_strategy_status(strategy, StrategyStatus.WAITING_FOR_TRADES)
+                elif self.execution.is_expired(execution):
+                    execution.cancel_sent = True
+                    self.execution.on_timeout(leg)
+                    log.info(f'{strategy.key} order {order_id} not filled after {self.execution.parameters.timeout_seconds}s, cancelling it')
+                    self.cancelOrder(order_id, '')
+                else:
+                    quote = self.quotes.get(leg.contract.conId)
+                    limit_price = self.execution.reprice_target(execution, leg, quote.snapshot() if quote is not None else None)
+                    if limit_price is not None and self.risk.allow_modification():
+                        self.execution.on_reprice(execution, leg, limit_price)
+                        self.placeOrder(order_id, leg.contract, leg.order)
+
+    def complete_execution(self, strategy: PairStrategy, execution: LegExecution, leg: StrategyOrder) -> None:
+        """Sends the orders that complete a pair at market, those the risk gate stops are retried on the next wakeup"""
+        if execution.hedges and self.risk.seconds_until_orders(len(execution.hedges)) > 0:
+            return
+        orders = self.execution.completion_orders(execution, leg)
+        for order in orders:
+            self.add_strategy_order(strategy, self.orders.allocate(), order)
         self.send_strategy_orders()
+        rejected = [order for order in orders if order.status == 'RiskRejected']
+        if rejected:
+            execution.hedges = [self.execution.retry_order(order) for order in rejected]
+        else:
+            del strategy.executions[execution.order_id]
+
+    def add_strategy_order(self, strategy: PairStrategy, order_id: int, order: StrategyOrder) -> None:
+        self.orders.add(order_id, order)
+        self.order_strategies[order_id] = strategy.key
+        self.latency.record('tick_to_order', order.tick_ns, order.created_ns)
+        strategy.order_ids.add(order_id)
     ### -------- orders --------######
 
     def orderStatus(self, orderId: OrderId, status: str, filled: Decimal, remaining: Decimal, avgFillPrice: float, permId: int, parentId: int, lastFillPrice: float, clientId: int, whyHeld: str, mktCselfrice: float):
-        if orderId in self.orders:
-            self.orders[orderId].status = status
-            self.orders[orderId].fill_price = avgFillPrice
-            if status == 'Filled' and self.orders[orderId].order.totalQuantity == filled and remaining == 0:
-                ltd = datetime.datetime.strptime(
-                    self.orders[orderId].contract.lastTradeDateOrContractMonth, '%Y%m%d').date()
-                name = estimate_bond_name(ltd)
-                cusip = '-'
-                for bond in self.bonds_general_info:
-                    if bond.contract_details:
-                        if self.orders[orderId].contract.conId == bond.contract_details.contract.conId:
-                            cusip = bond.cusip
-                self.orders[orderId].fill_time = datetime.datetime.now(
-                ).timestamp()
-                if self.status == StrategyStatus.SENT_ENTRY_ORDERS:
-                    self.positions[self.orders[orderId].contract.conId] = StrategyPosition.from_filled_order(
-                        self.orders[orderId].order, self.orders[orderId].contract, avgFillPrice, name=name, cusip=cusip)
-                    if not self.trades:
-                        self.trades.append(
-                            PairsTrade.open(self.orders[orderId]))
-                    else:
-                        if self.trades[-1].is_complete():
-                            self.trades.append(
-                                PairsTrade.open(self.orders[orderId]))
-                        else:
-                            self.trades[-1].add_entry_order(
-                                self.orders[orderId])
-                if self.status == StrategyStatus.SENT_EXIT_ORDERS:
-                    if self.orders[orderId].contract.conId in self.positions:
-                        self.positions.pop(self.orders[orderId].contract.conId)
-                        if self.trades:
-                            self.trades[-1].add_exit_order(self.orders[orderId])
+        with self.state_lock:
+            if orderId in self.orders:
+                became_terminal = self.orders.update_status(orderId, status)
+                if became_terminal and self.orders[orderId].sent_ns is not None:
+                    # releases the quantity that was sent, before a partial fill cuts it to what filled
+                    self.risk.on_done(self.orders[orderId])
+                partly_filled = became_terminal and status != 'Filled' and filled > 0
+                if became_terminal and status != 'Filled':
+                    self.on_order_cancelled(orderId, filled)
+                if partly_filled:
+                    # the order is booked for what it filled, like a complete fill of that quantity
+                    self.orders[orderId].order.totalQuantity = filled
+                self.orders[orderId].fill_price = avgFillPrice
+                if partly_filled or (status == 'Filled' and self.orders[orderId].order.totalQuantity == filled and remaining == 0):
+                    self.book_fill(orderId, avgFillPrice)
+        self.wake_strategy()
         return super().orderStatus(orderId, status, filled, remaining, avgFillPrice, permId, parentId, lastFillPrice, clientId, whyHeld, mktCselfrice)
 
+    def book_fill(self, order_id: int, avg_fill_price: float) -> None:
+        """Books the fill of an order into the account and strategy positions"""
+        order = self.orders[order_id]
+        name, cusip = self.instrument_name_and_cusip(order.contract)
+        # TWS repeats the Filled status, a fill is booked once
+        already_booked = order.fill_time is not None
+        order.fill_time = datetime.datetime.now().timestamp()
+        if already_booked:
+            return
+        filled_ns = monotonic_ns()
+        self.latency.record('place_order_to_fill', order.sent_ns, filled_ns)
+        self.latency.record('tick_to_fill', order.tick_ns, filled_ns)
+        self.execution.on_filled(order, avg_fill_price)
+        strategy = self.strategies.get(self.order_strategies.get(order_id))
+        if strategy is not None:
+            # the account wide positions add up the fills of every strategy
+            apply_fill(self.positions, order.order, order.contract, avg_fill_price, name, cusip)
+            trade = strategy.on_fill(order, avg_fill_price, name, cusip)
+            if trade is not None:
+                self.trades.append(trade)
+            execution = strategy.executions.get(order_id)
+            if execution is not None:
+                execution.filled = True
+            self.mark_strategy_changed(strategy)
+
+    def on_order_cancelled(self, order_id: int, filled: Decimal) -> None:
+        """A worked leg that ended before filling completely. manage_executions gives up an entry that did not fill
+        at all, hedges the filled part of one that did, and completes an exit with what is left at market."""
+        strategy = self.strategies.get(self.order_strategies.get(order_id))
+        execution = strategy.executions.get(order_id) if strategy is not None else None
+        if execution is None:
+            return
+        quantity = float(self.orders[order_id].order.totalQuantity)
+        if filled:
+            log.info(f'{strategy.key} order {order_id} ended with {filled} of {quantity} filled')
+        self.execution.on_cancelled(execution, quantity, float(filled))
+        self.mark_strategy_changed(strategy)
+
     def openOrder(self, orderId: OrderId, contract: Contract, order: Order, orderState: OrderState):
-        self.orders[orderId] = StrategyOrder(
-            order, contract, orderState.status, None, None, None)
+        # TWS echoes the orders placed here, they keep their StrategyOrder and its timings
+        if orderId in self.orders:
+            self.orders.update_status(orderId, orderState.status)
+        else:
+            self.orders.add(orderId, StrategyOrder(
+                order, contract, orderState.status, None, None, None))
 
     def send_strategy_orders(self):
-        for orderId, order in self.orders.items():
-            if order.status == 'Unsent' and order.contract:
-                new_contract = order.contract
-                new_contract.exchange = 'SMART'
-                self.placeOrder(orderId, new_contract, order.order)
-                order.sent_time = datetime.datetime.now().timestamp()
-                order.status = 'Sent'
+        """Places every unsent order in one burst, the bookkeeping is done first
+        so that the legs of a pair leave back to back"""
+        unsent = self.orders.take_unsent()
+        if not unsent:
+            return
+        check_start_ns = monotonic_ns()
+        reason = self.risk.check([order for _, order in unsent], self.positions, self.quotes, self.pnl.snapshot().gross_exposure)
+        self.latency.record('risk_check', check_start_ns)
+        if reason is not None:
+            self.reject_orders(unsent, reason)
+            return
+        for orderId, order in unsent:
+            order.contract.exchange = 'SMART'
+            # PairsTrade tells legs apart by order id, it must not depend on TWS echoing openOrder
+            order.order.orderId = orderId
+            self.risk.on_sent(order)
+            self.execution.on_sent(order)
+        for orderId, order in unsent:
+            self.placeOrder(orderId, order.contract, order.order)
+            order.sent_ns = monotonic_ns()
+        sent_time = datetime.datetime.now().timestamp()
+        for orderId, order in unsent:
+            order.sent_time = sent_time
+            self.latency.record('tick_to_place_order', order.tick_ns, order.sent_ns)
+            self.latency.record('order_to_place_order', order.created_ns, order.sent_ns)
+        if len(unsent) > 1:
+            self.latency.record('first_to_last_leg', unsent[0][1].sent_ns, unsent[-1][1].sent_ns)
+
+    def reject_orders(self, orders: list[tuple[int, StrategyOrder]], reason: str) -> None:
+        """Orders stopped by the risk gate, their strategies go back to the state before sending them"""
+        strategies = {}
+        for order_id, order in orders:
+            self.orders.update_status(order_id, 'RiskRejected')
+            strategy = self.strategies.get(self.order_strategies.get(order_id))
+            if strategy is not None:
+                strategy.order_ids.discard(order_id)
+                strategy.executions.pop(order_id, None)
+                # legs completing a pair are retried by their LegExecution, the strategy stays where it is
+                if order.execution != HEDGE:
+                    strategies[strategy.key] = strategy
+        if self.risk.metrics.is_worth_logging(reason):
+            log.error(f'Risk gate rejected orders {[order_id for order_id, _ in orders]}: {reason}, {self.risk.metrics.as_dict()}')
+        for strategy in strategies.values():
+            if strategy.status == StrategyStatus.SENT_ENTRY_ORDERS:
+                self.update_strategy_status(strategy, StrategyStatus.WAITING_FOR_TRADES)
+            elif strategy.status == StrategyStatus.SENT_EXIT_ORDERS:
+                self.update_strategy_status(strategy, StrategyStatus.IN_A_TRADE)
+        # a strategy retries on the next quote of its legs, retrying right away would spin while a limit holds
+        with self.changes_lock:
+            self.changed_strategies.difference_update(strategies)
 
-    def calculate_position_sizes(self) -> tuple[int, int]:
+    def archive_orders(self) -> None:
+        """Drops completed orders beyond the ones kept for late callbacks, see OrderManager"""
+        archived = self.orders.archive_terminal()
+        for order_id in archived:
+            strategy = self.strategies.get(self.order_strategies.pop(order_id, None))
+            if strategy is not None:
+                strategy.order_ids.discard(order_id)
+        self.pnl.forget_orders(archived)
+
+    def calculate_position_sizes(self, strategy: PairStrategy) -> tuple[int, int]:
         total_money_available = self.buying_powers[self.account]*(
-            self.percent_of_account_to_use/100)
-        one_thousand_dollar_units = math.floor(total_money_available/1000)
-        if self.strategy_data.hedge_ratio < 1:
-            contract_1_amount = math.floor(0.5*one_thousand_dollar_units)
-            contract_2_amount = math.floor(self.strategy_data.hedge_ratio*contract_1_amount)
-        else:
-            contract_2_amount = math.floor(0.5*one_thousand_dollar_units)
-            contract_1_amount = math.floor(contract_2_amount/self.strategy_data.hedge_ratio)
-        return [contract_1_amount, contract_2_amount]
+            self.percent_of_account_to_use/100)/self.max_pairs
+        return position_sizes(total_money_available, strategy.parameters.hedge_ratio)
 
     # def calculate_position_sizes_testing(self, sell_contract: int) -> tuple[int, int]:
     #     if sell_contract == 1:
@@ -248,21 +609,19 @@ class TradingApp(EWrapper, EClient):
     #     return [contract_1_amount, contract_2_amount]
 
     def openOrderEnd(self):
+        self.requests.mark_type_complete(DataRequest.Orders)
         self.orders_received = True
-        rows = []
-        for _, order in self.orders.items():
-            rows.append(order.get_summary())
-        df = pd.DataFrame(rows)
-        tt = df_to_tt(df)
-        if not df.empty:
-            print(tt)
+        self.reporter.report('open_orders', 'Orders', [order.get_summary() for _, order in self.orders.items()])
+        self.wake_strategy()
         return super().openOrderEnd()
 
-    def has_open_orders(self) -> bool:
-        if self.orders:
+    def has_open_orders(self, strategy: PairStrategy) -> bool:
+        if strategy.order_ids:
             is_open = True
-            for _, order in self.orders.items():
-                is_open = is_open and order.is_open()
+            for order_id in list(strategy.order_ids):
+                # an archived order is terminal
+                order = self.orders.get(order_id)
+                is_open = is_open and order is not None and order.is_open()
             return is_open
         else:
             return False
@@ -273,56 +632,123 @@ class TradingApp(EWrapper, EClient):
         return not self.positions
 
     def bondContractDetails(self, reqId: int, contractDetails: ContractDetails):
-        for bond in self.bonds_general_info:
-            if self.requests[reqId].name == bond.securityTerm:
-                bond.contract_details = contractDetails
+        # IB reports a bond maturity on the details, the contract itself comes back without a last trade date
+        if not contractDetails.contract.lastTradeDateOrContractMonth and contractDetails.maturity:
+            contractDetails.contract.lastTradeDateOrContractMonth = contractDetails.maturity
+        security = self.instruments.by_cusip.get(contractDetails.cusip or self.requests[reqId].contract.symbol)
+        if security is not None:
+            self.instruments.add_contract_details(security, contractDetails)
         return super().bondContractDetails(reqId, contractDetails)
 
+    def contractDetailsEnd(self, reqId: int):
+        self.requests.mark_complete(reqId)
+        # the bar request of the contract can go out now
+        self.wake_strategy()
+        return super().contractDetailsEnd(reqId)
+
     def tickByTickBidAsk(self, reqId: int, time: int, bidPrice: float, askPrice: float, bidSize: Decimal, askSize: Decimal, tickAttribBidAsk: TickAttribBidAsk):
+        received_ns = monotonic_ns()
         if reqId in self.requests:
+            self.requests.mark_complete(reqId)
             name = self.requests[reqId].contract.conId
-            mid_price = round((bidPrice + askPrice)/2,3)
-            self.quotes[name] = Quote(bidPrice,askPrice,bidSize,askSize,mid_price,time)
+            self.instrument_ticks(name).bid_ask.append(time, bidPrice, askPrice, float(bidSize), float(askSize))
+            if name in self.quotes:
+                self.quotes[name].update_bid_ask(bidPrice, askPrice, float(bidSize), float(askSize))
+            else:
+                self.quotes[name] = Quote.from_bid_ask(bidPrice, askPrice, float(bidSize), float(askSize))
+            quote = self.quotes[name]
+            self.pnl.on_quote(name, quote.bid_price, quote.ask_price, quote.last_update_ns)
+            self.latency.record('tick_to_quote', received_ns)
+            self.wake_strategy(name)
         return super().tickByTickBidAsk(reqId, time, bidPrice, askPrice, bidSize, askSize, tickAttribBidAsk)
     ###---------------Historical Data-----------------###
 
     def historicalData(self, reqId: int, bars: BarData):
         if reqId in self.requests:
             name = self.requests[reqId].name
-            bar = PriceBar.from_bar_data(bars)
-            if name in self.historical_data:
-                self.historical_data[name].append(bar)
-            else:
-                self.historical_data[name] = [bar]
+            if name not in self.historical_data:
+                self.historical_data[name] = BarStore()
+            loaded_until = self.loaded_until.get(name)
+            # the request overlaps the loaded bars by one bar
+            if loaded_until is None or bar_timestamp_ns(bars.date) > loaded_until:
+                self.historical_data[name].append_bar_data(bars)
         return super().historicalData(reqId, bars)
 
     def historicalDataEnd(self, reqId: int, start: str, end: str):
         self.number_complete_historical_datasets += 1
         if reqId in self.requests:
+            self.requests.mark_complete(reqId)
+            self.scheduler.release(reqId)
             name = self.requests[reqId].name
             if name in self.historical_data:
-                self.historical_data[name].sort(key=lambda x: x.timestamp)
-            log.info(f'Obtained {len(self.historical_data[name])} bars for the {name}')
+                self.historical_data[name].sort()
+                # the newest bar is still forming while keepUpToDate is on
+                self.archive_bars(reqId, len(self.historical_data[name]) - 1)
+            latency = self.requests[reqId].latency()
+            log.info(f'Obtained {len(self.historical_data[name])} bars for the {name}' + (f' in {latency:.2f}s' if latency is not None else ''))
+        self.wake_strategy()
 
     def historicalDataUpdate(self, reqId: int, bar: BarData):
         if reqId in self.requests:
             name = self.requests[reqId].name
             if name in self.historical_data:
-                price_bar = PriceBar.from_bar_data(bar)
-                if self.historical_data[name][-1].timestamp != price_bar.timestamp:
-                    self.historical_data[name].append(price_bar)
-                    if self.strategy_data and name in [self.strategy_data.bond_1_name, self.strategy_data.bond_2_name] and self.historical_data[self.strategy_data.bond_1_name][-1].timestamp == self.historical_data[self.strategy_data.bond_2_name][-1].timestamp:
-                        parameters = check_bonds(self.strategy_data.bond_1_name,self.historical_data[self.strategy_data.bond_1_name],self.strategy_data.bond_2_name,self.historical_data[self.strategy_data.bond_2_name],self.strategy_data.rolling_window)
-                        if parameters['complete_coint']:
-                            self.strategy_data.spread_mean = parameters['spread_mean']
-                            self.strategy_data.spread_std = parameters['spread_std']
-                        elif parameters['complete_coint'] is False:
-                            self.strategy_data = None
-                            log.error('Cointegration failed, strategy data reset')
-                            self.update_status(StrategyStatus.ANALYZING_PAIRS)
-                        log.info(f'Updated strategy parameters hedge ratio {self.strategy_data.hedge_ratio}, mean {self.strategy_data.spread_mean}, std {self.strategy_data.spread_std}, reversion time {self.strategy_data.time_to_revert}')
+                store = self.historical_data[name]
+                if store.last_timestamp() == bar_timestamp_ns(bar.date):
+                    store.replace_last_bar_data(bar)
+                else:
+                    store.append_bar_data(bar)
+                    self.archive_bars(reqId, len(store) - 1)
+                    for strategy in list(self.strategies.values()):
+                        bond_1_name, bond_2_name = strategy.leg_names()
+                        if name in (bond_1_name, bond_2_name) and self.historical_data[bond_1_name].last_timestamp() == self.historical_data[bond_2_name].last_timestamp():
+                            self.update_spread_statistics(strategy)
+                            self.mark_strategy_changed(strategy)
 
         return super().historicalDataUpdate(reqId, bar)
+
+    def archive_key(self, request: Subscription) -> Union[int, str]:
+        """conId of the instrument of a request, which keys its bars and ticks in the archive. Contracts built from
+        Treasury Direct have conId 0 and the CUSIP as symbol, the conId comes from their contract details."""
+        if request.contract.conId:
+            return request.contract.conId
+        security = self.instruments.by_cusip.get(request.contract.symbol)
+        if security is not None and security.contract_details is not None:
+            return security.contract_details.contract.conId
+        return request.contract.symbol
+
+    def archive_bars(self, reqId: int, end: int) -> None:
+        """Writes the finished bars of a historical request through to the archive"""
+        if self.archive is None:
+            return
+        request = self.requests[reqId]
+        store = self.historical_data[request.name]
+        if end > 0:
+            self.archive.append_bars(self.archive_key(request), self.bar_size(), store, end)
+            self.loaded_until[request.name] = max(int(store.timestamps[end - 1]), self.loaded_until.get(request.name) or 0)
+
+    def archive_ticks(self, interval_in_seconds: int = 10) -> None:
+        """Appends the bid/ask ticks recorded since the previous call to the archive, at most every interval_in_seconds"""
+        now = datetime.datetime.now().timestamp()
+        if self.archive is None or now - self.last_tick_archive_time < interval_in_seconds:
+            return
+        self.last_tick_archive_time = now
+        for con_id, ticks in list(self.ticks.items()):
+            rows, self.tick_archive_positions[con_id] = ticks.bid_ask.since(self.tick_archive_positions.get(con_id, 0))
+            self.archive.append_ticks(con_id, rows)
+
+    def update_spread_statistics(self, strategy: PairStrategy) -> None:
+        """Refreshes the spread statistics of a strategy from the newest bar of both legs, a pair that is no longer
+        cointegrated stops unless it is in a trade"""
+        bond_1_name, bond_2_name = strategy.leg_names()
+        if not strategy.update_spread_statistics(self.historical_data[bond_1_name], self.historical_data[bond_2_name],
+                                                 self.revalidation_interval, self.update_hedge_ratio):
+            log.error(f'{strategy.key}: cointegration failed')
+            if strategy.status == StrategyStatus.WAITING_FOR_TRADES:
+                self.retire_strategy(strategy)
+            return
+        parameters = strategy.parameters
+        log.info(f'{strategy.key}: updated strategy parameters hedge ratio {parameters.hedge_ratio}, mean {parameters.spread_mean}, std {parameters.spread_std}, reversion time {parameters.time_to_revert}')
+
     ##-----------------ACCOUNT DATA-------------------##
 
     def accountSummary(self, reqId: int, account: str, tag: str, value: str, currency: str):
@@ -331,14 +757,19 @@ class TradingApp(EWrapper, EClient):
             log.info(f'Account <{account}> buying power {value} {currency}')
         if tag == 'BuyingPower':
             self.buying_powers[account] = float(value)
+            self.wake_strategy()
 
     def accountSummaryEnd(self, reqId: int):
+        self.requests.mark_complete(reqId)
         self.account_summary_provided = True
+        self.wake_strategy()
         return super().accountSummaryEnd(reqId)
 
     ##-----------------Quote Data-------------------##
     def tickPrice(self, reqId: int, tickType: int, price: float, attrib: TickAttribBidAsk):
+        received_ns = monotonic_ns()
         if reqId in self.requests:
+            self.requests.mark_complete(reqId)
             name = self.requests[reqId].contract.conId
             if tickType == TickTypeEnum.BID or tickType == TickTypeEnum.ASK:
                 if name in self.quotes:
@@ -347,6 +778,12 @@ class TradingApp(EWrapper, EClient):
                 else:
                     if name:
                         self.quotes[name] = Quote.from_tick(tickType, price)
+                if name:
+                    quote = self.quotes[name]
+                    self.pnl.on_quote(name, quote.bid_price, quote.ask_price, quote.last_update_ns)
+                    self.record_quote_tick(name)
+                    self.latency.record('tick_to_quote', received_ns)
+                self.wake_strategy(name or None)
         return super().tickPrice(reqId, tickType, price, attrib)
 
     def tickSize(self, reqId: TickerId, tickType: TickType, size: Decimal):
@@ -355,8 +792,33 @@ class TradingApp(EWrapper, EClient):
             if (tickType == TickTypeEnum.BID_SIZE or tickType == TickTypeEnum.ASK_SIZE) and name in self.quotes and name is not None:
                 self.quotes[name].update_quote(
                     tickType, float(floatMaxString(size)))
+                self.record_quote_tick(name)
+                self.wake_strategy(name)
         return super().tickSize(reqId, tickType, size)
 
+    def instrument_ticks(self, con_id: int) -> InstrumentTicks:
+        if con_id not in self.ticks:
+            self.ticks[con_id] = InstrumentTicks(self.tick_buffer_size, self.tick_buffer_size, self.depth_levels)
+        return self.ticks[con_id]
+
+    def record_quote_tick(self, con_id: int) -> None:
+        """Appends the top of book after a market data tick, once both sides are known"""
+        quote = self.quotes[con_id]
+        if quote.bid_price is not None and quote.ask_price is not None:
+            self.instrument_ticks(con_id).bid_ask.append(0, quote.bid_price, quote.ask_price, quote.bid_size or 0.0, quote.ask_size or 0.0)
+
+    def updateMktDepth(self, reqId: TickerId, position: int, operation: int, side: int, price: float, size: Decimal):
+        if reqId in self.requests:
+            self.requests.mark_complete(reqId)
+            self.instrument_ticks(self.requests[reqId].contract.conId).on_depth(position, operation, side, price, float(size))
+        return super().updateMktDepth(reqId, position, operation, side, price, size)
+
+    def updateMktDepthL2(self, reqId: TickerId, position: int, marketMaker: str, operation: int, side: int, price: float, size: Decimal, isSmartDepth: bool):
+        if reqId in self.requests:
+            self.requests.mark_complete(reqId)
+            self.instrument_ticks(self.requests[reqId].contract.conId).on_depth(position, operation, side, price, float(size))
+        return super().updateMktDepthL2(reqId, position, marketMaker, operation, side, price, size, isSmartDepth)
+
     ##-----------------Subscription and request Data-------------------##
     def subscribe_to_data(self, request_number: int, contract: Optional[Contract] = None, data_type: Optional[DataRequest] = None):
         match data_type:
@@ -365,15 +827,16 @@ class TradingApp(EWrapper, EClient):
             case DataRequest.QuoteData:
                 self.reqMktData(request_number, contract, '', False, False, [])
             case DataRequest.MarketDepth:
-                self.reqMktDepth(request_number, contract, 10)
+                self.reqMktDepth(request_number, contract, self.depth_levels, False, [])
             case DataRequest.TickData:
                 self.reqTickByTickData(
                     request_number, contract, "BidAsk", 1, False)
             case DataRequest.HistoricalData:
-                request_name = f'{self.bar_interval} mins' if self.bar_interval > 1 else '1 min'
                 self.reqHistoricalData(
-                    request_number, contract, '', "1 M", request_name, 'MIDPOINT', 0, 1, True, [])
+                    request_number, contract, '', self.history_request_duration(request_number), self.bar_size(),
+                    'MIDPOINT', 0, 1, True, [])
             case DataRequest.Positions:
+                self.positions_downloaded = False
                 self.reqPositions()
             case DataRequest.Orders:
                 self.reqOpenOrders()
@@ -386,41 +849,56 @@ class TradingApp(EWrapper, EClient):
         return request_number
 
     ##-----------------Spread Data-------------------##
-    def calculate_spread(self) -> Optional[float]:
-        if self.strategy_data:
-            if self.strategy_data.bond_1_contract_id in self.quotes and self.strategy_data.bond_2_contract_id in self.quotes:
-                spread = round(self.quotes[self.strategy_data.bond_1_contract_id].mid_price -
-                               self.strategy_data.hedge_ratio*self.quotes[self.strategy_data.bond_2_contract_id].mid_price, 4)
-                return spread
+    def bar_size(self) -> str:
+        return f'{self.bar_interval} mins' if self.bar_interval > 1 else '1 min'
+
+    def history_request_duration(self, request_number: int) -> str:
+        """Seeds the bar store with the archived bars of the last month and returns the duration that fills the gap
+        since the newest bar already loaded"""
+        request = self.requests[request_number]
+        if self.archive is not None and request.name not in self.historical_data:
+            self.historical_data[request.name] = self.archive.bar_store(
+                self.archive_key(request), self.bar_size(), history_start(), in_memory=True)
+            log.info(f'{len(self.historical_data[request.name])} archived bars for the {request.name}')
+        if request.name in self.historical_data:
+            self.loaded_until[request.name] = self.historical_data[request.name].last_timestamp()
+        return history_duration(self.loaded_until.get(request.name), 60*self.bar_interval)
+
+    def spread_snapshot(self, strategy: PairStrategy) -> Optional[tuple[QuoteSnapshot, QuoteSnapshot]]:
+        """Consistent quotes of both legs, so the mid and true spread of a strategy price one moment"""
+        bond_1_id, bond_2_id = strategy.legs()
+        if bond_1_id in self.quotes and bond_2_id in self.quotes:
+            return pair_snapshot(self.quotes[bond_1_id], self.quotes[bond_2_id])
         return None
 
-    def calculate_true_spread(self, mid_price_spread_above_avg: bool) -> Optional[float]:
-        """True spread is calculated with bid and ask price."""
-        if mid_price_spread_above_avg:
-            true_spread = self.quotes[self.strategy_data.bond_1_contract_id].bid_price - (
-                self.strategy_data.hedge_ratio)*self.quotes[self.strategy_data.bond_2_contract_id].ask_price
-        else:
-            true_spread = self.quotes[self.strategy_data.bond_1_contract_id].ask_price - (
-                self.strategy_data.hedge_ratio)*self.quotes[self.strategy_data.bond_2_contract_id].bid_price
-        return round(true_spread, 4)
+    def sendable_requests(self) -> list[tuple[int, Subscription]]:
+        """Pending requests, without the bars of a contract whose details are still on their way: the archive keys
+        them by the conId the details bring"""
+        return [(request_id, request) for request_id, request in self.requests.pending()
+                if not self.awaits_contract_details(request)]
+
+    def awaits_contract_details(self, request: Subscription) -> bool:
+        if self.archive is None or request.data_type != DataRequest.HistoricalData or request.contract.conId:
+            return False
+        details_id = self.requests.find(request.contract, DataRequest.ContractInfo)
+        return details_id is not None and self.requests[details_id].state in (RequestState.Pending, RequestState.Sent)
 
     def send_requests(self):
-        for request_id, request in self.requests.items():
-            if not request.was_sent:
-                request.was_sent = True
-                self.subscribe_to_data(
-                    request_id, request.contract, request.data_type)
-                request.send_time = datetime.datetime.now(
-                ).timestamp()
-                log.info(f'{request.name} {request.data_type} request #{request_id} succesfully sent')
+        """Sends the pending requests the scheduler lets through, the rest go out on a later call"""
+        for request_id, request in self.scheduler.select(self.sendable_requests()):
+            self.requests.mark_sent(request_id)
+            self.subscribe_to_data(
+                request_id, request.contract, request.data_type)
+            log.info(f'{request.name} {request.data_type} request #{request_id} succesfully sent')
+
+    def seconds_until_next_request(self) -> Optional[float]:
+        return self.scheduler.seconds_until_next(self.sendable_requests())
 
     ### --------------------Helper Functions --------------------###
 
-    def has_all_data_to_calculate_strategy(self) -> bool:
-        if self.strategy_data:
-            if self.strategy_data.bond_1_contract_id in self.quotes and self.strategy_data.bond_2_contract_id in self.quotes:
-                return True
-        return False
+    def has_all_data_to_calculate_strategy(self, strategy: PairStrategy) -> bool:
+        bond_1_id, bond_2_id = strategy.legs()
+        return bond_1_id in self.quotes and bond_2_id in self.quotes
 
     def received_all_account_data(self, positions_timeout: bool) -> bool:
         return (self.account in self.buying_powers or self.account_summary_provided) and (self.pinged_positions or positions_timeout) and self.orders_received
@@ -428,27 +906,20 @@ class TradingApp(EWrapper, EClient):
     def has_data_to_analyze_pairs(self) -> bool:
         return len(self.bonds_general_info) == (self.number_complete_historical_datasets)
 
-    def has_data_to_place_trades(self) -> bool:
-        if self.strategy_data and self.account in self.buying_powers:
-            if self.strategy_data.bond_1_contract_id in self.quotes and self.strategy_data.bond_2_contract_id in self.quotes:
-                if self.quotes[self.strategy_data.bond_1_contract_id].is_valid(5.0) and self.quotes[self.strategy_data.bond_2_contract_id].is_valid(5.0):
+    def has_data_to_place_trades(self, strategy: PairStrategy) -> bool:
+        if self.account in self.buying_powers:
+            bond_1_id, bond_2_id = strategy.legs()
+            if bond_1_id in self.quotes and bond_2_id in self.quotes:
+                if self.quotes[bond_1_id].is_valid(5.0) and self.quotes[bond_2_id].is_valid(5.0):
                     return True
         return False
 
-    def has_data_to_calculate_spread(self) -> bool:
-        if self.strategy_data:
-            if self.strategy_data.bond_1_contract_id in self.quotes and self.strategy_data.bond_2_contract_id in self.quotes:
-                return True
-        return False
+    def has_data_to_calculate_spread(self, strategy: PairStrategy) -> bool:
+        return self.has_all_data_to_calculate_strategy(strategy)
 
-    def has_data_to_calculate_unrealized_pnl(self) -> bool:
-        # we copy positions to avoid runtime error of accessing the same object
-        positions_copy = self.positions.copy()
-        for position in positions_copy.values():
-            if position.contract.conId in self.quotes:
-                if not self.quotes[position.contract.conId].is_valid(5.0):
-                    return False
-        return True
+    def has_data_to_calculate_unrealized_pnl(self, strategy: Optional[PairStrategy] = None) -> bool:
+        """Positions of a strategy, or of the whole account, are marked to fresh quotes"""
+        return self.pnl.is_marked(strategy.key if strategy else None, 5.0)
 
     def is_time_to_report(self, interval_in_seconds: int = 10) -> bool:
         now = datetime.datetime.now().timestamp()
@@ -458,103 +929,116 @@ class TradingApp(EWrapper, EClient):
         else:
             return False
 
-    def get_positions_table(self) -> str:
-        if self.has_data_to_calculate_unrealized_pnl():
-            rows = []
-            for position in self.positions.values():
-                rows.append(position.to_row_with_unrealized_pnl(
-                    self.quotes[position.contract.conId]))
-            df = pd.DataFrame(rows)
-            df.loc[len(df)] = ['', '', '', '', '', '', '',
-                               'total pnl', df.unrealized_pnl.sum()]
-            table = df_to_tt(df)
-            return table
-
-    def buy_the_spread(self) -> None:
-        contract_1_amount,contract_2_amount = self.calculate_position_sizes()
-        sell_order = create_market_order(
-            "SELL", contract_2_amount, self.account)
+    def report_pnl(self, strategy: Optional[PairStrategy] = None) -> None:
+        """Positions of a strategy, or of the account, with their pnl and a row of totals"""
+        if self.has_data_to_calculate_unrealized_pnl(strategy):
+            book = strategy.key if strategy else None
+            rows = self.pnl.position_rows(book)
+            if not rows:
+                return
+            totals = self.pnl.snapshot(book)
+            rows.append({'book': 'total', 'unrealized_pnl': round(totals.unrealized, 2), 'realized_pnl': round(totals.realized, 2),
+                         'commissions': round(totals.commissions, 2), 'exposure': round(totals.gross_exposure, 2), 'dv01': round(totals.dv01, 2)})
+            self.reporter.report('pnl', strategy.key if strategy else 'Account', rows)
+
+    def trade_report(self, trade: PairsTrade) -> Optional[dict]:
+        """Report of a closed trade from the pnl engine, None until the commissions of its exits are in. The exits realize
+        the pnl, the executions of the entries are not known after a restart and only add their commissions when they are."""
+        exit_ids = [order.order.orderId for order in trade.exit_orders]
+        if not self.pnl.has_commissions(exit_ids):
+            return None
+        commissions, realized = self.pnl.order_totals([order.order.orderId for order in trade.entry_orders] + exit_ids)
+        return trade.report(commissions, realized)
+
+    def buy_the_spread(self, strategy: PairStrategy) -> None:
+        tick_ns = self.newest_tick_ns(strategy)
+        contract_1_amount,contract_2_amount = self.calculate_position_sizes(strategy)
         buy_order = create_market_order(
             "BUY", contract_1_amount, self.account)
-        id1 = self.get_next_valid_order_id()
-        id2 = id1 + 1
-        self.orders[id1] = StrategyOrder.create(
-            sell_order, self.strategy_data.bond_1_contract)
-        self.orders[id2] = StrategyOrder.create(
-            buy_order, self.strategy_data.bond_2_contract)
-        if not self.has_open_orders():
+        sell_order = create_market_order(
+            "SELL", contract_2_amount, self.account)
+        self.execute_legs(strategy, [StrategyOrder.create(buy_order, strategy.parameters.bond_1_contract, tick_ns),
+                                     StrategyOrder.create(sell_order, strategy.parameters.bond_2_contract, tick_ns)], entry=True)
+        if not self.has_open_orders(strategy):
             self.send_strategy_orders()
-        self.strategy_data.create_pickle_file()
 
-    def sell_the_spread(self) -> None:
-        contract_1_amount, contract_2_amount = self.calculate_position_sizes()
+    def sell_the_spread(self, strategy: PairStrategy) -> None:
+        tick_ns = self.newest_tick_ns(strategy)
+        contract_1_amount, contract_2_amount = self.calculate_position_sizes(strategy)
         sell_order = create_market_order(
             "SELL", contract_1_amount, self.account)
         buy_order = create_market_order(
             "BUY", contract_2_amount, self.account)
-        id1 = self.get_next_valid_order_id()
-        id2 = id1 + 1
-        self.orders[id1] = StrategyOrder.create(
-            sell_order, self.strategy_data.bond_1_contract)
-        self.orders[id2] = StrategyOrder.create(
-            buy_order, self.strategy_data.bond_2_contract)
-        if not self.has_open_orders():
+        self.execute_legs(strategy, [StrategyOrder.create(sell_order, strategy.parameters.bond_1_contract, tick_ns),
+                                     StrategyOrder.create(buy_order, strategy.parameters.bond_2_contract, tick_ns)], entry=True)
+        if not self.has_open_orders(strategy):
             self.send_strategy_orders()
-        self.strategy_data.create_pickle_file()
-
-    def find_pairs_trade(self) -> StrategyParameters:
-        log.info(f'Finding pairs trade')
-        names = [bond.securityTerm for bond in self.bonds_general_info]
-        pairs = []
-        for x in range(0, len(names)-1):
-            for y in range(len(names)-1, 0, -1):
-                if names[x] != names[y]:
-                    pair = [names[x], names[y]]
-                    reverse_pair = [names[y], names[x]]
-                    if pair not in pairs:
-                        pairs.append(pair)
-                    if reverse_pair not in pairs:
-                        pairs.append(reverse_pair)
-        results = (Parallel(n_jobs=-1)(delayed(check_bonds)
-                                       (pair[0], self.historical_data[pair[0]], pair[1], self.historical_data[pair[1]], self.rolling_window) for pair in pairs))
-        results_frame = pd.DataFrame(results)
-        results_frame.hedge_ratio = results_frame.hedge_ratio.astype(float)
-        # drop the rows where complete_coint is false
-        #results_frame = results_frame[results_frame.complete_coint]
-        results_frame.sort_values(by=['score'], ascending=False, inplace=True)
-        table = df_to_tt(results_frame)
-        log.info(f'\n{table}')
-        results = results_frame.iloc[0].copy()
-        for bond in self.bonds_general_info:
-            if bond.securityTerm == results.bond_1_name:
-                bond_1_contract = bond.contract_details.contract
-                conid1 = bond.contract_details.contract.conId
-            if bond.securityTerm == results.bond_2_name:
-                bond_2_contract = bond.contract_details.contract
-                conid2 = bond.contract_details.contract.conId
-        self.strategy_data = StrategyParameters(results.bond_1_name, results.bond_2_name, bond_1_contract, bond_2_contract, conid1,
-                                                conid2, results.hedge_ratio, results.spread_mean, results.spread_std, results.time_to_revert, self.rolling_window)
-
-    def get_bond_market_info(self):
-        log.info('Connecting to Treasury Direct...')
-        securities: Optional[list[USTreasurySecurity]] = get_bonds_info()
+
+    def newest_tick_ns(self, strategy: PairStrategy) -> Optional[int]:
+        """Monotonic time of the latest quote update of either leg, the tick a decision on the pair reacts to"""
+        times = [self.quotes[con_id].last_update_ns for con_id in strategy.legs() if con_id in self.quotes]
+        times = [value for value in times if value is not None]
+        return max(times) if times else None
+
+    def find_pairs_trades(self) -> list[PairStrategy]:
+        """Ranks the pairs and starts strategies on the best ones that are not running yet, up to max_pairs"""
+        log.info(f'Finding pairs trades')
+        names = unique_names([bond.securityTerm for bond in self.bonds_general_info])
+        timestamps, closes = align_closes(self.historical_data, names)
+        correlations = return_correlations(closes) if self.min_pair_correlation is not None else None
+        pairs = candidate_pairs(len(names), correlations, self.min_pair_correlation)
+        if not len(pairs):
+            log.info(f'No pair reaches a return correlation of {self.min_pair_correlation}, scoring all pairs')
+            pairs = candidate_pairs(len(names))
+        log.info(f'Scoring {len(pairs)} of {len(names)*(len(names) - 1)} pairs')
+        if self.analysis_pool:
+            self.analysis_pool.sync(names, timestamps, closes)
+            results = self.analysis_pool.score(pairs, self.rolling_window)
+        else:
+            results = score_pairs(names, closes, self.rolling_window, pairs)
+        for result in results:
+            result['hedge_ratio'] = float(result['hedge_ratio'])
+        # best score first, pairs without a score last
+        results = sorted(results, key=lambda result: -math.inf if math.isnan(result['score']) else result['score'], reverse=True)
+        self.reporter.report('pair_scores', 'Pair scores', results)
+        contracts = {bond.securityTerm: bond.contract_details.contract for bond in self.bonds_general_info if bond.contract_details}
+        started = []
+        for result in results:
+            if len(self.strategies) >= self.max_pairs:
+                break
+            if pair_key(result['bond_1_name'], result['bond_2_name']) in self.strategies:
+                continue
+            bond_1_contract = contracts[result['bond_1_name']]
+            bond_2_contract = contracts[result['bond_2_name']]
+            strategy = PairStrategy(StrategyParameters(result['bond_1_name'], result['bond_2_name'], bond_1_contract, bond_2_contract,
+                                                       bond_1_contract.conId, bond_2_contract.conId, result['hedge_ratio'], result['spread_mean'],
+                                                       result['spread_std'], result['time_to_revert'], self.rolling_window))
+            self.add_strategy(strategy)
+            started.append(strategy)
+        return started
+
+    def get_bond_market_info(self, security_master: Optional[SecurityMaster] = None):
+        log.info('Loading Treasury securities...')
+        securities: Optional[list[USTreasurySecurity]] = get_bonds_info(security_master)
         if securities is None:
             log.info('Failed to get data from Treasury Direct...Aborting.')
             exit()
-        self.bonds_general_info = securities
-        rows: list[dict[str, str]] = []
-        for security in securities:
-            rows.append(security.summarize())
-        df = pd.DataFrame(rows)
-        table = df_to_tt(df)
-        log.info(f'\n{table}')
+        self.set_bonds_general_info(securities)
+        self.reporter.report('securities', 'Treasury securities', [security.summarize() for security in securities])
 
     ### ------ Executions and Commissions -------###
     def execDetails(self, reqId: int, contract: Contract, execution: Execution):
+        # executions replayed by reqExecutions are already in the positions, only live ones (reqId -1) move the pnl
+        if reqId == -1:
+            self.register_instrument(contract)
+            self.pnl.on_execution(execution.execId, execution.orderId, self.order_strategies.get(execution.orderId, ACCOUNT_BOOK),
+                                  contract.conId, execution.side, float(execution.shares), execution.price)
         return super().execDetails(reqId, contract, execution)
 
     def commissionReport(self, commissionReport: CommissionReport):
-        if self.trades:
-            if len(self.trades[-1].commission_reports) < 4:
-                self.trades[-1].commission_reports.append(commissionReport)
+        # commission reports only name the execution, the pnl engine matches them whichever arrives first
+        order_id = self.pnl.on_commission(commissionReport)
+        strategy = self.strategies.get(self.order_strategies.get(order_id))
+        if strategy is not None:
+            self.mark_strategy_changed(strategy)
         return super().commissionReport(commissionReport)